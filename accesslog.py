@@ -0,0 +1,123 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class AccessLog:
+    """Журнал запросов в формате JSON lines.
+
+    Запись идёт в фоновом потоке через очередь: запрос только кладёт
+    словарь в очередь. При переполнении очереди записи отбрасываются
+    (счётчик dropped). Ротация по размеру: access.log -> access.log.1.
+    Ошибки записи не останавливают поток: пачка считается потерянной,
+    файл закрывается и открывается заново при следующей записи;
+    счётчик errors и last_error видны в memory_usage (/metrics).
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backup_count=5,
+                 queue_size=10000, flush_interval=1.0):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name='access-log'
+        )
+        self._thread.start()
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def memory_usage(self):
+        return {'queued': self._queue.qsize(), 'dropped': self.dropped,
+                'errors': self.errors, 'last_error': self.last_error}
+
+    # ==================== WRITER ====================
+    def _open(self):
+        if self._file is None:
+            self._file = open(self._path, 'a', encoding='utf-8')
+        return self._file
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self._backup_count <= 0:
+            os.remove(self._path)
+            return
+        for index in range(self._backup_count - 1, 0, -1):
+            source = f'{self._path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self._path}.{index + 1}')
+        os.replace(self._path, f'{self._path}.1')
+
+    def _run(self):
+        while True:
+            try:
+                records = [self._queue.get(timeout=self._flush_interval)]
+            except queue.Empty:
+                continue
+            # Забираем всё накопившееся одной пачкой
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                f = self._open()
+                f.write(''.join(
+                    json.dumps(record, ensure_ascii=False, default=str) +
+                    '\n' for record in records
+                ))
+                f.flush()
+                if f.tell() >= self._max_bytes:
+                    self._rotate()
+            except OSError as e:
+                self.errors += 1
+                self.last_error = str(e)
+                self.dropped += len(records)
+                self._close()
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """Ждёт, пока записи из очереди, включая текущую пачку, окажутся
+        в файле (для остановки сервера).
+        """
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+
+def create_access_log(config):
+    log_config = config.get('access_log') or {}
+    if not log_config.get('path'):
+        return None
+    return AccessLog(
+        log_config['path'],
+        log_config.get('max_bytes', 50 * 1024 * 1024),
+        log_config.get('backup_count', 5),
+        log_config.get('queue_size', 10000)
+    )
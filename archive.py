@@ -0,0 +1,80 @@
+import re
+import shutil
+import time
+import zipfile
+
+CHUNK_SIZE = 256 * 1024
+ZIP64_LIMIT = 0x7fffffff
+
+# Уже сжатые форматы кладём в архив без повторного сжатия
+STORED_TYPES = {
+    'application/pdf',
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'application/zip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+
+def safe_name(name):
+    name = UNSAFE_CHARS.sub('_', str(name)).strip(' .')
+    return name or 'document'
+
+
+class _BufferedStream:
+    """Буферизованная запись в сокет без поддержки seek/tell."""
+
+    def __init__(self, out, buffer_size=CHUNK_SIZE):
+        self._out = out
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self._out.write(bytes(self._buffer))
+            self._buffer.clear()
+        self._out.flush()
+
+
+def stream_zip(out, entries):
+    """Пишет ZIP в поток по мере чтения документов.
+
+    entries — итератор (имя, content_type, размер, файловый объект);
+    в памяти одновременно держится не больше одного буфера.
+    """
+    stream = _BufferedStream(out)
+    used_names = set()
+    with zipfile.ZipFile(stream, 'w', allowZip64=True) as zf:
+        for name, content_type, size, fileobj in entries:
+            base, dot, ext = name.rpartition('.')
+            unique_name = name
+            counter = 1
+            while unique_name in used_names:
+                counter += 1
+                unique_name = (
+                    f'{base} ({counter}).{ext}' if dot
+                    else f'{name} ({counter})'
+                )
+            used_names.add(unique_name)
+
+            info = zipfile.ZipInfo(
+                unique_name, date_time=time.localtime()[:6]
+            )
+            info.compress_type = (
+                zipfile.ZIP_STORED if content_type in STORED_TYPES
+                else zipfile.ZIP_DEFLATED
+            )
+            force_zip64 = size is None or size > ZIP64_LIMIT
+            with fileobj, zf.open(info, 'w', force_zip64=force_zip64) as dest:
+                shutil.copyfileobj(fileobj, dest, CHUNK_SIZE)
+    stream.flush()
@@ -1,44 +1,530 @@
+import base64
 import hashlib
+import hmac
+import json
+import math
+import os
 import secrets
+import threading
 import time
+from collections import OrderedDict
 
-class SessionManager:
-    def __init__(self):
+from memory import deep_size
+
+
+class SessionBackend:
+    """Хранилище сессий в памяти процесса (без сохранения).
+
+    shared — хранилище общее для нескольких экземпляров сервера:
+    локальная копия сессии тогда периодически сверяется с ним.
+    Методы вызываются без блокировки SessionManager.
+    """
+
+    shared = False
+
+    def load(self):
+        return []
+
+    def get(self, key):
+        return None
+
+    def save(self, key, session):
+        pass
+
+    def delete(self, keys):
+        pass
+
+    def delete_user(self, user_id):
+        """Удаляет сессии пользователя, о которых этот экземпляр
+        может не знать. Возвращает их число.
+        """
+        return 0
+
+
+class FileSessionBackend(SessionBackend):
+    """Журнал сессий на локальном диске (JSON lines).
+
+    Журнал периодически переписывается из живых сессий, чтобы
+    не расти бесконечно. Живые сессии для этого ведутся здесь же,
+    под своей блокировкой: запись в журнал и его перезапись не
+    перемешиваются.
+    """
+
+    def __init__(self, path, min_compact_lines=1000):
+        self._path = path
+        self._min_compact_lines = min_compact_lines
+        self._lines = 0
+        self._file = None
         self._sessions = {}
-        self._session_timeout = 3600 * 8  # 8 часов
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self._path, 'a', encoding='utf-8')
+        return self._file
+
+    def _append(self, records):
+        f = self._open()
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+        f.flush()
+        self._lines += len(records)
+        if self._lines >= max(self._min_compact_lines,
+                              len(self._sessions) * 2):
+            self._compact()
+
+    def load(self):
+        sessions = {}
+        if os.path.exists(self._path):
+            with open(self._path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('op') == 'set':
+                        sessions[record['key']] = record['session']
+                    else:
+                        sessions.pop(record.get('key'), None)
+        with self._lock:
+            self._sessions = sessions
+            self._compact()
+        return list(sessions.items())
+
+    def save(self, key, session):
+        with self._lock:
+            self._sessions[key] = session
+            self._append([{'op': 'set', 'key': key, 'session': session}])
+
+    def delete(self, keys):
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                self._sessions.pop(key, None)
+            self._append([{'op': 'del', 'key': key} for key in keys])
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, session in self._sessions.items():
+                f.write(json.dumps(
+                    {'op': 'set', 'key': key, 'session': session},
+                    default=str
+                ) + '\n')
+        os.replace(tmp_path, self._path)
+        self._lines = len(self._sessions)
+
+
+class PostgresSessionBackend(SessionBackend):
+    """Сессии в таблице PostgreSQL, общей для нескольких экземпляров."""
+
+    shared = True
+
+    def __init__(self, db):
+        self._db = db
+
+    def load(self):
+        self._db.delete_expired_sessions()
+        return [
+            (row['session_key'], self._session(row))
+            for row in self._db.load_sessions()
+        ]
+
+    def get(self, key):
+        row = self._db.get_session_record(key)
+        return self._session(row) if row else None
+
+    def save(self, key, session):
+        self._db.save_session(
+            key, json.dumps(session['user'], default=str),
+            session['created_at'], session['expires_at']
+        )
+
+    def delete(self, keys):
+        if keys:
+            self._db.delete_sessions(list(keys))
+
+    def delete_user(self, user_id):
+        return self._db.delete_user_sessions(user_id) or 0
+
+    @staticmethod
+    def _session(row):
+        return {
+            'user': row['user_data'],
+            'created_at': row['created_at'],
+            'expires_at': row['expires_at']
+        }
+
+
+class SessionManager:
+    def __init__(self, timeout=3600 * 8, max_sessions=10000,
+                 sliding=False, sliding_resolution=60, backend=None,
+                 revalidate=5):
+        # Ключи — SHA-256 от session_id: сам идентификатор не хранится.
+        # Порядок OrderedDict совпадает с порядком истечения, т.к.
+        # таймаут у всех сессий одинаковый.
+        self._sessions = OrderedDict()
+        self._session_timeout = timeout
+        self._max_sessions = max_sessions
+        self._sliding = sliding
+        self._sliding_resolution = sliding_resolution
+        self._backend = backend or SessionBackend()
+        # Для общего хранилища: ключ -> время последней сверки.
+        # Копия сессии старше revalidate секунд перечитывается, чтобы
+        # выход или отзыв на другом экземпляре действовал и здесь.
+        self._revalidate = revalidate
+        self._checked = {}
+        # _lock защищает только словари в памяти; обращения к
+        # хранилищу (БД, файл) идут без неё
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+        now = time.time()
+        records = sorted(
+            self._backend.load(), key=lambda item: item[1]['expires_at']
+        )
+        for key, session in records:
+            if session['expires_at'] > now:
+                self._sessions[key] = session
+                self._checked[key] = now
+
+    @staticmethod
+    def _key(session_id):
+        return hashlib.sha256(session_id.encode()).hexdigest()
+
+    def _pop(self, key):
+        self._checked.pop(key, None)
+        return self._sessions.pop(key, None)
+
+    def _reap(self, now):
+        expired = []
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session['expires_at'] > now:
+                break
+            self._pop(key)
+            expired.append(key)
+        return expired
 
     def create_session(self, user_data):
         session_id = secrets.token_hex(32)
-        self._sessions[session_id] = {
+        key = self._key(session_id)
+        now = time.time()
+        session = {
             'user': user_data,
-            'created_at': time.time()
+            'created_at': now,
+            'expires_at': now + self._session_timeout
         }
+
+        with self._lock:
+            removed = self._reap(now)
+            while len(self._sessions) >= self._max_sessions:
+                removed.append(next(iter(self._sessions)))
+                self._pop(removed[-1])
+                self.evictions += 1
+            self._sessions[key] = session
+            self._checked[key] = now
+        self._backend.delete(removed)
+        self._backend.save(key, session)
         return session_id
 
     def get_session(self, session_id):
-        if not session_id or session_id not in self._sessions:
+        if not session_id:
             return None
 
-        session = self._sessions[session_id]
-        if time.time() - session['created_at'] > self._session_timeout:
-            del self._sessions[session_id]
+        key = self._key(session_id)
+        now = time.time()
+        with self._lock:
+            expired = self._reap(now)
+            session = self._sessions.get(key)
+            if session is not None and session['expires_at'] <= now:
+                self._pop(key)
+                expired.append(key)
+                session = None
+            stale = session is None or self._backend.shared and \
+                now - self._checked.get(key, 0) >= self._revalidate
+        if expired:
+            self._backend.delete(expired)
+        if session is None and key in expired:
             return None
 
+        if stale:
+            # Сессии нет в памяти (создана другим экземпляром) или
+            # копию пора сверить с общим хранилищем
+            stored = self._backend.get(key)
+            with self._lock:
+                if stored is None or stored['expires_at'] <= now:
+                    self._pop(key)
+                    return None
+                session = self._sessions.get(key)
+                if session is None or \
+                        stored['expires_at'] > session['expires_at']:
+                    session = self._sessions[key] = stored
+                self._checked[key] = now
+
+        save = False
+        if self._sliding:
+            expires_at = now + self._session_timeout
+            with self._lock:
+                if expires_at - session['expires_at'] >= \
+                        self._sliding_resolution and key in self._sessions:
+                    session['expires_at'] = expires_at
+                    self._sessions.move_to_end(key)
+                    save = True
+            if save:
+                self._backend.save(key, session)
+
         return session['user']
 
     def delete_session(self, session_id):
-        if session_id in self._sessions:
-            del self._sessions[session_id]
+        if not session_id:
+            return
+        key = self._key(session_id)
+        with self._lock:
+            self._pop(key)
+        self._backend.delete([key])
 
     def cleanup_expired(self):
-        current_time = time.time()
-        expired = [
-            sid for sid, data in self._sessions.items()
-            if current_time - data['created_at'] > self._session_timeout
-        ]
-        for sid in expired:
-            del self._sessions[sid]
+        with self._lock:
+            expired = self._reap(time.time())
+        self._backend.delete(expired)
+        return len(expired)
 
-    @staticmethod
-    def hash_password(password):
-        return hashlib.sha256(password.encode()).hexdigest()
\ No newline at end of file
+    def revoke_user(self, user_id):
+        with self._lock:
+            keys = [
+                key for key, session in self._sessions.items()
+                if session['user'].get('id') == user_id
+            ]
+            for key in keys:
+                self._pop(key)
+        self._backend.delete(keys)
+        # Сессии пользователя на других экземплярах — в хранилище
+        return len(keys) + self._backend.delete_user(user_id)
+
+    def count(self):
+        return len(self._sessions)
+
+    def memory_usage(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'evictions': self.evictions,
+                'bytes': deep_size(self._sessions)
+            }
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class TokenSessionManager:
+    """Сессии без состояния на сервере: cookie session_id содержит
+    подписанный HMAC-SHA256 токен v1.<key_id>.<payload>.<signature>.
+
+    Любой экземпляр сервера проверяет токен без обращения к БД.
+    Отозванные токены хранятся в небольшом deny-list, который
+    перечитывается из БД не чаще раза в refresh_interval секунд.
+    """
+
+    VERSION = 'v1'
+    USER_FIELDS = ('id', 'username', 'admin')
+
+    def __init__(self, keys, signing_key=None, timeout=3600 * 8,
+                 db=None, refresh_interval=30):
+        if not keys:
+            raise ValueError('Session token keys are not configured')
+        # Старые ключи остаются в keys только для проверки, пока
+        # не истекут выданные ими токены.
+        self._keys = {
+            str(key_id): secret.encode()
+            for key_id, secret in keys.items()
+        }
+        self._signing_key = str(signing_key or next(iter(self._keys)))
+        if self._signing_key not in self._keys:
+            raise ValueError(f'Unknown signing key: {self._signing_key}')
+        self._session_timeout = timeout
+        self._db = db
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._denied = {}
+        self._revoked_users = {}
+        self._refreshed_at = 0
+
+    def _sign(self, key_id, payload):
+        message = f'{self.VERSION}.{key_id}.{payload}'.encode('ascii')
+        return _b64encode(
+            hmac.new(self._keys[key_id], message, hashlib.sha256).digest()
+        )
+
+    def _decode(self, token):
+        try:
+            version, key_id, payload, signature = token.split('.')
+        except ValueError:
+            return None
+        if version != self.VERSION or key_id not in self._keys:
+            return None
+        if not hmac.compare_digest(self._sign(key_id, payload), signature):
+            return None
+        try:
+            return json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+
+    # ==================== DENY-LIST ====================
+    def _refresh(self, now):
+        """Перечитывает deny-list из БД. Запрос выполняется без
+        блокировки, чтобы медленная БД не задерживала проверки
+        токенов; под блокировкой только слияние с текущими записями
+        (отозванное не возвращается, поэтому записи объединяются).
+        """
+        with self._lock:
+            if self._db is None or \
+                    now - self._refreshed_at < self._refresh_interval:
+                return
+            self._refreshed_at = now
+        denied = {}
+        revoked_users = {}
+        for row in self._db.get_session_denylist():
+            if row['user_id'] is not None:
+                revoked_users[row['user_id']] = row['revoked_at']
+            else:
+                denied[row['token_id']] = row['expires_at']
+        # Отзыв пользователя важен, пока живы выданные до него токены
+        oldest = now - self._session_timeout
+        with self._lock:
+            for token_id, expires_at in self._denied.items():
+                if expires_at > now:
+                    denied[token_id] = expires_at
+            for user_id, revoked_at in self._revoked_users.items():
+                if revoked_at > max(oldest, revoked_users.get(user_id, 0)):
+                    revoked_users[user_id] = revoked_at
+            self._denied = denied
+            self._revoked_users = revoked_users
+
+    def _deny(self, token_id, user_id, revoked_at, expires_at):
+        if self._db is not None:
+            self._db.deny_session_token(
+                token_id, user_id, revoked_at, expires_at
+            )
+
+    # ==================== SESSIONS ====================
+    def create_session(self, user_data):
+        now = time.time()
+        claims = {
+            field: user_data.get(field) for field in self.USER_FIELDS
+        }
+        # Вниз до миллисекунды: округление вверх сделало бы токен,
+        # выданный перед revoke_user, более поздним, чем отзыв
+        claims['iat'] = math.floor(now * 1000) / 1000
+        claims['exp'] = int(now + self._session_timeout)
+        claims['jti'] = secrets.token_hex(8)
+        payload = _b64encode(
+            json.dumps(claims, separators=(',', ':')).encode()
+        )
+        key_id = self._signing_key
+        return f'{self.VERSION}.{key_id}.{payload}.' \
+               f'{self._sign(key_id, payload)}'
+
+    def get_session(self, session_id):
+        if not session_id:
+            return None
+        claims = self._decode(session_id)
+        if claims is None:
+            return None
+
+        now = time.time()
+        if claims.get('exp', 0) <= now:
+            return None
+
+        self._refresh(now)
+        with self._lock:
+            if claims.get('jti') in self._denied:
+                return None
+            revoked_at = self._revoked_users.get(claims.get('id'))
+            if revoked_at is not None and claims.get('iat', 0) <= revoked_at:
+                return None
+
+        return {field: claims.get(field) for field in self.USER_FIELDS}
+
+    def delete_session(self, session_id):
+        claims = self._decode(session_id) if session_id else None
+        if claims is None or not claims.get('jti'):
+            return
+        with self._lock:
+            self._denied[claims['jti']] = claims['exp']
+        self._deny(claims['jti'], None, time.time(), claims['exp'])
+
+    def revoke_user(self, user_id):
+        now = time.time()
+        with self._lock:
+            self._revoked_users[user_id] = now
+        self._deny(
+            f'user:{user_id}', user_id, now, now + self._session_timeout
+        )
+        return 0
+
+    def cleanup_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                token_id for token_id, expires_at in self._denied.items()
+                if expires_at <= now
+            ]
+            for token_id in expired:
+                del self._denied[token_id]
+        return len(expired)
+
+    def count(self):
+        # Число выданных токенов серверу неизвестно
+        return None
+
+    def memory_usage(self):
+        with self._lock:
+            return {
+                'denied_tokens': len(self._denied),
+                'revoked_users': len(self._revoked_users),
+                'bytes': deep_size(self._denied) +
+                deep_size(self._revoked_users)
+            }
+
+
+def create_session_manager(config, db=None):
+    session_config = config.get('sessions') or {}
+    backend_name = session_config.get('backend', 'memory')
+    if backend_name == 'token':
+        return TokenSessionManager(
+            session_config.get('token_keys') or {},
+            signing_key=session_config.get('signing_key'),
+            timeout=session_config.get('timeout', 3600 * 8),
+            db=db,
+            refresh_interval=session_config.get('denylist_refresh', 30)
+        )
+    if backend_name == 'file':
+        backend = FileSessionBackend(
+            session_config.get('path', 'sessions.journal')
+        )
+    elif backend_name == 'postgres':
+        backend = PostgresSessionBackend(db)
+    elif backend_name == 'memory':
+        backend = SessionBackend()
+    else:
+        raise ValueError(f'Unknown session backend: {backend_name}')
+
+    return SessionManager(
+        timeout=session_config.get('timeout', 3600 * 8),
+        max_sessions=session_config.get('max_sessions', 10000),
+        sliding=session_config.get('sliding', False),
+        sliding_resolution=session_config.get('sliding_resolution', 60),
+        backend=backend,
+        revalidate=session_config.get('revalidate', 5)
+    )
@@ -0,0 +1,104 @@
+"""Бенчмарк сериализации ответа /api/objects на 50 000 строк.
+
+    python bench/bench_json.py
+    python bench/bench_json.py --rows 200000 --repeat 10
+
+Последняя строка — колоночный формат (?format=columns).
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonenc import JsonEncoder, orjson, to_columns  # noqa: E402
+
+
+def build_rows(count):
+    created = datetime.datetime(2024, 3, 1, 9, 30, 15, 250000)
+    return [
+        {
+            'id': i,
+            'objectname': f'Объект №{i}, ул. Строителей, д. {i % 300}',
+            'amount': Decimal(f'{i * 17 % 100000}.50'),
+            'write_off': Decimal(f'{i * 7 % 50000}.25'),
+            'balance': Decimal(f'{i * 10 % 50000}.25'),
+            'created_at': created + datetime.timedelta(minutes=i),
+            'contract_date': datetime.date(2024, 1, 1 + i % 28),
+            'active': i % 5 != 0,
+            'seller_name': f'ООО «Поставщик {i % 40}»',
+            'comment': None,
+        }
+        for i in range(count)
+    ]
+
+
+def measure(encode, rows, repeat):
+    timings = []
+    result = b''
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = encode(rows)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = build_rows(args.rows)
+    encoders = [(
+        'json.dumps(default=str)',
+        lambda data: json.dumps(
+            data, default=str, ensure_ascii=False
+        ).encode('utf-8')
+    ), ('JsonEncoder(json)', JsonEncoder('json').encode)]
+    if orjson is not None:
+        encoders.append(('JsonEncoder(orjson)', JsonEncoder('orjson').encode))
+    else:
+        print('orjson is not installed, skipping')
+
+    reference = None
+    for name, encode in encoders:
+        timings, result = measure(encode, rows, args.repeat)
+        # Стандартный json — байт в байт как прежний json.dumps,
+        # orjson — компактный, сравниваются только значения
+        reference = reference or result
+        if name != 'JsonEncoder(orjson)':
+            assert result == reference, f'{name}: output differs'
+        assert json.loads(result) == json.loads(
+            json.dumps(rows, default=str)
+        ), f'{name}: values differ'
+        print(
+            f'{name:<24} {len(result):>10} bytes  '
+            f'min {min(timings):8.2f} ms  '
+            f'median {statistics.median(timings):8.2f} ms'
+        )
+
+    encode = encoders[-1][1]
+    timings, result = measure(
+        lambda data: encode(to_columns(data)), rows, args.repeat
+    )
+    parse, _ = measure(json.loads, result, args.repeat)
+    rows_parse, _ = measure(json.loads, encode(rows), args.repeat)
+    print(
+        f'{"columns":<24} {len(result):>10} bytes  '
+        f'min {min(timings):8.2f} ms  '
+        f'median {statistics.median(timings):8.2f} ms'
+    )
+    print(
+        f'json.loads: rows {statistics.median(rows_parse):.2f} ms, '
+        f'columns {statistics.median(parse):.2f} ms'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Бенчмарк /api/object_details на объекте с большим числом документов.
+
+    python bench/bench_object_details.py --seed 200 --file-size 2000000 \
+        --username admin --password admin
+    python bench/bench_object_details.py --object-id 42 --requests 500
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import uuid
+import urllib.request
+from http.cookiejar import CookieJar
+
+
+def build_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'.encode('utf-8')
+        )
+    for name, (filename, data) in files.items():
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"; '
+            f'filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'.encode('utf-8')
+            + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def request(opener, url, method='GET', body=None, content_type=None):
+    req = urllib.request.Request(url, data=body, method=method)
+    if content_type:
+        req.add_header('Content-Type', content_type)
+    with opener.open(req) as response:
+        return response.read()
+
+
+def seed(opener, base_url, count, file_size):
+    suffix = uuid.uuid4().hex[:8]
+    body, content_type = build_multipart({
+        'newObjectName': f'bench-{suffix}',
+        'newSellerName': f'bench-seller-{suffix}',
+        'newSellerInn': '0000000000',
+        'newSellerKpp': '000000000',
+        'newThemeName': f'bench-theme-{suffix}',
+        'quantity': '1'
+    }, {})
+    request(opener, f'{base_url}/api/receipt', 'POST', body, content_type)
+
+    objects = json.loads(request(opener, f'{base_url}/api/objects'))
+    obj = next(o for o in objects if o['objectname'] == f'bench-{suffix}')
+    receipt = json.loads(request(
+        opener, f'{base_url}/api/object_details?id={obj["id"]}'
+    ))['receipts'][0]
+
+    for i in range(count):
+        data = b'%PDF-1.4\n' + os.urandom(file_size)
+        body, content_type = build_multipart({
+            'objectId': obj['id'],
+            'sellerId': receipt['seller_id'],
+            'themeId': receipt['theme_id'],
+            'billNumber': f'B-{i}',
+            'invoiceNumber': f'I-{i}',
+            'entryControlNumber': f'E-{i}',
+            'quantity': '1'
+        }, {
+            'billFile': (f'bill-{i}.pdf', data),
+            'invoiceFile': (f'invoice-{i}.pdf', data[::-1]),
+            'entryControlFile': (f'ec-{i}.pdf', data[:file_size // 2])
+        })
+        request(opener, f'{base_url}/api/receipt', 'POST',
+                body, content_type)
+    return obj['id']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--object-id', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    args = parser.parse_args()
+
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(CookieJar())
+    )
+    if args.username:
+        body, content_type = build_multipart({
+            'username': args.username, 'password': args.password or ''
+        }, {})
+        request(opener, f'{args.url}/api/auth/login', 'POST',
+                body, content_type)
+
+    object_id = args.object_id
+    if args.seed:
+        object_id = seed(opener, args.url, args.seed, args.file_size)
+        print(f'Seeded object {object_id} with {args.seed * 3} documents')
+    if object_id is None:
+        parser.error('--object-id or --seed is required')
+
+    url = f'{args.url}/api/object_details?id={object_id}'
+    timings = []
+    size = 0
+    for _ in range(args.requests):
+        started = time.perf_counter()
+        size = len(request(opener, url))
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+    print(f'requests: {len(timings)}, response: {size} bytes')
+    print(
+        f'min {timings[0]:.2f} ms, '
+        f'median {statistics.median(timings):.2f} ms, '
+        f'p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, '
+        f'max {timings[-1]:.2f} ms'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,592 @@
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+import yaml
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from handlers import FileHelper
+from uploads import UploadManager
+
+
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 256 * 1024
+
+# Форматы, которые уже сжаты: повторно их не сжимаем.
+COMPRESSED_MAGIC = (
+    b'\xff\xd8\xff',        # JPEG
+    b'\x89PNG',              # PNG
+    b'GIF8',                 # GIF
+    b'PK\x03\x04',           # ZIP, docx, xlsx
+    b'\x1f\x8b',             # gzip
+    b'\x28\xb5\x2f\xfd',     # zstd
+    b'7z\xbc\xaf',           # 7z
+    b'Rar!',                 # RAR
+)
+
+
+class _ZlibReader(io.RawIOBase):
+    def __init__(self, raw):
+        self._raw = raw
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            data = (
+                self._decompressor.unconsumed_tail or
+                self._raw.read(CHUNK_SIZE)
+            )
+            if not data:
+                self._buffer = self._decompressor.flush()
+                if not self._buffer:
+                    return 0
+                break
+            self._buffer = self._decompressor.decompress(
+                data, CHUNK_SIZE
+            )
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def _zlib_compressor(level):
+    return zlib.compressobj(6 if level is None else level)
+
+
+def _zstd_compressor(level):
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level
+    ).compressobj()
+
+
+def _zstd_reader(raw):
+    return zstandard.ZstdDecompressor().stream_reader(
+        raw, closefd=True
+    )
+
+
+# encoding -> (фабрика компрессора, обёртка потока на чтение)
+CODECS = {
+    'zlib': (
+        _zlib_compressor,
+        lambda raw: io.BufferedReader(_ZlibReader(raw))
+    ),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compressor, _zstd_reader)
+
+
+class BlobStore:
+    """Базовый интерфейс хранилища содержимого документов по SHA-256."""
+
+    def put(self, data):
+        raise NotImplementedError
+
+    def put_file(self, source_path, sha256=None):
+        with open(source_path, 'rb') as f:
+            data = f.read()
+        if sha256 and self.digest(data) != sha256:
+            raise ValueError('Checksum mismatch')
+        digest = self.put(data)
+        os.remove(source_path)
+        return digest
+
+    def open(self, digest):
+        """Открывает блоб на чтение исходного (несжатого) содержимого."""
+        raise NotImplementedError
+
+    def read_stored(self, digest):
+        """Возвращает (encoding, bytes) в том виде, как блоб хранится."""
+        raise NotImplementedError
+
+    def stored_size(self, digest):
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def mtime(self, digest):
+        """Время последней записи блоба или None, если его нет."""
+        raise NotImplementedError
+
+    def delete(self, digest):
+        raise NotImplementedError
+
+    def iter_digests(self):
+        """Возвращает пары (digest, mtime) для всех блобов."""
+        raise NotImplementedError
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def decompress(encoding, data):
+        with CODECS[encoding][1](io.BytesIO(data)) as reader:
+            return reader.read()
+
+
+class FilesystemBlobStore(BlobStore):
+    def __init__(self, root, compression='auto', level=None,
+                 min_saving=0.1):
+        self._root = os.path.abspath(root)
+        self._tmp_dir = os.path.join(self._root, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+        if compression == 'auto':
+            compression = 'zstd' if 'zstd' in CODECS else 'zlib'
+        if compression not in CODECS and compression != 'none':
+            raise ValueError(f'Unknown compression: {compression}')
+        self._compression = None if compression == 'none' else compression
+        self._level = level
+        self._min_saving = min_saving
+
+    def _path(self, digest):
+        if len(digest) != 64 or not all(
+            c in '0123456789abcdef' for c in digest
+        ):
+            raise ValueError('Invalid blob digest')
+        return os.path.join(
+            self._root, digest[:2], digest[2:4], digest
+        )
+
+    def _find(self, digest):
+        """Возвращает (encoding, path) хранимого блоба или (None, None)."""
+        path = self._path(digest)
+        if os.path.exists(path):
+            return None, path
+        for encoding in CODECS:
+            encoded_path = f'{path}.{encoding}'
+            if os.path.exists(encoded_path):
+                return encoding, encoded_path
+        return None, None
+
+    def _compress_bytes(self, data):
+        compressor = CODECS[self._compression][0](self._level)
+        return compressor.compress(data) + compressor.flush()
+
+    def _worth_compressing(self, sample):
+        """Решает по началу файла, имеет ли смысл его сжимать."""
+        if self._compression is None or not sample:
+            return False
+        if sample.startswith(COMPRESSED_MAGIC):
+            return False
+        sample = sample[:SAMPLE_SIZE]
+        return (
+            len(self._compress_bytes(sample)) <=
+            len(sample) * (1 - self._min_saving)
+        )
+
+    def _compress(self, data):
+        """Сжимает data, если это действительно экономит место."""
+        if not self._worth_compressing(data):
+            return None, data
+        compressed = self._compress_bytes(data)
+        if len(compressed) > len(data) * (1 - self._min_saving):
+            return None, data
+        return self._compression, compressed
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _reuse(self, digest):
+        """Проверяет, сохранён ли блоб. Существующий блоб помечается
+        как только что записанный, чтобы сборщик мусора не удалил его
+        до привязки к новому документу.
+        """
+        path = self._find(digest)[1]
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, data):
+        digest = self.digest(data)
+        if self._reuse(digest):
+            return digest
+
+        encoding, stored = self._compress(data)
+        path = self._path(digest)
+        self._write(f'{path}.{encoding}' if encoding else path, stored)
+        return digest
+
+    def put_file(self, source_path, sha256=None):
+        """Сохраняет файл с диска, не загружая его целиком в память.
+
+        Исходный файл перемещается в хранилище или удаляется. Если
+        задан sha256 и он не совпадает с содержимым, файл не
+        сохраняется и остаётся на месте (ValueError).
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        with open(source_path, 'rb') as f:
+            head = f.read(SAMPLE_SIZE)
+            hasher.update(head)
+            size += len(head)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                size += len(chunk)
+        digest = hasher.hexdigest()
+        if sha256 and digest != sha256:
+            raise ValueError('Checksum mismatch')
+
+        if self._reuse(digest):
+            os.remove(source_path)
+            return digest
+
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._worth_compressing(head):
+            fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+            compressor = CODECS[self._compression][0](self._level)
+            try:
+                with os.fdopen(fd, 'wb') as out, \
+                        open(source_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        out.write(compressor.compress(chunk))
+                    out.write(compressor.flush())
+                    out.flush()
+                    os.fsync(out.fileno())
+                if os.path.getsize(tmp_path) <= size * (1 - self._min_saving):
+                    os.replace(tmp_path, f'{path}.{self._compression}')
+                    os.remove(source_path)
+                    return digest
+                os.remove(tmp_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        os.close(fd)
+        shutil.move(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        return digest
+
+    def recompress(self, digest):
+        """Сжимает ранее сохранённый несжатый блоб.
+
+        Возвращает количество сэкономленных байт.
+        """
+        encoding, path = self._find(digest)
+        if encoding is not None or path is None:
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        encoding, stored = self._compress(data)
+        if encoding is None:
+            return 0
+        self._write(f'{path}.{encoding}', stored)
+        os.remove(path)
+        return len(data) - len(stored)
+
+    def open(self, digest):
+        encoding, path = self._find(digest)
+        if path is None:
+            raise ValueError('File not found')
+        raw = open(path, 'rb')
+        if encoding is None:
+            return raw
+        return CODECS[encoding][1](raw)
+
+    def read_stored(self, digest):
+        encoding, path = self._find(digest)
+        if path is None:
+            raise ValueError('File not found')
+        with open(path, 'rb') as f:
+            return encoding, f.read()
+
+    def stored_size(self, digest):
+        path = self._find(digest)[1]
+        return os.path.getsize(path) if path else 0
+
+    def exists(self, digest):
+        return self._find(digest)[1] is not None
+
+    def mtime(self, digest):
+        path = self._find(digest)[1]
+        try:
+            return os.path.getmtime(path) if path else None
+        except FileNotFoundError:
+            return None
+
+    def delete(self, digest):
+        deleted = False
+        while True:
+            path = self._find(digest)[1]
+            if path is None:
+                return deleted
+            os.remove(path)
+            deleted = True
+
+    def iter_digests(self):
+        for shard in sorted(os.listdir(self._root)):
+            shard_path = os.path.join(self._root, shard)
+            if shard == 'tmp' or not os.path.isdir(shard_path):
+                continue
+            for sub in sorted(os.listdir(shard_path)):
+                sub_path = os.path.join(shard_path, sub)
+                if not os.path.isdir(sub_path):
+                    continue
+                for name in os.listdir(sub_path):
+                    path = os.path.join(sub_path, name)
+                    yield name.split('.', 1)[0], os.path.getmtime(path)
+
+
+BACKENDS = {
+    'filesystem': lambda cfg: FilesystemBlobStore(
+        cfg.get('path', 'blobs'),
+        cfg.get('compression', 'auto'),
+        cfg.get('compression_level'),
+        cfg.get('compression_min_saving', 0.1)
+    ),
+}
+
+
+def create_blob_store(config):
+    """Создаёт хранилище по секции storage конфигурации.
+
+    Без секции storage документы остаются в bytea-колонках.
+    """
+    storage_config = config.get('storage') or {}
+    backend = storage_config.get('backend')
+    if not backend:
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    return BACKENDS[backend](storage_config)
+
+
+class BlobMigrator(threading.Thread):
+    """Фоновый перенос документов из bytea в хранилище блобов."""
+
+    BATCH_SIZE = 100
+
+    def __init__(self, db, blob_store, pause=0.05):
+        super().__init__(daemon=True, name='blob-migrator')
+        self._db = db
+        self._blob_store = blob_store
+        self._pause = pause
+        self._stop_event = threading.Event()
+        self.migrated = 0
+        self.migrated_bytes = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def migrate_one(self, kind, owner_id):
+        """Переносит один документ. Если у владельца уже есть документ
+        в хранилище (загружен заново во время переноса), он остаётся,
+        а устаревшая bytea-копия только обнуляется.
+        """
+        legacy = self._db.get_file(kind, owner_id)
+        if not legacy or not legacy.get('file'):
+            return False
+        if self._db.get_document(kind, owner_id):
+            self._db.clear_legacy_file(kind, owner_id)
+            return False
+
+        data = bytes(legacy['file'])
+        filename = legacy.get('filename') or 'document'
+        digest = self._blob_store.put(data)
+        attached = self._db.attach_legacy_document(
+            kind, owner_id, digest, len(data), filename,
+            FileHelper.detect_content_type(data, filename)
+        )
+        self._db.clear_legacy_file(kind, owner_id)
+        if not attached:
+            return False
+        self.migrated += 1
+        self.migrated_bytes += len(data)
+        return True
+
+    def run(self):
+        """Переносит документы порциями, пока get_legacy_documents
+        что-то возвращает. Когда переносить нечего, поток завершается
+        после одного запроса.
+        """
+        seen = set()
+        while not self._stop_event.is_set():
+            pending = [
+                (row['kind'], row['owner_id'])
+                for row in self._db.get_legacy_documents(self.BATCH_SIZE)
+            ]
+            if not pending or seen.issuperset(pending):
+                break
+            for kind, owner_id in pending:
+                if self._stop_event.is_set():
+                    break
+                if (kind, owner_id) in seen:
+                    continue
+                seen.add((kind, owner_id))
+                try:
+                    if self.migrate_one(kind, owner_id):
+                        self._stop_event.wait(self._pause)
+                except Exception as e:
+                    print(
+                        f'Blob migration failed for {kind}/{owner_id}: {e}'
+                    )
+
+
+def collect_garbage(db, blob_store, grace_period=3600, dry_run=False,
+                    uploads=None):
+    """Удаляет блобы, на которые не ссылается ни один документ и ни
+    одна завершённая загрузка (uploads — UploadManager).
+
+    Блобы моложе grace_period не трогаем: они могли быть записаны,
+    но ещё не привязаны к документу. Повторная запись того же
+    содержимого обновляет время записи блоба.
+    """
+    def referenced():
+        digests = {b['sha256'] for b in db.get_document_blobs()}
+        if uploads is not None:
+            digests |= uploads.pending_digests()
+        return digests
+
+    threshold = time.time() - grace_period
+    in_use = referenced()
+    candidates = [
+        digest for digest, mtime in blob_store.iter_digests()
+        if digest not in in_use and mtime <= threshold
+    ]
+    if not candidates:
+        return []
+
+    # Пока шёл обход, блоб мог быть загружен заново и привязан к
+    # документу: ссылки и время записи проверяются ещё раз
+    in_use = referenced()
+    removed = []
+    for digest in candidates:
+        mtime = blob_store.mtime(digest)
+        if digest in in_use or mtime is None or mtime > threshold:
+            continue
+        if not dry_run:
+            blob_store.delete(digest)
+        removed.append(digest)
+    return removed
+
+
+def compress_existing(db, blob_store):
+    """Разовое сжатие блобов, сохранённых до включения сжатия."""
+    saved = 0
+    compressed = 0
+    for blob in db.get_document_blobs():
+        blob_saved = blob_store.recompress(blob['sha256'])
+        if blob_saved:
+            compressed += 1
+            saved += blob_saved
+    return {'compressed': compressed, 'saved_bytes': saved}
+
+
+def storage_report(db, blob_store):
+    blobs = db.get_document_blobs()
+    original = sum(b['size'] for b in blobs)
+    stored = sum(blob_store.stored_size(b['sha256']) for b in blobs)
+    return {
+        'blobs': len(blobs),
+        'original_bytes': original,
+        'stored_bytes': stored,
+        'saved_bytes': original - stored,
+        'ratio': stored / original if original else 1.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Document blob store')
+    parser.add_argument(
+        'command', choices=['migrate', 'gc', 'compress', 'report']
+    )
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--grace', type=int, default=3600)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    blob_store = create_blob_store(config)
+    if blob_store is None:
+        print('Storage backend is not configured')
+        return
+
+    # Подключение к БД нужно только командам: само хранилище и сборка
+    # мусора работают с переданным объектом db
+    from database import Database
+
+    db = Database(args.config)
+    db.apply_migrations()
+    try:
+        if args.command == 'migrate':
+            migrator = BlobMigrator(db, blob_store, pause=0)
+            migrator.run()
+            print(
+                f'Migrated {migrator.migrated} documents, '
+                f'{migrator.migrated_bytes} bytes'
+            )
+        elif args.command == 'gc':
+            upload_config = config.get('uploads') or {}
+            uploads = UploadManager(
+                upload_config['path'], blob_store
+            ) if upload_config.get('path') else None
+            removed = collect_garbage(
+                db, blob_store, args.grace, args.dry_run, uploads
+            )
+            print(f'Unreferenced blobs removed: {len(removed)}')
+        elif args.command == 'compress':
+            result = compress_existing(db, blob_store)
+            print(
+                f'Compressed {result["compressed"]} blobs, '
+                f'saved {result["saved_bytes"]} bytes'
+            )
+
+        if args.command in ('migrate', 'compress', 'report'):
+            report = storage_report(db, blob_store)
+            print(
+                f'Blobs: {report["blobs"]}, '
+                f'original: {report["original_bytes"]} bytes, '
+                f'stored: {report["stored_bytes"]} bytes, '
+                f'saved: {report["saved_bytes"]} bytes '
+                f'({(1 - report["ratio"]) * 100:.1f}%)'
+            )
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
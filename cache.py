@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUByteCache:
+    """LRU-кэш с ограничением по суммарному размеру значений в байтах.
+
+    invalidate увеличивает поколение ключа. Значение, прочитанное до
+    инвалидации, put с прежним поколением уже не сохранит.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self._max_bytes = max_bytes
+        self._max_item_bytes = max_item_bytes or max_bytes
+        self._items = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self, key):
+        """Поколение ключа: берётся до чтения значения из источника."""
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def put(self, key, value, size, generation=None):
+        if size > self._max_item_bytes:
+            return False
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generations.get(key, 0):
+                return False
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self._max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            entry = self._items.pop(key, None)
+            if entry is None:
+                return False
+            self._size -= entry[1]
+            self.invalidations += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'bytes': self._size,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+def create_file_cache(config):
+    cache_config = config.get('cache') or {}
+    max_bytes = cache_config.get('file_max_bytes', 0)
+    if not max_bytes:
+        return None
+    return LRUByteCache(
+        max_bytes, cache_config.get('file_max_item_bytes')
+    )
@@ -23,6 +23,7 @@ def parse_args():
     parser.add_argument("--company-logo")
     parser.add_argument("--server-host")
     parser.add_argument("--server-port", type=int)
+    parser.add_argument("--storage-path")
     return parser.parse_args()
 
 def collect_inputs(args):
@@ -41,6 +42,13 @@ def collect_inputs(args):
         "company": {
             "name": args.company_name or prompt_input("Company Name", "MyCompany"),
             "logo": args.company_logo or prompt_input("Company Logo (URL or path)", "logo.png")
+        },
+        "storage": {
+            "backend": "filesystem",
+            "path": args.storage_path or prompt_input("Documents storage directory", "blobs"),
+            # Перенос bytea-документов — отдельной командой
+            # python blobstore.py migrate, а не при старте сервера
+            "migrate": False
         }
     }
     return config
@@ -88,6 +96,30 @@ def apply_sql_script(config, script_path="init_db.sql"):
         print(f"Error applying SQL script: {e}")
         sys.exit(1)
 
+def apply_migrations(config, directory="migrations"):
+    if not os.path.isdir(directory):
+        return
+    try:
+        conn = psycopg2.connect(
+            dbname=config["database"]["name"],
+            user=config["database"]["user"],
+            password=config["database"]["password"],
+            host=config["database"]["host"],
+            port=config["database"]["port"]
+        )
+        cur = conn.cursor()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".sql"):
+                with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                    cur.execute(f.read())
+        conn.commit()
+        cur.close()
+        conn.close()
+        print("Migrations applied successfully.")
+    except Exception as e:
+        print(f"Error applying migrations: {e}")
+        sys.exit(1)
+
 def save_config(config, path="config.yaml"):
     try:
         with open(path, "w", encoding="utf-8") as f:
@@ -103,6 +135,7 @@ def main():
 
     create_database(config)
     apply_sql_script(config)
+    apply_migrations(config)
     save_config(config)
 
 if __name__ == "__main__":
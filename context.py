@@ -0,0 +1,78 @@
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def current_context():
+    """Контекст запроса, обрабатываемого текущим потоком."""
+    return getattr(_local, 'context', None)
+
+
+class RequestContext:
+    """Данные одного HTTP-запроса: сессия, пользователь, адрес клиента
+    и замеры времени. Создаётся один раз при разборе запроса и явно
+    передаётся в RequestHandler и менеджеры.
+    """
+
+    __slots__ = (
+        'session_id', 'user', 'client_address', 'method', 'path',
+        'started_at', 'started', 'timings', 'route', 'status',
+        'bytes_in', 'bytes_out', 'error'
+    )
+
+    def __init__(self, session_id=None, user=None, client_address=None,
+                 method=None, path=None):
+        self.session_id = session_id
+        self.user = user
+        self.client_address = client_address
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.route = None
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Текст ошибки ответа для журнала запросов
+        self.error = None
+
+    @property
+    def authenticated(self):
+        return self.user is not None
+
+    @property
+    def admin(self):
+        return bool(self.user and self.user.get('admin'))
+
+    @property
+    def user_id(self):
+        return self.user.get('id') if self.user else None
+
+    @property
+    def username(self):
+        return self.user.get('username') if self.user else None
+
+    def activate(self):
+        _local.context = self
+
+    def deactivate(self):
+        if getattr(_local, 'context', None) is self:
+            _local.context = None
+
+    def add_timing(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, stage):
+        """Суммирует время этапа (db, serialize, write, ...)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - start)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
@@ -1,28 +1,124 @@
+import csv
+import decimal
+import functools
+import io
+import json
+import os
+import random
+import threading
+import time
 import yaml
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extras
 from psycopg2.extras import RealDictCursor
 
+from metrics import DB_DURATION, DB_ERRORS
+from context import current_context
+
+
+# Позиции параметров с секретами (хеши паролей, ключи сессий),
+# которые не попадают в лог медленных запросов и EXPLAIN
+SECRET_PARAMS = {
+    'authenticate_user': (1,),
+    'create_user': (1,),
+    'update_user_password': (1,),
+    'save_session': (0,),
+    'get_session_record': (0,),
+    'delete_sessions': (0,),
+}
+
+
 class Database:
     def __init__(self, config_path='config.yaml'):
         self._config = self._load_config(config_path)
         self._connection = None
+        # Соединение одно на процесс: запросы из потоков сервера
+        # выполняются по очереди.
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._slow_ms = self._config.get('slow_query_ms', 500)
+        self._slow_log = self._config.get('slow_query_log')
+        self._explain_rate = self._config.get('explain_sample_rate', 0)
+        self._explain_log = self._config.get(
+            'explain_log', 'logs/explain.log'
+        )
+        self._itersize = self._config.get('stream_itersize', 2000)
+        # Соединения потоковой выдачи переиспользуются: без пула каждый
+        # запрос списка платил бы за подключение и аутентификацию
+        self._pool_lock = threading.Lock()
+        self._stream_pool = []
+        self._stream_busy = 0
+        self._stream_pool_size = self._config.get('stream_pool_size', 4)
 
     def _load_config(self, config_path):
         with open(config_path, 'r', encoding='utf-8') as f:
             config = yaml.safe_load(f)
         return config['database']
 
+    def _connect(self):
+        conn = psycopg2.connect(
+            host=self._config['host'],
+            port=self._config['port'],
+            database=self._config['name'],
+            user=self._config['user'],
+            password=self._config['password']
+        )
+        # Числа в jsonb (образы строк функций *_audited) — Decimal,
+        # как и в обычных строках результата
+        psycopg2.extras.register_default_jsonb(
+            conn, loads=functools.partial(
+                json.loads, parse_float=decimal.Decimal
+            )
+        )
+        return conn
+
     def _get_connection(self):
         if self._connection is None or self._connection.closed:
-            self._connection = psycopg2.connect(
-                host=self._config['host'],
-                port=self._config['port'],
-                database=self._config['name'],
-                user=self._config['user'],
-                password=self._config['password']
-            )
+            self._connection = self._connect()
         return self._connection
 
+    def _acquire_stream_connection(self):
+        with self._pool_lock:
+            self._stream_busy += 1
+            while self._stream_pool:
+                conn = self._stream_pool.pop()
+                if not conn.closed:
+                    return conn
+        try:
+            return self._connect()
+        except Exception:
+            with self._pool_lock:
+                self._stream_busy -= 1
+            raise
+
+    def _release_stream_connection(self, conn):
+        """Возвращает соединение в пул; незавершённая транзакция
+        (клиент отключился посреди ответа) откатывается.
+        """
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        with self._pool_lock:
+            self._stream_busy -= 1
+            if not conn.closed and \
+                    len(self._stream_pool) < self._stream_pool_size:
+                self._stream_pool.append(conn)
+                return
+        conn.close()
+
+    def connection_count(self):
+        with self._pool_lock:
+            return int(self.is_connected()) + \
+                len(self._stream_pool) + self._stream_busy
+
+    def _commit(self, conn):
+        """Фиксирует вызов, если он не идёт внутри transaction()."""
+        if not getattr(self._local, 'transaction', False):
+            conn.commit()
+
     def _rollback(self):
         """Откатывает транзакцию при ошибке."""
         try:
@@ -31,50 +127,335 @@ class Database:
         except Exception:
             pass
 
-    def call_function(self, func_name, params=None, fetch=False):
-        conn = self._get_connection()
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                if params:
-                    placeholders = ', '.join(['%s'] * len(params))
+    # ==================== TRACING ====================
+    @staticmethod
+    def _sanitize(params, func_name=None):
+        """Параметры для лога: секреты, двоичные данные и длинные
+        строки заменяются описанием.
+        """
+        secrets = SECRET_PARAMS.get(func_name, ())
+        result = []
+        for position, value in enumerate(params or ()):
+            if position in secrets:
+                value = '<redacted>'
+            elif isinstance(value, psycopg2.Binary):
+                value = f'<binary {len(value.adapted)} bytes>'
+            elif isinstance(value, (bytes, bytearray, memoryview)):
+                value = f'<{len(value)} bytes>'
+            elif isinstance(value, str) and len(value) > 200:
+                value = value[:200] + f'... <{len(value)} chars>'
+            elif isinstance(value, (list, tuple)) and len(value) > 20:
+                value = list(value[:20]) + [f'... <{len(value)} items>']
+            result.append(value)
+        return result
+
+    @staticmethod
+    def _write_log(path, line):
+        """Дописывает строку в журнал; без пути журнал отключён."""
+        if not path:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def _observe(self, func_name, params, elapsed, rows, select,
+                 explain=True):
+        DB_DURATION.observe(elapsed, func_name)
+        context = current_context()
+        if context is not None:
+            context.add_timing('db', elapsed)
+
+        if rows is None or elapsed * 1000 < self._slow_ms:
+            return
+        self._write_log(self._slow_log, json.dumps({
+            'ts': time.time(),
+            'function': func_name,
+            'ms': round(elapsed * 1000, 3),
+            'rows': rows,
+            'params': self._sanitize(params, func_name),
+            'route': context.route if context is not None else None
+        }, ensure_ascii=False, default=str))
+
+        # Откат после EXPLAIN отменил бы открытую transaction()
+        if explain and self._explain_rate and \
+                not getattr(self._local, 'transaction', False) and \
+                random.random() < self._explain_rate:
+            self._explain(func_name, params, select)
+
+    def _explain(self, func_name, params, select):
+        """EXPLAIN ANALYZE выполняет функцию повторно, поэтому план
+        снимается в транзакции, которая затем откатывается.
+        """
+        placeholders = ', '.join(['%s'] * len(params or ()))
+        query = (
+            f"SELECT * FROM {func_name}({placeholders})" if select
+            else f"SELECT {func_name}({placeholders})"
+        )
+        # Потоковые вызовы приходят сюда без блокировки: EXPLAIN и
+        # откат на общем соединении не должны попасть в чужую транзакцию
+        with self._lock:
+            conn = self._get_connection()
+            try:
+                with conn.cursor() as cur:
                     cur.execute(
-                        f"SELECT * FROM {func_name}({placeholders})",
-                        params
+                        f"EXPLAIN (ANALYZE, BUFFERS) {query}",
+                        params or None
                     )
-                else:
-                    cur.execute(f"SELECT * FROM {func_name}()")
+                    plan = '\n'.join(row[0] for row in cur.fetchall())
+            except psycopg2.Error as e:
+                plan = f'EXPLAIN failed: {e}'
+            finally:
+                self._rollback()
+        self._write_log(
+            self._explain_log,
+            f'-- {time.strftime("%Y-%m-%d %H:%M:%S")} {func_name} '
+            f'{self._sanitize(params, func_name)}\n{plan}\n'
+        )
 
-                if fetch:
-                    result = cur.fetchall()
-                    conn.commit()
-                    return result
-                conn.commit()
-        except psycopg2.Error as e:
-            self._rollback()
-            raise e
+    def call_function(self, func_name, params=None, fetch=False):
+        with self._lock:
+            conn = self._get_connection()
+            start = time.perf_counter()
+            rows = None
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    if params:
+                        placeholders = ', '.join(['%s'] * len(params))
+                        cur.execute(
+                            f"SELECT * FROM {func_name}({placeholders})",
+                            params
+                        )
+                    else:
+                        cur.execute(f"SELECT * FROM {func_name}()")
+
+                    if fetch:
+                        result = cur.fetchall()
+                        self._commit(conn)
+                        rows = len(result)
+                        return result
+                    self._commit(conn)
+                    rows = cur.rowcount
+            except psycopg2.Error as e:
+                DB_ERRORS.inc(func_name)
+                self._rollback()
+                raise e
+            finally:
+                self._observe(
+                    func_name, params, time.perf_counter() - start,
+                    rows, True
+                )
+
+    def call_function_for_ids(self, func_name, ids, key):
+        """Функция от массива id (migrations/010) одним запросом:
+        {id: [строки]} в порядке ids; key — колонка строки с id.
+        """
+        ids = list(dict.fromkeys(ids))
+        result = {lookup_id: [] for lookup_id in ids}
+        if ids:
+            for row in self.call_function(func_name, (ids,), fetch=True):
+                result[row[key]].append(row)
+        return result
 
     def call_function_scalar(self, func_name, params=None):
-        conn = self._get_connection()
+        with self._lock:
+            conn = self._get_connection()
+            start = time.perf_counter()
+            rows = None
+            try:
+                with conn.cursor() as cur:
+                    if params:
+                        placeholders = ', '.join(['%s'] * len(params))
+                        cur.execute(
+                            f"SELECT {func_name}({placeholders})",
+                            params
+                        )
+                    else:
+                        cur.execute(f"SELECT {func_name}()")
+                    result = cur.fetchone()
+                    self._commit(conn)
+                    rows = 1 if result else 0
+                    return result[0] if result else None
+            except psycopg2.Error as e:
+                DB_ERRORS.inc(func_name)
+                self._rollback()
+                raise e
+            finally:
+                self._observe(
+                    func_name, params, time.perf_counter() - start,
+                    rows, False
+                )
+
+    def stream_function(self, func_name, params=None):
+        """Строки функции порциями по stream_itersize через именованный
+        (серверный) курсор.
+
+        Курсор живёт, пока ответ отправляется клиенту, поэтому он
+        открывается на соединении из пула и не занимает общее.
+        Внутри batch() используется общее соединение.
+        """
+        shared = getattr(self._local, 'batch', False)
+        conn = self._get_connection() if shared \
+            else self._acquire_stream_connection()
+        elapsed = 0.0
+        rows = None
         try:
-            with conn.cursor() as cur:
-                if params:
-                    placeholders = ', '.join(['%s'] * len(params))
+            start = time.perf_counter()
+            with conn.cursor(name=f'stream_{func_name}',
+                             cursor_factory=RealDictCursor) as cur:
+                cur.itersize = self._itersize
+                placeholders = ', '.join(['%s'] * len(params or ()))
+                cur.execute(
+                    f"SELECT * FROM {func_name}({placeholders})",
+                    params or None
+                )
+                rows = 0
+                while True:
+                    batch = cur.fetchmany(self._itersize)
+                    elapsed += time.perf_counter() - start
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    yield batch
+                    start = time.perf_counter()
+            conn.commit()
+        except psycopg2.Error as e:
+            DB_ERRORS.inc(func_name)
+            if shared:
+                self._rollback()
+            raise e
+        finally:
+            if not shared:
+                self._release_stream_connection(conn)
+            self._observe(func_name, params, elapsed, rows, True)
+
+    @contextmanager
+    def batch(self):
+        """Все вызовы внутри блока идут подряд через общее соединение,
+        без чередования с запросами других потоков.
+        """
+        with self._lock:
+            nested = getattr(self._local, 'batch', False)
+            self._local.batch = True
+            try:
+                yield self
+            finally:
+                self._local.batch = nested
+
+    @contextmanager
+    def transaction(self):
+        """Вызовы call_function* внутри блока — одна транзакция
+        общего соединения: фиксируется в конце блока, откатывается
+        при любом исключении. Вложенный блок входит во внешний.
+        """
+        with self._lock:
+            if getattr(self._local, 'transaction', False):
+                yield self
+                return
+            self._local.transaction = True
+            try:
+                yield self
+                self._get_connection().commit()
+            except BaseException:
+                self._rollback()
+                raise
+            finally:
+                self._local.transaction = False
+
+    def copy_rows(self, table, columns, rows):
+        """Загружает строки (кортежи) в таблицу одной командой COPY.
+        None и пустые строки записываются как NULL.
+        """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with self._lock:
+            conn = self._get_connection()
+            start = time.perf_counter()
+            count = None
+            try:
+                with conn.cursor() as cur:
+                    cur.copy_expert(
+                        f"COPY {table} ({', '.join(columns)}) "
+                        f"FROM STDIN WITH (FORMAT csv)",
+                        buffer
+                    )
+                    count = cur.rowcount
+                conn.commit()
+                return count
+            except psycopg2.Error as e:
+                DB_ERRORS.inc(f'COPY {table}')
+                self._rollback()
+                raise e
+            finally:
+                self._observe(
+                    f'COPY {table}', None, time.perf_counter() - start,
+                    count, False, explain=False
+                )
+
+    def apply_migrations(self, directory='migrations'):
+        """Выполняет файлы migrations/*.sql по порядку имён, каждый
+        один раз: выполненные отмечаются в schema_migrations в той же
+        транзакции. Изменения схемы добавляются новыми файлами.
+        Экземпляры, запущенные одновременно, ждут друг друга на
+        advisory-блокировке.
+        """
+        if not os.path.isdir(directory):
+            return
+        with self._lock:
+            conn = self._get_connection()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT pg_advisory_lock("
+                        "hashtext('schema_migrations'))"
+                    )
                     cur.execute(
-                        f"SELECT {func_name}({placeholders})",
-                        params
+                        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                        "name VARCHAR(255) PRIMARY KEY, "
+                        "applied_at TIMESTAMP NOT NULL DEFAULT now())"
                     )
-                else:
-                    cur.execute(f"SELECT {func_name}()")
-                result = cur.fetchone()
+                    cur.execute("SELECT name FROM schema_migrations")
+                    applied = {row[0] for row in cur.fetchall()}
                 conn.commit()
-                return result[0] if result else None
-        except psycopg2.Error as e:
-            self._rollback()
-            raise e
+                for name in sorted(os.listdir(directory)):
+                    if not name.endswith('.sql') or name in applied:
+                        continue
+                    with open(os.path.join(directory, name), 'r',
+                              encoding='utf-8') as f:
+                        sql = f.read()
+                    with conn.cursor() as cur:
+                        cur.execute(sql)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (name) "
+                            "VALUES (%s)", (name,)
+                        )
+                    conn.commit()
+            except psycopg2.Error as e:
+                self._rollback()
+                raise e
+            finally:
+                # Блокировка сессии снимается и при закрытии соединения
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "SELECT pg_advisory_unlock("
+                            "hashtext('schema_migrations'))"
+                        )
+                    conn.commit()
+                except psycopg2.Error:
+                    self._rollback()
+
+    def is_connected(self):
+        return self._connection is not None and not self._connection.closed
 
     def close(self):
         if self._connection and not self._connection.closed:
             self._connection.close()
+        with self._pool_lock:
+            pool, self._stream_pool = self._stream_pool, []
+        for conn in pool:
+            conn.close()
 
     def test_connection(self):
         conn = self._get_connection()
@@ -89,6 +470,9 @@ class Database:
     def get_all_objects(self):
         return self.call_function('get_all_objects', fetch=True)
 
+    def stream_all_objects(self):
+        return self.stream_function('get_all_objects')
+
     def get_object_by_id(self, object_id):
         result = self.call_function(
             'get_object_by_id', (object_id,), fetch=True
@@ -123,6 +507,22 @@ class Database:
             'writeoffs': self.get_writeoffs_by_object(object_id)
         }
 
+    def get_object_details_bulk(self, object_ids):
+        """{id: {'receipts': [...], 'writeoffs': [...]}} за два запроса."""
+        receipts = self.call_function_for_ids(
+            'get_receipts_by_objects', object_ids, 'object_id'
+        )
+        writeoffs = self.call_function_for_ids(
+            'get_writeoffs_by_objects', object_ids, 'object_id'
+        )
+        return {
+            object_id: {
+                'receipts': receipts[object_id],
+                'writeoffs': writeoffs[object_id]
+            }
+            for object_id in receipts
+        }
+
     def get_all_sellers(self):
         return self.call_function('get_all_sellers', fetch=True)
 
@@ -147,6 +547,56 @@ class Database:
         )
         return result[0] if result else None
 
+    def clear_legacy_file(self, file_type, file_id):
+        return self.call_function_scalar(
+            'clear_legacy_file', (file_type, file_id)
+        )
+
+    # Document methods
+    def attach_document(self, kind, owner_id, sha256, size,
+                        filename, content_type,
+                        uploader_id=None, uploader=None):
+        return self.call_function_scalar(
+            'attach_document',
+            (kind, owner_id, sha256, size, filename, content_type,
+             uploader_id, uploader)
+        )
+
+    def attach_legacy_document(self, kind, owner_id, sha256, size,
+                               filename, content_type):
+        return self.call_function_scalar(
+            'attach_legacy_document',
+            (kind, owner_id, sha256, size, filename, content_type)
+        )
+
+    def get_legacy_documents(self, limit):
+        return self.call_function(
+            'get_legacy_documents', (limit,), fetch=True
+        )
+
+    def detach_document(self, kind, owner_id):
+        return self.call_function_scalar(
+            'detach_document', (kind, owner_id)
+        )
+
+    def get_document(self, kind, owner_id):
+        result = self.call_function(
+            'get_document', (kind, owner_id), fetch=True
+        )
+        return result[0] if result else None
+
+    def get_documents_by_keys(self, keys):
+        if not keys:
+            return []
+        kinds, owner_ids = zip(*keys)
+        return self.call_function(
+            'get_documents_by_keys', (list(kinds), list(owner_ids)),
+            fetch=True
+        )
+
+    def get_document_blobs(self):
+        return self.call_function('get_document_blobs', fetch=True)
+
     # Search methods
     def search_objects_by_name(self, search_text):
         return self.call_function(
@@ -182,6 +632,12 @@ class Database:
         )
         return result[0] if result else None
 
+    def get_user_credentials(self, username):
+        result = self.call_function(
+            'get_user_credentials', (username,), fetch=True
+        )
+        return result[0] if result else None
+
     def get_all_users(self):
         return self.call_function('get_all_users', fetch=True)
 
@@ -191,16 +647,62 @@ class Database:
         )
         return result[0] if result else None
 
+    # Session methods
+    def save_session(self, key, user_data, created_at, expires_at):
+        self.call_function_scalar(
+            'save_session', (key, user_data, created_at, expires_at)
+        )
+
+    def get_session_record(self, key):
+        result = self.call_function(
+            'get_session_record', (key,), fetch=True
+        )
+        return result[0] if result else None
+
+    def load_sessions(self):
+        return self.call_function('load_sessions', fetch=True)
+
+    def delete_sessions(self, keys):
+        return self.call_function_scalar('delete_sessions', (keys,))
+
+    def delete_user_sessions(self, user_id):
+        return self.call_function_scalar(
+            'delete_user_sessions', (user_id,)
+        )
+
+    def delete_expired_sessions(self):
+        return self.call_function_scalar('delete_expired_sessions')
+
+    def deny_session_token(self, token_id, user_id, revoked_at, expires_at):
+        self.call_function_scalar(
+            'deny_session_token',
+            (token_id, user_id, revoked_at, expires_at)
+        )
+
+    def get_session_denylist(self):
+        return self.call_function('get_session_denylist', fetch=True)
+
     # Pricing methods
     def get_all_pricing(self):
         return self.call_function('get_all_pricing', fetch=True)
 
+    def stream_all_pricing(self):
+        return self.stream_function('get_all_pricing')
+
     def get_pricing_by_id(self, pricing_id):
         result = self.call_function(
             'get_pricing_by_id', (pricing_id,), fetch=True
         )
         return result[0] if result else None
 
+    def get_pricing_by_receipts(self, receipt_ids):
+        return {
+            receipt_id: rows[0] if rows else None
+            for receipt_id, rows in self.call_function_for_ids(
+                'get_pricing_by_receipts', receipt_ids, 'receipt_id'
+            ).items()
+        }
+
     def get_pricing_by_receipt(self, receipt_id):
         result = self.call_function(
             'get_pricing_by_receipt', (receipt_id,), fetch=True
@@ -222,6 +724,9 @@ class Database:
             'get_all_logs', (limit, offset), fetch=True
         )
 
+    def stream_all_logs(self, limit=500, offset=0):
+        return self.stream_function('get_all_logs', (limit, offset))
+
     def get_logs_count(self):
         return self.call_function_scalar('get_logs_count')
 
@@ -235,4 +740,14 @@ class Database:
         return self.call_function('get_objects_in_stock', fetch=True)
 
     def get_objects_written_off(self):
-        return self.call_function('get_objects_written_off', fetch=True)
\ No newline at end of file
+        return self.call_function('get_objects_written_off', fetch=True)
+
+    # Import methods
+    def copy_import_rows(self, columns, rows):
+        return self.copy_rows('import_rows', columns, rows)
+
+    def import_receipts(self, import_id):
+        return self.call_function_scalar('import_receipts', (import_id,))
+
+    def import_cleanup(self, import_id):
+        return self.call_function_scalar('import_cleanup', (import_id,))
@@ -1,21 +1,49 @@
+import datetime
+import io
 import json
 import re
 from urllib.parse import quote
-from auth import SessionManager
+from archive import safe_name
+from passwords import PasswordHasher
+
+# НДС цены по умолчанию, %: форма, API и импорт поступлений
+DEFAULT_TAX = 20
+
+
+def _patch_text(value):
+    return value or None
+
+
+def _patch_date(value):
+    """Дата YYYY-MM-DD для PATCH; пустая строка — без даты."""
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f'Неверная дата: {value}')
+
 
 class RequestHandler:
     def __init__(self, db, manager, user_manager,
-                 session_manager, pricing_manager=None):
+                 session_manager, pricing_manager=None,
+                 blob_store=None, file_cache=None, uploads=None,
+                 password_hasher=None, importer=None):
         self.db = db
         self.manager = manager
         self.user_manager = user_manager
         self.session_manager = session_manager
         self.pricing_manager = pricing_manager
+        self.blob_store = blob_store
+        self.file_cache = file_cache
+        self.uploads = uploads
+        self.password_hasher = password_hasher or PasswordHasher()
+        self.importer = importer
 
     # ==================== LOGGING ====================
-    def _log(self, session_id, action, entity_type,
+    def _log(self, context, action, entity_type,
              entity_id, entity_name, details=None):
-        user = self.session_manager.get_session(session_id)
+        user = context.user if context else None
         if user:
             self.db.add_log(
                 user['id'], user['username'], action,
@@ -23,8 +51,8 @@ class RequestHandler:
             )
 
     def get_logs(self, limit=500, offset=0):
-        logs = self.db.get_all_logs(limit, offset)
-        return [dict(l) for l in logs]
+        # Порции строк с серверного курсора, см. Database.stream_function
+        return self.db.stream_all_logs(limit, offset)
 
     def get_logs_count(self):
         return self.db.get_logs_count()
@@ -35,35 +63,38 @@ class RequestHandler:
 
     # ==================== AUTH ====================
     def login(self, username, password):
-        password_hash = SessionManager.hash_password(password)
-        user = self.db.authenticate_user(username, password_hash)
+        credentials = self.db.get_user_credentials(username)
+        stored_hash = credentials['password_hash'] if credentials else None
 
-        if not user:
+        if not self.password_hasher.verify(password, stored_hash):
             raise ValueError(
                 'Неверное имя пользователя или пароль'
             )
 
-        session_id = self.session_manager.create_session(
-            dict(user)
-        )
+        if self.password_hasher.needs_rehash(stored_hash):
+            self.user_manager.update_user_password(
+                credentials['id'], self.password_hasher.hash(password)
+            )
+
+        user = {
+            'id': credentials['id'],
+            'username': credentials['username'],
+            'admin': credentials['admin']
+        }
+        session_id = self.session_manager.create_session(user)
         return {
             'success': True,
             'session_id': session_id,
-            'user': {
-                'id': user['id'],
-                'username': user['username'],
-                'admin': user['admin']
-            }
+            'user': user
         }
 
-    def logout(self, session_id):
-        self.session_manager.delete_session(session_id)
+    def logout(self, context):
+        self.session_manager.delete_session(context.session_id)
         return {'success': True}
 
-    def get_current_user(self, session_id):
-        user = self.session_manager.get_session(session_id)
-        if user:
-            return {'authenticated': True, 'user': user}
+    def get_current_user(self, context):
+        if context.user:
+            return {'authenticated': True, 'user': context.user}
         return {'authenticated': False}
 
     # ==================== USER MANAGEMENT ====================
@@ -85,7 +116,7 @@ class RequestHandler:
         if not username or not password:
             raise ValueError('Заполните все поля')
 
-        password_hash = SessionManager.hash_password(password)
+        password_hash = self.password_hasher.hash(password)
         result = self.user_manager.create_user(
             username, password_hash, admin
         )
@@ -95,67 +126,168 @@ class RequestHandler:
             'message': f'Пользователь "{username}" успешно создан'
         }
 
-    def update_user(self, fields, session_id=None):
-        user_id = int(fields.get('id'))
-        username = fields.get('username')
-        admin = fields.get('admin', '').lower() == 'true'
+    # ==================== GET HANDLERS ====================
+    def get_objects(self):
+        self.db.update_storage_stats()
+        return self.db.stream_all_objects()
 
-        self.user_manager.update_user(user_id, username, admin)
+    def get_object(self, object_id):
+        obj = self.db.get_object_by_id(object_id)
+        if obj:
+            return dict(obj)
+        raise ValueError('Object not found')
 
-        password = fields.get('password', '').strip()
-        if password:
-            password_hash = SessionManager.hash_password(password)
-            self.user_manager.update_user_password(
-                user_id, password_hash
-            )
+    # ==================== UPLOADS ====================
+    def _require_uploads(self):
+        if self.uploads is None:
+            raise ValueError('Загрузка по частям отключена')
+
+    def create_upload(self, fields, context):
+        self._require_uploads()
+        return self.uploads.create(
+            context.user,
+            fields.get('filename'),
+            int(fields.get('size', 0)),
+            fields.get('sha256')
+        )
 
-        if session_id:
-            self._log(
-                session_id, 'Редактирование', 'Пользователь',
-                user_id, username, None
-            )
+    def upload_chunk(self, upload_id, index, data, checksum,
+                     context):
+        self._require_uploads()
+        return self.uploads.put_chunk(
+            context.user,
+            upload_id, index, data, checksum
+        )
 
-        return {
-            'success': True,
-            'message': f'Пользователь "{username}" успешно обновлён'
-        }
+    def get_upload(self, upload_id, context):
+        self._require_uploads()
+        return self.uploads.status(
+            context.user, upload_id
+        )
 
-    def delete_user(self, user_id, session_id=None):
-        user = self.db.get_user_by_id(user_id)
-        user_name = user['username'] if user else str(user_id)
+    def finalize_upload(self, upload_id, context):
+        self._require_uploads()
+        return self.uploads.finalize(
+            context.user, upload_id
+        )
 
-        self.user_manager.delete_user(user_id)
+    def abort_upload(self, upload_id, context):
+        self._require_uploads()
+        self.uploads.abort(
+            context.user, upload_id
+        )
+        return {'success': True}
 
-        if session_id:
-            self._log(
-                session_id, 'Удаление', 'Пользователь',
-                user_id, user_name, None
-            )
+    # ==================== IMPORT ====================
+    def _require_importer(self):
+        if self.importer is None:
+            raise ValueError('Импорт отключён')
+
+    def start_import(self, fields, files, context):
+        self._require_importer()
+        file_info = (files or {}).get('file', {})
+        return self.importer.start(
+            context.user, file_info.get('data'),
+            file_info.get('filename') or '',
+            str(fields.get('dryRun', '')).lower() == 'true'
+        )
 
+    def get_import(self, import_id, context):
+        self._require_importer()
+        return self.importer.status(context.user, import_id)
+
+    def get_import_report(self, import_id, context):
+        self._require_importer()
+        return self.importer.report(context.user, import_id)
+
+    def _file_info(self, files, fields, file_field, document_field,
+                   context):
+        """Файл из multipart-запроса или завершённой загрузки по частям."""
+        document_id = fields.get(document_field)
+        if not document_id:
+            return files.get(file_field, {})
+        self._require_uploads()
+        document = self.uploads.resolve(
+            (context.user if context else None) or {}, document_id
+        )
         return {
-            'success': True,
-            'message': 'Пользователь успешно удалён'
+            'data': document,
+            'filename': document.filename,
+            'document_id': document_id
         }
 
-    # ==================== GET HANDLERS ====================
-    def get_objects(self):
-        self.db.update_storage_stats()
-        objects = self.db.get_all_objects()
-        return [dict(obj) for obj in objects]
+    def _release_uploads(self, *file_infos):
+        for info in file_infos:
+            if info.get('document_id'):
+                self.uploads.release(info['document_id'])
 
-    def get_object(self, object_id):
-        obj = self.db.get_object_by_id(object_id)
-        if obj:
-            return dict(obj)
-        raise ValueError('Object not found')
+    # ==================== DOCUMENT CATALOG ====================
+    @staticmethod
+    def _document_meta(document):
+        return {
+            'id': document['id'],
+            'filename': document['filename'],
+            'size': document['size'],
+            'content_type': document['content_type'],
+            'uploaded_at': document['uploaded_at'],
+            'uploader': document['uploader']
+        }
+
+    def _attach_documents(self, receipts=(), writeoffs=()):
+        """Добавляет к строкам метаданные документов из каталога."""
+        if self.blob_store is None:
+            return
+
+        keys = []
+        for r in receipts:
+            for kind, key in FileHelper.RECEIPT_DOCUMENTS:
+                if r.get(key):
+                    keys.append((kind, r[key]))
+        for w in writeoffs:
+            keys.append(('writeoff', w['id']))
+
+        catalog = {
+            (d['kind'], d['owner_id']): self._document_meta(d)
+            for d in self.db.get_documents_by_keys(keys)
+        }
+
+        for r in receipts:
+            for kind, key in FileHelper.RECEIPT_DOCUMENTS:
+                r[f'{kind}_document'] = catalog.get((kind, r.get(key)))
+        for w in writeoffs:
+            document = catalog.get(('writeoff', w['id']))
+            w['document'] = document
+            if document:
+                w['has_document'] = True
+                w['document_filename'] = document['filename']
 
     def get_object_details(self, object_id):
         details = self.db.get_object_details(object_id)
+        receipts = [dict(r) for r in details['receipts']]
+        writeoffs = [dict(w) for w in details['writeoffs']]
+        self._attach_documents(receipts, writeoffs)
         return {
-            'receipts': [dict(r) for r in details['receipts']],
-            'writeoffs': [dict(w) for w in details['writeoffs']]
+            'receipts': receipts,
+            'writeoffs': writeoffs
         }
 
+    def get_object_details_bulk(self, object_ids):
+        details = {}
+        all_receipts, all_writeoffs = [], []
+        for object_id, rows in self.db.get_object_details_bulk(
+                object_ids).items():
+            receipts = [dict(r) for r in rows['receipts']]
+            writeoffs = [dict(w) for w in rows['writeoffs']]
+            all_receipts.extend(receipts)
+            all_writeoffs.extend(writeoffs)
+            details[object_id] = {
+                'receipts': receipts,
+                'writeoffs': writeoffs
+            }
+        # Каталог документов — одним запросом на все объекты
+        self._attach_documents(all_receipts, all_writeoffs)
+        return details
+
     def get_sellers(self):
         sellers = self.db.get_all_sellers()
         return [dict(s) for s in sellers]
@@ -179,20 +311,166 @@ class RequestHandler:
     def get_receipt(self, receipt_id):
         receipt = self.db.get_receipt_by_id(receipt_id)
         if receipt:
-            return dict(receipt)
+            receipt = dict(receipt)
+            self._attach_documents(receipts=[receipt])
+            return receipt
         raise ValueError('Receipt not found')
 
     def get_writeoff(self, writeoff_id):
         writeoff = self.db.get_writeoff_by_id(writeoff_id)
         if writeoff:
-            return dict(writeoff)
+            writeoff = dict(writeoff)
+            self._attach_documents(writeoffs=[writeoff])
+            return writeoff
         raise ValueError('Writeoff not found')
 
-    def get_file(self, file_type, file_id):
+    def get_file(self, file_type, file_id, accept_encodings=()):
+        result = None
+        generation = None
+        if self.file_cache is not None:
+            result = self.file_cache.get((file_type, file_id))
+            generation = self.file_cache.generation((file_type, file_id))
+
+        if result is None:
+            result = dict(self._load_file(file_type, file_id))
+            result['file'] = bytes(result['file'])
+            if self.file_cache is not None:
+                self.file_cache.put(
+                    (file_type, file_id), result, len(result['file']),
+                    generation
+                )
+
+        # Сжатый документ отдаём как есть, если клиент это принимает
+        encoding = result.get('content_encoding')
+        if encoding and encoding not in accept_encodings:
+            result = dict(
+                result,
+                file=self.blob_store.decompress(encoding, result['file']),
+                content_encoding=None
+            )
+        return result
+
+    def _invalidate_files(self, keys):
+        if self.file_cache is None:
+            return
+        for key in keys:
+            self.file_cache.invalidate(key)
+
+    def _receipt_file_keys(self, receipt):
+        if not receipt:
+            return []
+        return [
+            (kind, receipt[key])
+            for kind, key in FileHelper.RECEIPT_DOCUMENTS
+            if receipt.get(key)
+        ]
+
+    def _load_file(self, file_type, file_id):
+        if self.blob_store is not None:
+            document = self.db.get_document(file_type, file_id)
+            if document:
+                encoding, data = self.blob_store.read_stored(
+                    document['sha256']
+                )
+                return {
+                    'file': data,
+                    'filename': document['filename'],
+                    'content_type': document['content_type'],
+                    'content_encoding': encoding
+                }
+
         result = self.db.get_file(file_type, file_id)
         if not result or not result.get('file'):
             raise ValueError('File not found')
         return result
+
+    # ==================== ARCHIVES ====================
+    DOCUMENT_LABELS = {
+        'bill': 'Счёт',
+        'invoice': 'Накладная',
+        'entry_control': 'Вх.контроль',
+        'writeoff': 'Списание'
+    }
+
+    def get_documents_archive(self, object_ids):
+        """Возвращает имя архива и ленивый итератор его записей."""
+        objects = []
+        for object_id in object_ids:
+            obj = self.db.get_object_by_id(object_id)
+            if not obj:
+                raise ValueError('Object not found')
+            objects.append(obj)
+
+        if len(objects) == 1:
+            archive_name = f'{safe_name(objects[0]["objectname"])}.zip'
+        else:
+            archive_name = 'documents.zip'
+        return archive_name, self._iter_archive_entries(objects)
+
+    def _iter_archive_entries(self, objects):
+        for obj in objects:
+            folder = safe_name(obj['objectname'])
+            details = self.db.get_object_details(obj['id'])
+
+            documents = []
+            for r in details['receipts']:
+                for kind, key in FileHelper.RECEIPT_DOCUMENTS:
+                    if r.get(key):
+                        documents.append(
+                            (kind, r[key], r.get(f'{kind}_number'))
+                        )
+            for w in details['writeoffs']:
+                documents.append(('writeoff', w['id'], w.get('writeoff_date')))
+
+            catalog = {}
+            if self.blob_store is not None:
+                catalog = {
+                    (d['kind'], d['owner_id']): d
+                    for d in self.db.get_documents_by_keys(
+                        [(kind, owner_id) for kind, owner_id, _ in documents]
+                    )
+                }
+
+            for kind, owner_id, number in documents:
+                entry = self._open_archive_entry(
+                    kind, owner_id, catalog.get((kind, owner_id))
+                )
+                if entry is None:
+                    continue
+                filename, content_type, size, fileobj = entry
+                label = self.DOCUMENT_LABELS[kind]
+                if number:
+                    label = f'{label} {safe_name(number)}'
+                yield (
+                    f'{folder}/{label} - {safe_name(filename)}',
+                    content_type, size, fileobj
+                )
+
+    def _open_archive_entry(self, kind, owner_id, document):
+        if document is not None:
+            return (
+                document['filename'] or 'document',
+                document['content_type'],
+                document['size'],
+                self.blob_store.open(document['sha256'])
+            )
+
+        result = self.db.get_file(kind, owner_id)
+        if not result or not result.get('file'):
+            return None
+        data = bytes(result['file'])
+        filename = result.get('filename') or 'document'
+        return (
+            filename,
+            FileHelper.detect_content_type(data, filename),
+            len(data),
+            io.BytesIO(data)
+        )
+
+    def get_file_cache_stats(self):
+        if self.file_cache is None:
+            return {'enabled': False}
+        return dict(self.file_cache.stats(), enabled=True)
     
     def get_objects_filtered(self, filter_type):
         self.db.update_storage_stats()
@@ -266,7 +544,7 @@ class RequestHandler:
             'message': f'Тема "{name}" успешно создана'
         }
 
-    def create_receipt(self, fields, files):
+    def create_receipt(self, fields, files, context=None):
         seller_id = fields.get('sellerId')
         if fields.get('newSellerName'):
             result = self.manager.create_seller(
@@ -290,32 +568,43 @@ class RequestHandler:
             )
             object_id = result['id']
 
-        bill_file_info = files.get('billFile', {})
+        bill_file_info = self._file_info(
+            files, fields, 'billFile', 'billDocumentId', context
+        )
+        invoice_file_info = self._file_info(
+            files, fields, 'invoiceFile', 'invoiceDocumentId', context
+        )
+        ec_file_info = self._file_info(
+            files, fields, 'entryControlFile', 'entryControlDocumentId',
+            context
+        )
+
         bill_result = self.manager.create_bill(
             fields.get('billNumber', ''),
             fields.get('billDate'),
             seller_id,
             bill_file_info.get('data'),
-            bill_file_info.get('filename')
+            bill_file_info.get('filename'),
+            context
         )
         bill_id = bill_result['id']
 
-        invoice_file_info = files.get('invoiceFile', {})
         invoice_result = self.manager.create_invoice(
             fields.get('invoiceNumber', ''),
             fields.get('invoiceDate'),
             seller_id, bill_id,
             invoice_file_info.get('data'),
-            invoice_file_info.get('filename')
+            invoice_file_info.get('filename'),
+            context
         )
         invoice_id = invoice_result['id']
 
-        ec_file_info = files.get('entryControlFile', {})
         ec_result = self.manager.create_entry_control(
             fields.get('entryControlNumber', ''),
             fields.get('entryControlDate'),
             ec_file_info.get('data'),
-            ec_file_info.get('filename')
+            ec_file_info.get('filename'),
+            context
         )
         entry_control_id = ec_result['id']
 
@@ -327,6 +616,9 @@ class RequestHandler:
             fields.get('location', ''),
             int(fields.get('quantity', 0))
         )
+        self._release_uploads(
+            bill_file_info, invoice_file_info, ec_file_info
+        )
 
         return {
             'success': True,
@@ -339,10 +631,9 @@ class RequestHandler:
             )
         }
 
-    def create_writeoff(self, fields, files=None):
+    def create_writeoff(self, fields, files=None, context=None):
         if files is None:
             files = {}
-
         object_id = fields.get('objectId')
         theme_id = fields.get('themeId')
 
@@ -355,7 +646,10 @@ class RequestHandler:
         quantity = int(fields.get('quantity', 0))
         writeoff_date = fields.get('writeoffDate') or None
 
-        doc_info = files.get('writeoffDocument', {})
+        doc_info = self._file_info(
+            files, fields, 'writeoffDocument', 'writeoffDocumentId',
+            context
+        )
         file_data = doc_info.get('data')
         filename = doc_info.get('filename')
 
@@ -365,8 +659,9 @@ class RequestHandler:
 
         result = self.manager.create_writeoff(
             object_id, theme_id, quantity,
-            writeoff_date, file_data, filename
+            writeoff_date, file_data, filename, context
         )
+        self._release_uploads(doc_info)
         return {
             'success': True,
             'id': result['id'],
@@ -376,58 +671,7 @@ class RequestHandler:
             )
         }
 
-    def update_object(self, fields, session_id=None):
-        object_id = int(fields.get('id'))
-        object_name = fields.get('objectName')
-        self.manager.update_object(object_id, object_name)
-
-        if session_id:
-            self._log(
-                session_id, 'Редактирование', 'Объект',
-                object_id, object_name, None
-            )
-
-        return {
-            'success': True,
-            'message': f'Объект "{object_name}" успешно обновлён'
-        }
-
-    def update_seller(self, fields, session_id=None):
-        seller_id = int(fields.get('id'))
-        name = fields.get('name')
-        inn = fields.get('inn')
-        kpp = fields.get('kpp')
-        self.manager.update_seller(seller_id, name, inn, kpp)
-
-        if session_id:
-            self._log(
-                session_id, 'Редактирование', 'Поставщик',
-                seller_id, name,
-                f'ИНН: {inn}, КПП: {kpp}'
-            )
-
-        return {
-            'success': True,
-            'message': f'Поставщик "{name}" успешно обновлён'
-        }
-
-    def update_theme(self, fields, session_id=None):
-        theme_id = int(fields.get('id'))
-        name = fields.get('name')
-        self.manager.update_theme(theme_id, name)
-
-        if session_id:
-            self._log(
-                session_id, 'Редактирование', 'Тема',
-                theme_id, name, None
-            )
-
-        return {
-            'success': True,
-            'message': f'Тема "{name}" успешно обновлена'
-        }
-
-    def update_receipt(self, fields, files=None, session_id=None):
+    def update_receipt(self, fields, files=None, context=None):
         if files is None:
             files = {}
 
@@ -449,9 +693,16 @@ class RequestHandler:
         obj = self.db.get_object_by_id(object_id)
         obj_name = obj['objectname'] if obj else str(object_id)
 
-        bill_info = files.get('editBillFile', {})
-        invoice_info = files.get('editInvoiceFile', {})
-        ec_info = files.get('editEcFile', {})
+        bill_info = self._file_info(
+            files, fields, 'editBillFile', 'editBillDocumentId', context
+        )
+        invoice_info = self._file_info(
+            files, fields, 'editInvoiceFile', 'editInvoiceDocumentId',
+            context
+        )
+        ec_info = self._file_info(
+            files, fields, 'editEcFile', 'editEcDocumentId', context
+        )
 
         self.manager.update_receipt(
             receipt_id, object_id, seller_object_name,
@@ -461,10 +712,20 @@ class RequestHandler:
             invoice_number, invoice_date,
             invoice_info.get('data'), invoice_info.get('filename'),
             ec_number, ec_date,
-            ec_info.get('data'), ec_info.get('filename')
+            ec_info.get('data'), ec_info.get('filename'),
+            context
         )
+        self._release_uploads(bill_info, invoice_info, ec_info)
+
+        if self.file_cache is not None and (
+            bill_info.get('data') or invoice_info.get('data') or
+            ec_info.get('data')
+        ):
+            self._invalidate_files(self._receipt_file_keys(
+                self.db.get_receipt_by_id(receipt_id)
+            ))
 
-        if session_id:
+        if context:
             details_parts = [
                 f'Наименование: {seller_object_name}',
                 f'Кол-во: {quantity}'
@@ -499,7 +760,7 @@ class RequestHandler:
                 )
 
             self._log(
-                session_id, 'Редактирование', 'Поступление',
+                context, 'Редактирование', 'Поступление',
                 receipt_id, obj_name,
                 ', '.join(details_parts)
             )
@@ -510,7 +771,7 @@ class RequestHandler:
         }
 
     def update_writeoff(self, fields, files=None,
-                        session_id=None):
+                        context=None):
         if files is None:
             files = {}
 
@@ -520,7 +781,9 @@ class RequestHandler:
         quantity = int(fields.get('quantity'))
         writeoff_date = fields.get('writeoffDate')
 
-        doc_info = files.get('writeoffDocument', {})
+        doc_info = self._file_info(
+            files, fields, 'writeoffDocument', 'writeoffDocumentId', context
+        )
         file_data = doc_info.get('data')
         filename = doc_info.get('filename')
 
@@ -533,10 +796,13 @@ class RequestHandler:
 
         self.manager.update_writeoff(
             writeoff_id, object_id, theme_id, quantity,
-            writeoff_date, file_data, filename
+            writeoff_date, file_data, filename, context
         )
+        self._release_uploads(doc_info)
+        if file_data:
+            self._invalidate_files([('writeoff', writeoff_id)])
 
-        if session_id:
+        if context:
             details_parts = [f'Кол-во: {quantity}']
             if writeoff_date:
                 details_parts.append(f'Дата: {writeoff_date}')
@@ -548,7 +814,7 @@ class RequestHandler:
                 )
 
             self._log(
-                session_id, 'Редактирование', 'Списание',
+                context, 'Редактирование', 'Списание',
                 writeoff_id, obj_name,
                 ', '.join(details_parts)
             )
@@ -558,22 +824,154 @@ class RequestHandler:
             'message': 'Списание успешно обновлено'
         }
 
-    def update_object(self, fields, session_id=None):
-        object_id = int(fields.get('id'))
+    # ==================== PATCH ====================
+    # Поле формы -> (ключ строки get_*_by_id, преобразование)
+    RECEIPT_PATCH_FIELDS = {
+        'objectId': ('object_id', int),
+        'sellerObjectName': ('seller_object_name', str),
+        'sellerId': ('seller_id', int),
+        'themeId': ('theme_id', int),
+        'location': ('location', str),
+        'quantity': ('quantity', int),
+        'billNumber': ('bill_number', _patch_text),
+        'billDate': ('bill_date', _patch_date),
+        'invoiceNumber': ('invoice_number', _patch_text),
+        'invoiceDate': ('invoice_date', _patch_date),
+        'ecNumber': ('entry_control_number', _patch_text),
+        'ecDate': ('entry_control_date', _patch_date),
+    }
+    WRITEOFF_PATCH_FIELDS = {
+        'objectId': ('object_id', int),
+        'themeId': ('theme_id', int),
+        'quantity': ('quantity', int),
+        'writeoffDate': ('writeoff_date', _patch_date),
+    }
+
+    @staticmethod
+    def _patch_changes(fields, columns):
+        return {
+            column: convert(fields[name])
+            for name, (column, convert) in columns.items()
+            if name in fields
+        }
+
+    def patch_receipt(self, fields, files=None, context=None):
+        if files is None:
+            files = {}
 
-        # Получаем старое имя для лога
-        old_obj = self.db.get_object_by_id(object_id)
-        old_name = old_obj['objectname'] if old_obj else ''
+        receipt_id = int(fields.get('id'))
+        changes = self._patch_changes(fields, self.RECEIPT_PATCH_FIELDS)
+        file_infos = {
+            kind: self._file_info(files, fields, file_field,
+                                  document_field, context)
+            for kind, file_field, document_field in (
+                ('bill', 'editBillFile', 'editBillDocumentId'),
+                ('invoice', 'editInvoiceFile', 'editInvoiceDocumentId'),
+                ('entry_control', 'editEcFile', 'editEcDocumentId'),
+            )
+        }
 
+        result = self.manager.patch_receipt(
+            receipt_id, changes,
+            {kind: (info.get('data'), info.get('filename'))
+             for kind, info in file_infos.items()},
+            context
+        )
+        self._release_uploads(*file_infos.values())
+
+        updated_docs = [
+            f'{label}: {file_infos[kind]["filename"]}'
+            for kind, label in (('bill', 'Счёт'), ('invoice', 'Накладная'),
+                                ('entry_control', 'Вх.контроль'))
+            if file_infos[kind].get('data')
+        ]
+        if updated_docs:
+            self._invalidate_files(self._receipt_file_keys(result['new']))
+
+        if context and result['changed']:
+            receipt = result['new']
+            obj = result['object']
+            details_parts = [
+                f'Наименование: {receipt["seller_object_name"]}',
+                f'Кол-во: {receipt["quantity"]}'
+            ]
+            for column, label in (('bill_number', 'Счёт'),
+                                  ('invoice_number', 'Накладная'),
+                                  ('entry_control_number', 'Вх.контроль')):
+                value = receipt.get(column)
+                if value:
+                    details_parts.append(f'{label}: {value}')
+            if updated_docs:
+                details_parts.append(
+                    'Обновлены файлы: ' + ', '.join(updated_docs)
+                )
+            self._log(
+                context, 'Редактирование', 'Поступление', receipt_id,
+                obj['objectname'] if obj else str(receipt['object_id']),
+                ', '.join(details_parts)
+            )
+
+        return {
+            'success': True,
+            'changed': result['changed'],
+            'message': 'Поступление успешно обновлено'
+            if result['changed'] else 'Изменений нет'
+        }
+
+    def patch_writeoff(self, fields, files=None, context=None):
+        if files is None:
+            files = {}
+
+        writeoff_id = int(fields.get('id'))
+        changes = self._patch_changes(fields, self.WRITEOFF_PATCH_FIELDS)
+        doc_info = self._file_info(
+            files, fields, 'writeoffDocument', 'writeoffDocumentId', context
+        )
+        file_data = doc_info.get('data')
+        filename = doc_info.get('filename')
+
+        result = self.manager.patch_writeoff(
+            writeoff_id, changes, file_data, filename, context
+        )
+        self._release_uploads(doc_info)
+        if file_data:
+            self._invalidate_files([('writeoff', writeoff_id)])
+
+        if context and result['changed']:
+            writeoff = result['new']
+            obj = result['object']
+            details_parts = [f'Кол-во: {writeoff["quantity"]}']
+            if writeoff.get('writeoff_date'):
+                details_parts.append(f'Дата: {writeoff["writeoff_date"]}')
+            document = filename or writeoff.get('document_filename')
+            if document:
+                details_parts.append(f'Документ: {document}')
+            self._log(
+                context, 'Редактирование', 'Списание', writeoff_id,
+                obj['objectname'] if obj else str(writeoff['object_id']),
+                ', '.join(details_parts)
+            )
+
+        return {
+            'success': True,
+            'changed': result['changed'],
+            'message': 'Списание успешно обновлено'
+            if result['changed'] else 'Изменений нет'
+        }
+
+    def update_object(self, fields, context=None):
+        object_id = int(fields.get('id'))
         object_name = fields.get('objectName')
-        self.manager.update_object(object_id, object_name)
+        result = self.manager.update_object(object_id, object_name)
 
-        if session_id:
+        if context:
+            old_obj = result['old']
+            old_name = old_obj['objectname'] if old_obj else ''
             details = None
             if old_name and old_name != object_name:
                 details = f'Было: {old_name}'
             self._log(
-                session_id, 'Редактирование', 'Объект',
+                context, 'Редактирование', 'Объект',
                 object_id, object_name, details
             )
 
@@ -582,32 +980,20 @@ class RequestHandler:
             'message': f'Объект "{object_name}" успешно обновлён'
         }
 
-    def update_pricing(self, fields, session_id=None):
+    def update_pricing(self, fields, context=None):
         pricing_id = int(fields.get('id'))
         price = float(fields.get('price'))
         tax = float(fields.get('tax'))
 
-        # Получаем данные о поступлении и объекте
-        pricing = self.db.get_pricing_by_id(pricing_id)
-        obj_name = f'Цена #{pricing_id}'
-        if pricing:
-            receipt = self.db.get_receipt_by_id(
-                pricing['receipt_id']
-            )
-            if receipt:
-                obj = self.db.get_object_by_id(
-                    receipt['object_id']
-                )
-                if obj:
-                    obj_name = obj['objectname']
-
-        self.pricing_manager.update_pricing(
+        result = self.pricing_manager.update_pricing(
             pricing_id, price, tax
         )
 
-        if session_id:
+        if context:
+            obj = result['object']
+            obj_name = obj['objectname'] if obj else f'Цена #{pricing_id}'
             self._log(
-                session_id, 'Редактирование', 'Цена',
+                context, 'Редактирование', 'Цена',
                 pricing_id, obj_name,
                 f'Цена: {price}, НДС: {tax}%'
             )
@@ -618,23 +1004,25 @@ class RequestHandler:
         }
 
     # ==================== DELETE (с логированием) ============
-    def delete_object(self, object_id, session_id=None):
-        obj = self.db.get_object_by_id(object_id)
+    def delete_object(self, object_id, context=None):
+        result = self.manager.delete_object(object_id)
+        obj = result['old']
         obj_name = obj['objectname'] if obj else str(object_id)
+        receipts = result['receipts']
+        writeoffs = result['writeoffs']
 
-        # Считаем связанные записи для лога
-        receipts = self.db.get_receipts_by_object(object_id)
-        writeoffs = self.db.get_writeoffs_by_object(object_id)
-
-        self.manager.delete_object(object_id)
+        file_keys = [('writeoff', w['id']) for w in writeoffs]
+        for receipt in receipts:
+            file_keys.extend(self._receipt_file_keys(receipt))
+        self._invalidate_files(file_keys)
 
-        if session_id:
+        if context:
             details = (
                 f'Удалено поступлений: {len(receipts)}, '
                 f'списаний: {len(writeoffs)}'
             )
             self._log(
-                session_id, 'Удаление', 'Объект',
+                context, 'Удаление', 'Объект',
                 object_id, obj_name, details
             )
 
@@ -643,14 +1031,16 @@ class RequestHandler:
             'message': 'Объект успешно удалён'
         }
 
-    def delete_receipt(self, receipt_id, session_id=None):
-        receipt = self.db.get_receipt_by_id(receipt_id)
+    def delete_receipt(self, receipt_id, context=None):
+        result = self.manager.delete_receipt(receipt_id)
+        receipt = result['old']
+        self._invalidate_files(self._receipt_file_keys(receipt))
 
         obj_name = str(receipt_id)
         details_parts = []
 
         if receipt:
-            obj = self.db.get_object_by_id(receipt.get('object_id'))
+            obj = result['object']
             if obj:
                 obj_name = obj['objectname']
 
@@ -671,11 +1061,9 @@ class RequestHandler:
                     f'Кол-во: {receipt["quantity"]}'
                 )
 
-        self.manager.delete_receipt(receipt_id)
-
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Поступление',
+                context, 'Удаление', 'Поступление',
                 receipt_id, obj_name,
                 ', '.join(details_parts) if details_parts else None
             )
@@ -685,8 +1073,9 @@ class RequestHandler:
             'message': 'Поступление успешно удалено'
         }
 
-    def delete_writeoff(self, writeoff_id, session_id=None):
-        writeoff = self.db.get_writeoff_by_id(writeoff_id)
+    def delete_writeoff(self, writeoff_id, context=None):
+        writeoff = self.manager.delete_writeoff(writeoff_id)['old']
+        self._invalidate_files([('writeoff', writeoff_id)])
 
         obj_name = str(writeoff_id)
         details_parts = []
@@ -712,11 +1101,9 @@ class RequestHandler:
                     f'Тема: {writeoff["theme_name"]}'
                 )
 
-        self.manager.delete_writeoff(writeoff_id)
-
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Списание',
+                context, 'Удаление', 'Списание',
                 writeoff_id, obj_name,
                 ', '.join(details_parts) if details_parts else None
             )
@@ -726,32 +1113,24 @@ class RequestHandler:
             'message': 'Списание успешно удалено'
         }
 
-    def delete_pricing(self, pricing_id, session_id=None):
-        pricing = self.db.get_pricing_by_id(pricing_id)
+    def delete_pricing(self, pricing_id, context=None):
+        result = self.pricing_manager.delete_pricing(pricing_id)
+        pricing = result['old']
 
         obj_name = f'Цена #{pricing_id}'
         details = None
 
         if pricing:
-            receipt = self.db.get_receipt_by_id(
-                pricing['receipt_id']
-            )
-            if receipt:
-                obj = self.db.get_object_by_id(
-                    receipt['object_id']
-                )
-                if obj:
-                    obj_name = obj['objectname']
+            if result['object']:
+                obj_name = result['object']['objectname']
             details = (
                 f'Цена: {pricing["price"]}, '
                 f'НДС: {pricing["tax"]}%'
             )
 
-        self.pricing_manager.delete_pricing(pricing_id)
-
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Цена',
+                context, 'Удаление', 'Цена',
                 pricing_id, obj_name, details
             )
 
@@ -760,19 +1139,17 @@ class RequestHandler:
             'message': 'Цена успешно удалена'
         }
 
-    def delete_seller(self, seller_id, session_id=None):
-        seller = self.db.get_seller_by_id(seller_id)
+    def delete_seller(self, seller_id, context=None):
+        seller = self.manager.delete_seller(seller_id)['old']
         seller_name = seller['name'] if seller else str(seller_id)
 
         details = None
         if seller:
             details = f'ИНН: {seller["inn"]}, КПП: {seller["kpp"]}'
 
-        self.manager.delete_seller(seller_id)
-
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Поставщик',
+                context, 'Удаление', 'Поставщик',
                 seller_id, seller_name, details
             )
 
@@ -781,15 +1158,13 @@ class RequestHandler:
             'message': 'Поставщик успешно удалён'
         }
 
-    def delete_theme(self, theme_id, session_id=None):
-        theme = self.db.get_theme_by_id(theme_id)
+    def delete_theme(self, theme_id, context=None):
+        theme = self.manager.delete_theme(theme_id)['old']
         theme_name = theme['name'] if theme else str(theme_id)
 
-        self.manager.delete_theme(theme_id)
-
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Тема',
+                context, 'Удаление', 'Тема',
                 theme_id, theme_name, None
             )
 
@@ -798,22 +1173,22 @@ class RequestHandler:
             'message': 'Тема успешно удалена'
         }
 
-    def update_seller(self, fields, session_id=None):
+    def update_seller(self, fields, context=None):
         seller_id = int(fields.get('id'))
         name = fields.get('name')
         inn = fields.get('inn')
         kpp = fields.get('kpp')
 
-        old_seller = self.db.get_seller_by_id(seller_id)
-
-        self.manager.update_seller(seller_id, name, inn, kpp)
+        old_seller = self.manager.update_seller(
+            seller_id, name, inn, kpp
+        )['old']
 
-        if session_id:
+        if context:
             details = f'ИНН: {inn}, КПП: {kpp}'
             if old_seller and old_seller['name'] != name:
                 details = f'Было: {old_seller["name"]}, {details}'
             self._log(
-                session_id, 'Редактирование', 'Поставщик',
+                context, 'Редактирование', 'Поставщик',
                 seller_id, name, details
             )
 
@@ -822,20 +1197,18 @@ class RequestHandler:
             'message': f'Поставщик "{name}" успешно обновлён'
         }
 
-    def update_theme(self, fields, session_id=None):
+    def update_theme(self, fields, context=None):
         theme_id = int(fields.get('id'))
         name = fields.get('name')
 
-        old_theme = self.db.get_theme_by_id(theme_id)
+        old_theme = self.manager.update_theme(theme_id, name)['old']
 
-        self.manager.update_theme(theme_id, name)
-
-        if session_id:
+        if context:
             details = None
             if old_theme and old_theme['name'] != name:
                 details = f'Было: {old_theme["name"]}'
             self._log(
-                session_id, 'Редактирование', 'Тема',
+                context, 'Редактирование', 'Тема',
                 theme_id, name, details
             )
 
@@ -844,23 +1217,25 @@ class RequestHandler:
             'message': f'Тема "{name}" успешно обновлена'
         }
 
-    def update_user(self, fields, session_id=None):
+    def update_user(self, fields, context=None):
         user_id = int(fields.get('id'))
         username = fields.get('username')
         admin = fields.get('admin', '').lower() == 'true'
 
-        old_user = self.db.get_user_by_id(user_id)
-
-        self.user_manager.update_user(user_id, username, admin)
+        old_user = self.user_manager.update_user(
+            user_id, username, admin
+        )['old']
 
         password = fields.get('password', '').strip()
         if password:
-            password_hash = SessionManager.hash_password(password)
+            password_hash = self.password_hasher.hash(password)
             self.user_manager.update_user_password(
                 user_id, password_hash
             )
+        if password or (old_user and old_user['admin'] != admin):
+            self.session_manager.revoke_user(user_id)
 
-        if session_id:
+        if context:
             details_parts = []
             if old_user and old_user['username'] != username:
                 details_parts.append(
@@ -872,7 +1247,7 @@ class RequestHandler:
                 details_parts.append('Пароль изменён')
 
             self._log(
-                session_id, 'Редактирование', 'Пользователь',
+                context, 'Редактирование', 'Пользователь',
                 user_id, username,
                 ', '.join(details_parts)
             )
@@ -882,15 +1257,15 @@ class RequestHandler:
             'message': f'Пользователь "{username}" успешно обновлён'
         }
 
-    def delete_user(self, user_id, session_id=None):
-        user = self.db.get_user_by_id(user_id)
+    def delete_user(self, user_id, context=None):
+        user = self.user_manager.delete_user(user_id)['old']
         user_name = user['username'] if user else str(user_id)
 
-        self.user_manager.delete_user(user_id)
+        self.session_manager.revoke_user(user_id)
 
-        if session_id:
+        if context:
             self._log(
-                session_id, 'Удаление', 'Пользователь',
+                context, 'Удаление', 'Пользователь',
                 user_id, user_name, None
             )
 
@@ -901,8 +1276,7 @@ class RequestHandler:
 
     # ==================== PRICING GET ====================
     def get_all_pricing(self):
-        pricing = self.db.get_all_pricing()
-        return [dict(p) for p in pricing]
+        return self.db.stream_all_pricing()
 
     def get_pricing(self, pricing_id):
         pricing = self.db.get_pricing_by_id(pricing_id)
@@ -910,6 +1284,9 @@ class RequestHandler:
             return dict(pricing)
         raise ValueError('Pricing not found')
 
+    def get_pricing_by_receipts(self, receipt_ids):
+        return self.db.get_pricing_by_receipts(receipt_ids)
+
     def get_pricing_by_receipt(self, receipt_id):
         pricing = self.db.get_pricing_by_receipt(receipt_id)
         if pricing:
@@ -919,7 +1296,7 @@ class RequestHandler:
     def create_pricing(self, fields):
         receipt_id = int(fields.get('receiptId'))
         price = float(fields.get('price'))
-        tax = float(fields.get('tax', 20.0))
+        tax = float(fields.get('tax', DEFAULT_TAX))
 
         existing = self.db.get_pricing_by_receipt(receipt_id)
         if existing:
@@ -1030,6 +1407,15 @@ class FileHelper:
 
     INLINE_TYPES = ['application/pdf', 'image/jpeg', 'image/png', 'image/gif']
 
+    # Кодировки хранилища и соответствующие им Content-Encoding
+    CONTENT_ENCODINGS = {'zlib': 'deflate', 'zstd': 'zstd'}
+
+    RECEIPT_DOCUMENTS = (
+        ('bill', 'bill_id'),
+        ('invoice', 'invoice_id'),
+        ('entry_control', 'entry_control_id')
+    )
+
     @classmethod
     def detect_content_type(cls, file_data, filename=''):
         ext = filename.lower().split('.')[-1] if '.' in filename else ''
@@ -1050,6 +1436,26 @@ class FileHelper:
     def is_inline(cls, content_type):
         return content_type in cls.INLINE_TYPES
 
+    @classmethod
+    def accepted_encodings(cls, accept_encoding):
+        tokens = set()
+        for part in accept_encoding.split(','):
+            token, *params = part.split(';')
+            quality = 1.0
+            for param in params:
+                name, _, value = param.strip().partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                tokens.add(token.strip().lower())
+        return tuple(
+            encoding for encoding, token in cls.CONTENT_ENCODINGS.items()
+            if token in tokens
+        )
+
     @staticmethod
     def encode_filename(filename):
         return quote(filename)
\ No newline at end of file
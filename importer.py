@@ -0,0 +1,347 @@
+import codecs
+import csv
+import datetime
+import io
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from handlers import DEFAULT_TAX
+
+# Колонка import_rows -> допустимые заголовки файла (без учёта
+# регистра и крайних пробелов)
+COLUMNS = OrderedDict((
+    ('object_name', ('объект', 'объект на складе', 'object')),
+    ('seller_object_name', ('наименование у поставщика', 'наименование',
+                            'seller_object_name')),
+    ('seller_name', ('поставщик', 'seller')),
+    ('seller_inn', ('инн', 'inn')),
+    ('seller_kpp', ('кпп', 'kpp')),
+    ('theme_name', ('тема', 'theme')),
+    ('location', ('место хранения', 'место', 'location')),
+    ('quantity', ('количество', 'кол-во', 'quantity')),
+    ('bill_number', ('счёт', 'счет', 'bill_number')),
+    ('bill_date', ('дата счёта', 'дата счета', 'bill_date')),
+    ('invoice_number', ('накладная', 'invoice_number')),
+    ('invoice_date', ('дата накладной', 'invoice_date')),
+    ('entry_control_number', ('входной контроль', 'вх. контроль',
+                              'entry_control_number')),
+    ('entry_control_date', ('дата вх. контроля', 'дата входного контроля',
+                            'entry_control_date')),
+    ('price', ('цена', 'price')),
+    ('tax', ('ндс', 'tax')),
+))
+REQUIRED = {
+    'object_name': 'Не указан объект',
+    'seller_name': 'Не указан поставщик',
+    'theme_name': 'Не указана тема',
+    'quantity': 'Не указано количество',
+}
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d.%m.%y', '%d/%m/%Y')
+STAGING_COLUMNS = ('import_id', 'line') + tuple(COLUMNS)
+
+
+def _decode_csv(data):
+    """Текст CSV: UTF-8 (с BOM или без), иначе cp1251 из Excel."""
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data[:65536])
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'cp1251'
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline='')
+
+
+def read_rows(data, filename):
+    """Строки файла по одной: (номер строки, значения)."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        if openpyxl is None:
+            raise ValueError('Для импорта XLSX установите openpyxl')
+        book = openpyxl.load_workbook(
+            io.BytesIO(data), read_only=True, data_only=True
+        )
+        try:
+            rows = book.active.iter_rows(values_only=True)
+            for number, values in enumerate(rows, 1):
+                yield number, values
+        finally:
+            book.close()
+        return
+
+    text = _decode_csv(data)
+    try:
+        dialect = csv.Sniffer().sniff(text.read(8192), delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+    text.seek(0)
+    for number, values in enumerate(csv.reader(text, dialect), 1):
+        yield number, values
+
+
+def map_header(values):
+    """Позиции колонок import_rows в строке заголовка."""
+    aliases = {
+        alias: column
+        for column, names in COLUMNS.items() for alias in names
+    }
+    aliases.update({column: column for column in COLUMNS})
+    positions = {}
+    for index, value in enumerate(values):
+        column = aliases.get(str(value or '').strip().lower())
+        if column and column not in positions:
+            positions[column] = index
+    missing = [
+        COLUMNS[column][0] for column in REQUIRED if column not in positions
+    ]
+    if missing:
+        raise ValueError(
+            'В файле нет колонок: ' + ', '.join(missing)
+        )
+    return positions
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value).strip()
+    return value or None
+
+
+def _date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(
+                str(value).strip(), date_format
+            ).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def _number(value):
+    number = Decimal(value.replace(' ', '').replace(',', '.'))
+    if not number.is_finite() or number < 0:
+        raise InvalidOperation(value)
+    return number
+
+
+def validate_row(positions, values):
+    """Значения строки для import_rows (без import_id и line) и список
+    ошибок. Строка без значений возвращается как (None, []).
+    """
+    cells = {
+        column: values[index] if index < len(values) else None
+        for column, index in positions.items()
+    }
+    row = {column: _text(cells.get(column)) for column in COLUMNS}
+    if not any(row.values()):
+        return None, []
+
+    errors = [
+        message for column, message in REQUIRED.items() if not row[column]
+    ]
+
+    if row['quantity']:
+        try:
+            quantity = _number(row['quantity'])
+        except InvalidOperation:
+            quantity = None
+        if not quantity or quantity != int(quantity):
+            errors.append(f'Неверное количество: {row["quantity"]}')
+        else:
+            row['quantity'] = int(quantity)
+
+    for column, label in (('bill_date', 'счёта'),
+                          ('invoice_date', 'накладной'),
+                          ('entry_control_date', 'вх. контроля')):
+        if row[column]:
+            try:
+                row[column] = _date(cells[column])
+            except ValueError:
+                errors.append(f'Неверная дата {label}: {row[column]}')
+
+    for column, label in (('price', 'цена'), ('tax', 'НДС')):
+        if row[column]:
+            try:
+                row[column] = _number(row[column].rstrip('%'))
+            except InvalidOperation:
+                errors.append(f'Неверное значение ({label}): {row[column]}')
+    if row['price'] and row['tax'] is None:
+        row['tax'] = DEFAULT_TAX
+
+    return tuple(row.values()), errors
+
+
+class ReceiptImporter:
+    """Импорт поступлений из CSV/XLSX в фоновом потоке.
+
+    Файл читается построчно, проверенные строки порциями загружаются
+    COPY в import_rows, затем import_receipts одной транзакцией
+    создаёт недостающие объекты, поставщиков и темы и сами поступления
+    (migrations/009). Ход импорта и отчёт об ошибках по строкам
+    доступны по id импорта. Импорты выполняются по одному.
+    """
+
+    def __init__(self, db, copy_batch=5000, max_errors=1000,
+                 max_jobs=20):
+        self._db = db
+        self._copy_batch = copy_batch
+        self._max_errors = max_errors
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    # ==================== JOBS ====================
+    def _get(self, user, import_id):
+        with self._lock:
+            job = self._jobs.get(import_id)
+        if job is None or job['user_id'] != user.get('id'):
+            raise ValueError('Import not found')
+        return job
+
+    @staticmethod
+    def _status(job):
+        status = {
+            key: value for key, value in job.items()
+            if key not in ('errors', 'user_id', 'username')
+        }
+        status['import_id'] = status.pop('id')
+        return status
+
+    def start(self, user, data, filename, dry_run=False):
+        if not data:
+            raise ValueError('Файл не выбран')
+        import_id = secrets.token_hex(16)
+        job = {
+            'id': import_id,
+            'user_id': user.get('id'),
+            'username': user.get('username'),
+            'filename': filename,
+            'dry_run': dry_run,
+            'state': 'queued',
+            'rows': 0,
+            'valid': 0,
+            'invalid': 0,
+            'inserted': 0,
+            'created': None,
+            'errors': [],
+            'errors_truncated': False,
+            'error': None,
+            'started_at': time.time(),
+            'finished_at': None,
+        }
+        with self._lock:
+            self._jobs[import_id] = job
+            finished = [
+                key for key, item in self._jobs.items()
+                if item['finished_at'] is not None
+            ]
+            for key in finished[:max(0, len(self._jobs) - self._max_jobs)]:
+                del self._jobs[key]
+
+        thread = threading.Thread(
+            target=self._run, args=(job, data),
+            daemon=True, name=f'import-{import_id[:8]}'
+        )
+        thread.start()
+        return self._status(job)
+
+    def status(self, user, import_id):
+        return self._status(self._get(user, import_id))
+
+    def report(self, user, import_id):
+        job = self._get(user, import_id)
+        return {
+            'import_id': import_id,
+            'invalid': job['invalid'],
+            'errors': list(job['errors']),
+            'truncated': job['errors_truncated'],
+        }
+
+    # ==================== PIPELINE ====================
+    def _run(self, job, data):
+        with self._run_lock:
+            try:
+                job['state'] = 'validating'
+                self._load(job, data)
+                if job['dry_run'] or not job['valid']:
+                    job['state'] = 'done'
+                    return
+                job['state'] = 'inserting'
+                result = self._db.import_receipts(job['id'])
+                job['created'] = result['created']
+                job['inserted'] = result['inserted']
+                job['state'] = 'done'
+                self._db.add_log(
+                    job['user_id'], job['username'], 'Импорт',
+                    'Поступление', None, job['filename'],
+                    f'Создано поступлений: {job["inserted"]}, '
+                    f'строк с ошибками: {job["invalid"]}'
+                )
+            except Exception as e:
+                job['state'] = 'failed'
+                job['error'] = str(e).split('\n')[0]
+            finally:
+                if not job['dry_run']:
+                    try:
+                        self._db.import_cleanup(job['id'])
+                    except Exception as e:
+                        print(f'Import cleanup failed: {e}')
+                job['finished_at'] = time.time()
+
+    def _load(self, job, data):
+        """Проверяет строки файла и загружает верные в import_rows."""
+        rows = read_rows(data, job['filename'] or '')
+        positions = None
+        for _, values in rows:
+            if any(_text(value) for value in values):
+                positions = map_header(values)
+                break
+        if positions is None:
+            raise ValueError('Файл пуст')
+
+        batch = []
+        for line, values in rows:
+            row, errors = validate_row(positions, values)
+            if row is None:
+                continue
+            job['rows'] += 1
+            if errors:
+                job['invalid'] += 1
+                if len(job['errors']) < self._max_errors:
+                    job['errors'].append({'line': line, 'errors': errors})
+                else:
+                    job['errors_truncated'] = True
+                continue
+            job['valid'] += 1
+            if job['dry_run']:
+                continue
+            batch.append((job['id'], line) + row)
+            if len(batch) >= self._copy_batch:
+                self._db.copy_import_rows(STAGING_COLUMNS, batch)
+                batch = []
+        if batch:
+            self._db.copy_import_rows(STAGING_COLUMNS, batch)
+
+
+def create_receipt_importer(config, db):
+    import_config = config.get('imports') or {}
+    return ReceiptImporter(
+        db,
+        import_config.get('copy_batch', 5000),
+        import_config.get('max_errors', 1000),
+        import_config.get('max_jobs', 20)
+    )
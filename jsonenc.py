@@ -0,0 +1,179 @@
+import base64
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _binary(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+# Явные преобразования типов из строк БД. Строковое представление
+# совпадает с прежним default=str: "1234.50", "2024-01-02 03:04:05".
+HANDLERS = {
+    decimal.Decimal: str,
+    datetime.datetime: str,
+    datetime.date: str,
+    datetime.time: str,
+    uuid.UUID: str,
+    memoryview: _binary,
+    bytes: _binary,
+    bytearray: _binary,
+}
+
+
+def _default(value):
+    handler = HANDLERS.get(type(value))
+    if handler is None:
+        for kind, function in HANDLERS.items():
+            if isinstance(value, kind):
+                handler = function
+                break
+        else:
+            handler = str
+    return handler(value)
+
+
+class JsonEncoder:
+    """Кодирование ответов API сразу в байты UTF-8.
+
+    При установленном orjson используется он, иначе — один заранее
+    созданный json.JSONEncoder без проверки циклов. Вывод json совпадает
+    с прежним json.dumps (разделители ", " и ": "); orjson пишет
+    компактно, без пробелов. Разделители вывода — в item_separator и
+    key_separator (для JsonStream).
+    """
+
+    def __init__(self, backend='auto'):
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('orjson is not installed')
+        if backend not in ('orjson', 'json'):
+            raise ValueError(f'Unknown JSON encoder: {backend}')
+        self.backend = backend
+        if backend == 'orjson':
+            self.item_separator, self.key_separator = b',', b':'
+        else:
+            self.item_separator, self.key_separator = b', ', b': '
+        self._encoder = json.JSONEncoder(
+            ensure_ascii=False, check_circular=False, default=_default
+        )
+        if orjson is not None:
+            # Даты передаются в _default, чтобы сохранить формат str()
+            self._options = orjson.OPT_PASSTHROUGH_DATETIME | \
+                orjson.OPT_NON_STR_KEYS
+
+    def _encode_json(self, data):
+        return self._encoder.encode(data).encode('utf-8')
+
+    def encode(self, data):
+        if self.backend == 'orjson':
+            try:
+                return orjson.dumps(
+                    data, default=_default, option=self._options
+                )
+            except TypeError:
+                # Целые больше 64 бит и прочие редкие случаи
+                pass
+        return self._encode_json(data)
+
+
+class JsonStream:
+    """Ответ-массив из порций строк, который кодируется и отправляется
+    по мере чтения из БД. Если задан key, массив вкладывается в объект
+    {key: [...], **extra}.
+    """
+
+    def __init__(self, batches, key=None, extra=None):
+        self.batches = batches
+        self.key = key
+        self.extra = extra or {}
+
+    def materialize(self):
+        rows = [row for batch in self.batches for row in batch]
+        if self.key is None:
+            return rows
+        return dict({self.key: rows}, **self.extra)
+
+    def chunks(self, encoder, timer=None):
+        """Байты ответа; первая порция отдаётся только после первой
+        выборки, чтобы ошибка запроса ещё могла стать обычным ответом.
+        timer — context.timer: время кодирования идёт в этап
+        serialize отдельно от выборки из БД.
+        """
+        def encode(data):
+            if timer is None:
+                return encoder.encode(data)
+            with timer('serialize'):
+                return encoder.encode(data)
+
+        if self.key is None:
+            prefix, suffix = b'[', b']'
+        else:
+            prefix = b'{' + encoder.encode(self.key) + \
+                encoder.key_separator + b'['
+            suffix = b']'
+            if self.extra:
+                suffix += encoder.item_separator + \
+                    encoder.encode(self.extra)[1:-1]
+            suffix += b'}'
+
+        first = True
+        for batch in self.batches:
+            if not batch:
+                continue
+            body = encode(batch)[1:-1]
+            yield (prefix if first else encoder.item_separator) + body
+            first = False
+        yield (prefix if first else b'') + suffix
+
+
+def create_json_encoder(config):
+    server_config = config.get('server') or {}
+    return JsonEncoder(server_config.get('json_encoder', 'auto'))
+
+
+def to_columns(rows, dictionary_ratio=0.5):
+    """Список строк-словарей в колоночный вид:
+
+        {"columns": [...], "values": [[...], ...], "count": N,
+         "dictionaries": {"seller_name": [...]}}
+
+    values[i] — значения i-й колонки. Строковые колонки, в которых
+    различных значений не больше dictionary_ratio от числа строк,
+    кодируются словарём: в values лежат индексы в dictionaries[column].
+    """
+    rows = list(rows)
+    columns = list(rows[0].keys()) if rows else []
+    values = []
+    dictionaries = {}
+    for column in columns:
+        column_values = [row.get(column) for row in rows]
+        if dictionary_ratio:
+            index = {}
+            for value in column_values:
+                if value is not None:
+                    if type(value) is not str:
+                        index = None
+                        break
+                    index.setdefault(value, len(index))
+            if index and len(index) <= len(rows) * dictionary_ratio:
+                dictionaries[column] = list(index)
+                column_values = [
+                    None if value is None else index[value]
+                    for value in column_values
+                ]
+        values.append(column_values)
+    return {
+        'columns': columns,
+        'values': values,
+        'count': len(rows),
+        'dictionaries': dictionaries
+    }
@@ -1,22 +1,88 @@
 import psycopg2
+from psycopg2.extras import Json
 from database import Database
+from handlers import FileHelper
+from uploads import StoredDocument
 
 class StorageManager:
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, blob_store=None):
         self._db = db
+        self._blob_store = blob_store
+
+    # Documents
+    def _file_param(self, file_data):
+        if self._blob_store is not None or not file_data:
+            return None
+        return psycopg2.Binary(file_data)
+
+    def _put_document(self, file_data, filename):
+        """Сохраняет содержимое в хранилище блобов до обращения к БД.
+
+        Возвращает (sha256, size, filename, content_type) для
+        _attach_document или None без хранилища и файла. Блоб, так и
+        не привязанный к записи, удалит сборщик мусора.
+        """
+        if self._blob_store is None or not file_data:
+            return None
+        if isinstance(file_data, StoredDocument):
+            return (file_data.sha256, len(file_data),
+                    filename or file_data.filename, file_data.content_type)
+        return (
+            self._blob_store.put(file_data), len(file_data), filename,
+            FileHelper.detect_content_type(file_data, filename or '')
+        )
+
+    def _attach_document(self, kind, owner_id, document, context=None):
+        if document is None or not owner_id:
+            return None
+        uploader = (context.user if context else None) or {}
+        self._db.attach_document(
+            kind, owner_id, *document,
+            uploader.get('id'), uploader.get('username')
+        )
+        return document[0]
+
+    def _store_document(self, kind, owner_id, file_data, filename,
+                        context=None):
+        if not owner_id:
+            return None
+        return self._attach_document(
+            kind, owner_id, self._put_document(file_data, filename),
+            context
+        )
+
+    def _receipt_documents(self, receipt):
+        return [
+            (kind, receipt.get(key))
+            for kind, key in FileHelper.RECEIPT_DOCUMENTS
+            if receipt.get(key)
+        ]
+
+    def _detach_documents(self, documents):
+        if self._blob_store is None:
+            return
+        for kind, owner_id in documents:
+            self._db.detach_document(kind, owner_id)
 
     # Objects
     def create_object(self, object_name):
         new_id = self._db.call_function_scalar('create_object', (object_name,))
         return {'id': new_id}
 
+    # Функции *_audited (migrations/007) возвращают словарь
+    # {'success', 'old', 'new', ...} с образами строки до и после
     def update_object(self, object_id, object_name):
-        result = self._db.call_function_scalar('update_object', (object_id, object_name))
-        return {'success': result}
+        return self._db.call_function_scalar('update_object_audited', (object_id, object_name))
 
     def delete_object(self, object_id):
-        result = self._db.call_function_scalar('delete_object', (object_id,))
-        return {'success': result}
+        result = self._db.call_function_scalar('delete_object_audited', (object_id,))
+        documents = [
+            ('writeoff', writeoff['id']) for writeoff in result['writeoffs']
+        ]
+        for receipt in result['receipts']:
+            documents.extend(self._receipt_documents(receipt))
+        self._detach_documents(documents)
+        return result
 
     # Sellers
     def create_seller(self, name, inn, kpp):
@@ -24,12 +90,10 @@ class StorageManager:
         return {'id': new_id}
 
     def update_seller(self, seller_id, name, inn, kpp):
-        result = self._db.call_function_scalar('update_seller', (seller_id, name, inn, kpp))
-        return {'success': result}
+        return self._db.call_function_scalar('update_seller_audited', (seller_id, name, inn, kpp))
 
     def delete_seller(self, seller_id):
-        result = self._db.call_function_scalar('delete_seller', (seller_id,))
-        return {'success': result}
+        return self._db.call_function_scalar('delete_seller_audited', (seller_id,))
 
     # Themes
     def create_theme(self, name):
@@ -37,38 +101,51 @@ class StorageManager:
         return {'id': new_id}
 
     def update_theme(self, theme_id, name):
-        result = self._db.call_function_scalar('update_theme', (theme_id, name))
-        return {'success': result}
+        return self._db.call_function_scalar('update_theme_audited', (theme_id, name))
 
     def delete_theme(self, theme_id):
-        result = self._db.call_function_scalar('delete_theme', (theme_id,))
-        return {'success': result}
+        return self._db.call_function_scalar('delete_theme_audited', (theme_id,))
 
     # Bills
-    def create_bill(self, number, date, seller_id, file_data, filename):
-        file_binary = psycopg2.Binary(file_data) if file_data else None
-        new_id = self._db.call_function_scalar(
-            'create_bill',
-            (number, date, seller_id, file_binary, filename)
-        )
+    # Запись и привязка документа — одна транзакция: при ошибке
+    # привязки не остаётся записи без файла
+    def create_bill(self, number, date, seller_id, file_data, filename,
+                    context=None):
+        document = self._put_document(file_data, filename)
+        with self._db.transaction():
+            new_id = self._db.call_function_scalar(
+                'create_bill',
+                (number, date, seller_id,
+                 self._file_param(file_data), filename)
+            )
+            self._attach_document('bill', new_id, document, context)
         return {'id': new_id}
 
     # Invoices
-    def create_invoice(self, number, date, seller_id, bill_id, file_data, filename):
-        file_binary = psycopg2.Binary(file_data) if file_data else None
-        new_id = self._db.call_function_scalar(
-            'create_invoice',
-            (number, date, seller_id, bill_id, file_binary, filename)
-        )
+    def create_invoice(self, number, date, seller_id, bill_id, file_data,
+                       filename, context=None):
+        document = self._put_document(file_data, filename)
+        with self._db.transaction():
+            new_id = self._db.call_function_scalar(
+                'create_invoice',
+                (number, date, seller_id, bill_id,
+                 self._file_param(file_data), filename)
+            )
+            self._attach_document('invoice', new_id, document, context)
         return {'id': new_id}
 
     # Entry Control
-    def create_entry_control(self, number, date, file_data, filename):
-        file_binary = psycopg2.Binary(file_data) if file_data else None
-        new_id = self._db.call_function_scalar(
-            'create_entry_control',
-            (number, date, file_binary, filename)
-        )
+    def create_entry_control(self, number, date, file_data, filename,
+                             context=None):
+        document = self._put_document(file_data, filename)
+        with self._db.transaction():
+            new_id = self._db.call_function_scalar(
+                'create_entry_control',
+                (number, date, self._file_param(file_data), filename)
+            )
+            self._attach_document(
+                'entry_control', new_id, document, context
+            )
         return {'id': new_id}
 
     # Receipts
@@ -89,16 +166,10 @@ class StorageManager:
                     invoice_number=None, invoice_date=None,
                     invoice_file=None, invoice_filename=None,
                     ec_number=None, ec_date=None,
-                    ec_file=None, ec_filename=None):
-        bill_binary = (
-            psycopg2.Binary(bill_file) if bill_file else None
-        )
-        invoice_binary = (
-            psycopg2.Binary(invoice_file) if invoice_file else None
-        )
-        ec_binary = (
-            psycopg2.Binary(ec_file) if ec_file else None
-        )
+                    ec_file=None, ec_filename=None, context=None):
+        bill_binary = self._file_param(bill_file)
+        invoice_binary = self._file_param(invoice_file)
+        ec_binary = self._file_param(ec_file)
         result = self._db.call_function_scalar(
             'update_receipt',
             (receipt_id, object_id, seller_object_name,
@@ -110,35 +181,118 @@ class StorageManager:
             ec_number, ec_date,
             ec_binary, ec_filename)
         )
+
+        if self._blob_store is not None and (
+            bill_file or invoice_file or ec_file
+        ):
+            receipt = self._db.get_receipt_by_id(receipt_id) or {}
+            self._store_document(
+                'bill', receipt.get('bill_id'),
+                bill_file, bill_filename, context
+            )
+            self._store_document(
+                'invoice', receipt.get('invoice_id'),
+                invoice_file, invoice_filename, context
+            )
+            self._store_document(
+                'entry_control', receipt.get('entry_control_id'),
+                ec_file, ec_filename, context
+            )
         return {'success': result}
 
+    # Ответ PATCH без изменённых полей: в БД не обращаемся
+    UNCHANGED = {'success': True, 'changed': False, 'old': None,
+                 'new': None, 'object': None}
+
+    def patch_receipt(self, receipt_id, changes, files=None,
+                      context=None):
+        """Изменяет только переданные значения поступления.
+
+        changes — значения в ключах строки get_receipt_by_id, включая
+        номера и даты документов; files — {вид: (данные, имя файла)}
+        только для новых файлов. patch_receipt (migrations/008)
+        обновляет только изменённые колонки затронутых таблиц; новые
+        файлы при хранилище блобов привязываются после неё.
+        """
+        files = {kind: file for kind, file in (files or {}).items()
+                 if file[0]}
+        if not changes and not files:
+            return dict(self.UNCHANGED)
+        params = [receipt_id, Json(changes)]
+        for kind, _ in FileHelper.RECEIPT_DOCUMENTS:
+            binary = self._file_param(files.get(kind, (None,))[0])
+            params.extend((binary, files[kind][1] if binary else None))
+        result = self._db.call_function_scalar('patch_receipt', params)
+        if not result['success']:
+            raise ValueError('Receipt not found')
+
+        if self._blob_store is not None:
+            for kind, id_key in FileHelper.RECEIPT_DOCUMENTS:
+                if kind in files:
+                    self._store_document(
+                        kind, result['new'].get(id_key), *files[kind],
+                        context
+                    )
+                    result['changed'] = True
+        return result
+
     def delete_receipt(self, receipt_id):
-        result = self._db.call_function_scalar('delete_receipt', (receipt_id,))
-        return {'success': result}
+        result = self._db.call_function_scalar('delete_receipt_audited', (receipt_id,))
+        if result['old']:
+            self._detach_documents(self._receipt_documents(result['old']))
+        return result
 
     def create_writeoff(self, object_id, theme_id, quantity,
-                    writeoff_date, file_data, filename):
-        file_binary = psycopg2.Binary(file_data) if file_data else None
-        new_id = self._db.call_function_scalar(
-            'create_writeoff',
-            (object_id, theme_id, quantity,
-            writeoff_date, file_binary, filename)
-        )
+                    writeoff_date, file_data, filename, context=None):
+        document = self._put_document(file_data, filename)
+        with self._db.transaction():
+            new_id = self._db.call_function_scalar(
+                'create_writeoff',
+                (object_id, theme_id, quantity,
+                writeoff_date, self._file_param(file_data), filename)
+            )
+            self._attach_document('writeoff', new_id, document, context)
         return {'id': new_id}
 
     def update_writeoff(self, writeoff_id, object_id, theme_id,
-                        quantity, writeoff_date, file_data, filename):
-        file_binary = psycopg2.Binary(file_data) if file_data else None
+                        quantity, writeoff_date, file_data, filename,
+                        context=None):
         result = self._db.call_function_scalar(
             'update_writeoff',
             (writeoff_id, object_id, theme_id, quantity,
-            writeoff_date, file_binary, filename)
+            writeoff_date, self._file_param(file_data), filename)
+        )
+        self._store_document(
+            'writeoff', writeoff_id, file_data, filename, context
         )
         return {'success': result}
 
+    def patch_writeoff(self, writeoff_id, changes, file_data=None,
+                       filename=None, context=None):
+        """Изменяет только переданные значения списания
+        (patch_writeoff, migrations/008).
+        """
+        if not changes and not file_data:
+            return dict(self.UNCHANGED)
+        binary = self._file_param(file_data)
+        result = self._db.call_function_scalar(
+            'patch_writeoff',
+            (writeoff_id, Json(changes), binary,
+             filename if binary else None)
+        )
+        if not result['success']:
+            raise ValueError('Writeoff not found')
+        if file_data and self._blob_store is not None:
+            self._store_document(
+                'writeoff', writeoff_id, file_data, filename, context
+            )
+            result['changed'] = True
+        return result
+
     def delete_writeoff(self, writeoff_id):
-        result = self._db.call_function_scalar('delete_writeoff', (writeoff_id,))
-        return {'success': result}
+        result = self._db.call_function_scalar('delete_writeoff_audited', (writeoff_id,))
+        self._detach_documents([('writeoff', writeoff_id)])
+        return result
 
 class UserManager:
     def __init__(self, db: Database):
@@ -149,16 +303,14 @@ class UserManager:
         return {'id': new_id}
 
     def update_user(self, user_id, username, admin):
-        result = self._db.call_function_scalar('update_user', (user_id, username, admin))
-        return {'success': result}
+        return self._db.call_function_scalar('update_user_audited', (user_id, username, admin))
 
     def update_user_password(self, user_id, password_hash):
         result = self._db.call_function_scalar('update_user_password', (user_id, password_hash))
         return {'success': result}
 
     def delete_user(self, user_id):
-        result = self._db.call_function_scalar('delete_user', (user_id,))
-        return {'success': result}
+        return self._db.call_function_scalar('delete_user_audited', (user_id,))
     
 class PricingManager:
     def __init__(self, db: Database):
@@ -172,12 +324,10 @@ class PricingManager:
         return {'id': new_id}
 
     def update_pricing(self, pricing_id, price, tax):
-        result = self._db.call_function_scalar(
-            'update_pricing',
+        return self._db.call_function_scalar(
+            'update_pricing_audited',
             (pricing_id, price, tax)
         )
-        return {'success': result}
 
     def delete_pricing(self, pricing_id):
-        result = self._db.call_function_scalar('delete_pricing', (pricing_id,))
-        return {'success': result}
\ No newline at end of file
+        return self._db.call_function_scalar('delete_pricing_audited', (pricing_id,))
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def deep_size(obj, seen=None):
+    """Приблизительный размер объекта вместе с вложенными контейнерами."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def process_memory():
+    """RSS процесса (Linux) в байтах."""
+    try:
+        with open('/proc/self/status', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+class MemoryTracker:
+    """Учёт памяти по подсистемам и снимки tracemalloc."""
+
+    def __init__(self):
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._snapshots = []
+
+    def register(self, name, function):
+        """function() возвращает словарь, где bytes — занятая память."""
+        self._sources[name] = function
+
+    def report(self):
+        subsystems = {}
+        for name, function in self._sources.items():
+            try:
+                subsystems[name] = function()
+            except Exception as e:
+                subsystems[name] = {'error': str(e)}
+        accounted = sum(
+            item.get('bytes') or 0 for item in subsystems.values()
+        )
+        return {
+            'rss': process_memory(),
+            'accounted': accounted,
+            'subsystems': subsystems,
+            'tracemalloc': self.tracemalloc_status()
+        }
+
+    # ==================== TRACEMALLOC ====================
+    def tracemalloc_status(self):
+        status = {
+            'tracing': tracemalloc.is_tracing(),
+            'snapshots': [
+                {'taken_at': taken_at} for taken_at, _ in self._snapshots
+            ]
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            status.update({'current': current, 'peak': peak})
+        return status
+
+    def start(self, frames=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return self.tracemalloc_status()
+
+    def stop(self):
+        with self._lock:
+            self._snapshots = []
+        tracemalloc.stop()
+        return self.tracemalloc_status()
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            raise ValueError('tracemalloc is not running')
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        with self._lock:
+            # Храним два последних снимка для сравнения
+            self._snapshots = (
+                self._snapshots + [(time.time(), snapshot)]
+            )[-2:]
+        return self.tracemalloc_status()
+
+    def top(self, limit=20, key_type='lineno'):
+        with self._lock:
+            snapshots = list(self._snapshots)
+        if not snapshots:
+            raise ValueError('No tracemalloc snapshots')
+
+        latest = snapshots[-1][1]
+        result = {
+            'top': [
+                {
+                    'site': self._site(stat.traceback),
+                    'size': stat.size,
+                    'count': stat.count
+                }
+                for stat in latest.statistics(key_type)[:limit]
+            ]
+        }
+        if len(snapshots) == 2:
+            result['diff'] = [
+                {
+                    'site': self._site(stat.traceback),
+                    'size': stat.size,
+                    'size_diff': stat.size_diff,
+                    'count_diff': stat.count_diff
+                }
+                for stat in latest.compare_to(
+                    snapshots[0][1], key_type
+                )[:limit]
+            ]
+        return result
+
+    @staticmethod
+    def _site(traceback):
+        frame = traceback[0]
+        return f'{os.path.relpath(frame.filename)}:{frame.lineno}'
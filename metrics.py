@@ -0,0 +1,225 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+            for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """Значение считывается функцией в момент выгрузки метрик."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+        self._function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            value = self._function()
+            if value is None:
+                return []
+            items = [((), value)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [
+            f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам..., +Inf, сумма]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = \
+                    [0] * (len(self._buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in
+                     self._values.items()]
+        lines = self.header()
+        bounds = self._buckets + (float('inf'),)
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(
+                    f'{self.name}_bucket{_labels(self.labels, key, le)} '
+                    f'{total}'
+                )
+            lines.append(
+                f'{self.name}_sum{_labels(self.labels, key)} '
+                f'{_number(counts[-1])}'
+            )
+            lines.append(
+                f'{self.name}_count{_labels(self.labels, key)} {total}'
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'http_requests_total', 'HTTP requests by route and status',
+    ('method', 'route', 'status')
+)
+HTTP_DURATION = REGISTRY.histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    ('method', 'route')
+)
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    'http_requests_in_flight', 'HTTP requests being processed'
+)
+HTTP_BODY_BYTES = REGISTRY.gauge(
+    'http_request_body_bytes_in_memory',
+    'Request bodies currently held in memory'
+)
+HTTP_RESPONSE_BYTES = REGISTRY.gauge(
+    'http_response_bytes_buffered',
+    'Encoded responses currently buffered before sending'
+)
+HTTP_BYTES_IN = REGISTRY.counter(
+    'http_request_bytes_total', 'Request body bytes received (uploads)',
+    ('route',)
+)
+HTTP_BYTES_OUT = REGISTRY.counter(
+    'http_response_bytes_total', 'Response bytes sent (downloads)',
+    ('route',)
+)
+DB_DURATION = REGISTRY.histogram(
+    'db_function_duration_seconds', 'Database function call latency',
+    ('function',)
+)
+DB_ERRORS = REGISTRY.counter(
+    'db_function_errors_total', 'Database function call errors',
+    ('function',)
+)
+DB_CONNECTIONS = REGISTRY.gauge(
+    'db_connections_open', 'Open database connections'
+)
+SESSIONS = REGISTRY.gauge(
+    'sessions_active', 'Active sessions in the session store'
+)
+THREADS = REGISTRY.gauge(
+    'server_threads', 'Live server threads',
+    function=threading.active_count
+)
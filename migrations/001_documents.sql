@@ -0,0 +1,121 @@
+-- Метаданные документов, содержимое которых хранится вне БД.
+-- (kind, owner_id) совпадают с аргументами get_file(file_type, file_id).
+
+CREATE TABLE IF NOT EXISTS documents (
+    kind VARCHAR(32) NOT NULL,
+    owner_id INTEGER NOT NULL,
+    sha256 CHAR(64) NOT NULL,
+    size BIGINT NOT NULL,
+    filename TEXT,
+    content_type VARCHAR(255),
+    uploaded_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, owner_id)
+);
+
+CREATE INDEX IF NOT EXISTS documents_sha256_idx ON documents (sha256);
+
+CREATE OR REPLACE FUNCTION attach_document(
+    p_kind VARCHAR, p_owner_id INTEGER, p_sha256 CHAR(64),
+    p_size BIGINT, p_filename TEXT, p_content_type VARCHAR
+) RETURNS CHAR(64) AS $$
+DECLARE
+    v_old CHAR(64);
+BEGIN
+    SELECT sha256 INTO v_old FROM documents
+    WHERE kind = p_kind AND owner_id = p_owner_id;
+
+    INSERT INTO documents (kind, owner_id, sha256, size,
+                           filename, content_type, uploaded_at)
+    VALUES (p_kind, p_owner_id, p_sha256, p_size,
+            p_filename, p_content_type, now())
+    ON CONFLICT (kind, owner_id) DO UPDATE SET
+        sha256 = EXCLUDED.sha256,
+        size = EXCLUDED.size,
+        filename = EXCLUDED.filename,
+        content_type = EXCLUDED.content_type,
+        uploaded_at = EXCLUDED.uploaded_at;
+
+    RETURN v_old;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION detach_document(
+    p_kind VARCHAR, p_owner_id INTEGER
+) RETURNS CHAR(64) AS $$
+    DELETE FROM documents
+    WHERE kind = p_kind AND owner_id = p_owner_id
+    RETURNING sha256;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION get_document(
+    p_kind VARCHAR, p_owner_id INTEGER
+) RETURNS SETOF documents AS $$
+    SELECT * FROM documents
+    WHERE kind = p_kind AND owner_id = p_owner_id;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION get_documents_by_owners(
+    p_kind VARCHAR, p_owner_ids INTEGER[]
+) RETURNS SETOF documents AS $$
+    SELECT * FROM documents
+    WHERE kind = p_kind AND owner_id = ANY(p_owner_ids);
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION get_document_hashes()
+RETURNS TABLE (sha256 CHAR(64)) AS $$
+    SELECT DISTINCT d.sha256 FROM documents d;
+$$ LANGUAGE sql STABLE;
+
+-- Обнуляет bytea-колонку после переноса содержимого в хранилище.
+-- Таблицы и колонки соответствуют функции get_file из init_db.sql.
+CREATE OR REPLACE FUNCTION clear_legacy_file(
+    p_kind VARCHAR, p_owner_id INTEGER
+) RETURNS BOOLEAN AS $$
+BEGIN
+    IF p_kind = 'bill' THEN
+        UPDATE bills SET file = NULL WHERE id = p_owner_id;
+    ELSIF p_kind = 'invoice' THEN
+        UPDATE invoices SET file = NULL WHERE id = p_owner_id;
+    ELSIF p_kind = 'entry_control' THEN
+        UPDATE entry_control SET file = NULL WHERE id = p_owner_id;
+    ELSIF p_kind = 'writeoff' THEN
+        UPDATE writeoffs SET document = NULL WHERE id = p_owner_id;
+    ELSE
+        RETURN FALSE;
+    END IF;
+    RETURN FOUND;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Привязка документа при переносе из bytea: только если у владельца
+-- ещё нет документа, загруженного пользователем. Возвращает TRUE,
+-- если строка добавлена.
+CREATE OR REPLACE FUNCTION attach_legacy_document(
+    p_kind VARCHAR, p_owner_id INTEGER, p_sha256 CHAR(64),
+    p_size BIGINT, p_filename TEXT, p_content_type VARCHAR
+) RETURNS BOOLEAN AS $$
+    WITH inserted AS (
+        INSERT INTO documents (kind, owner_id, sha256, size,
+                               filename, content_type, uploaded_at)
+        VALUES (p_kind, p_owner_id, p_sha256, p_size,
+                p_filename, p_content_type, now())
+        ON CONFLICT (kind, owner_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM inserted);
+$$ LANGUAGE sql;
+
+-- Документы, содержимое которых ещё лежит в bytea-колонках.
+CREATE OR REPLACE FUNCTION get_legacy_documents(p_limit INTEGER)
+RETURNS TABLE (kind VARCHAR, owner_id INTEGER) AS $$
+    SELECT 'bill'::VARCHAR, id FROM bills WHERE file IS NOT NULL
+    UNION ALL
+    SELECT 'invoice'::VARCHAR, id FROM invoices WHERE file IS NOT NULL
+    UNION ALL
+    SELECT 'entry_control'::VARCHAR, id FROM entry_control
+    WHERE file IS NOT NULL
+    UNION ALL
+    SELECT 'writeoff'::VARCHAR, id FROM writeoffs
+    WHERE document IS NOT NULL
+    LIMIT p_limit;
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,50 @@
+-- Каталог метаданных документов: списки и карточки объектов
+-- читают только эту таблицу, содержимое файлов — только /api/file/.
+
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS id BIGSERIAL;
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS uploader_id INTEGER;
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS uploader VARCHAR(255);
+
+CREATE UNIQUE INDEX IF NOT EXISTS documents_id_idx ON documents (id);
+
+DROP FUNCTION IF EXISTS attach_document(
+    VARCHAR, INTEGER, CHAR, BIGINT, TEXT, VARCHAR
+);
+DROP FUNCTION IF EXISTS get_documents_by_owners(VARCHAR, INTEGER[]);
+
+CREATE OR REPLACE FUNCTION attach_document(
+    p_kind VARCHAR, p_owner_id INTEGER, p_sha256 CHAR(64),
+    p_size BIGINT, p_filename TEXT, p_content_type VARCHAR,
+    p_uploader_id INTEGER, p_uploader VARCHAR
+) RETURNS CHAR(64) AS $$
+DECLARE
+    v_old CHAR(64);
+BEGIN
+    SELECT sha256 INTO v_old FROM documents
+    WHERE kind = p_kind AND owner_id = p_owner_id;
+
+    INSERT INTO documents (kind, owner_id, sha256, size, filename,
+                           content_type, uploaded_at,
+                           uploader_id, uploader)
+    VALUES (p_kind, p_owner_id, p_sha256, p_size, p_filename,
+            p_content_type, now(), p_uploader_id, p_uploader)
+    ON CONFLICT (kind, owner_id) DO UPDATE SET
+        sha256 = EXCLUDED.sha256,
+        size = EXCLUDED.size,
+        filename = EXCLUDED.filename,
+        content_type = EXCLUDED.content_type,
+        uploaded_at = EXCLUDED.uploaded_at,
+        uploader_id = EXCLUDED.uploader_id,
+        uploader = EXCLUDED.uploader;
+
+    RETURN v_old;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION get_documents_by_keys(
+    p_kinds TEXT[], p_owner_ids INTEGER[]
+) RETURNS SETOF documents AS $$
+    SELECT d.* FROM documents d
+    JOIN unnest(p_kinds, p_owner_ids) AS k(kind, owner_id)
+        ON d.kind = k.kind AND d.owner_id = k.owner_id;
+$$ LANGUAGE sql STABLE;
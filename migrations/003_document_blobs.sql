@@ -0,0 +1,11 @@
+-- Уникальные блобы с исходным размером: для сборщика мусора
+-- и отчёта о сжатии.
+
+DROP FUNCTION IF EXISTS get_document_hashes();
+
+CREATE OR REPLACE FUNCTION get_document_blobs()
+RETURNS TABLE (sha256 CHAR(64), size BIGINT) AS $$
+    SELECT DISTINCT ON (d.sha256) d.sha256, d.size
+    FROM documents d
+    ORDER BY d.sha256;
+$$ LANGUAGE sql STABLE;
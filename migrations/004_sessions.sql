@@ -0,0 +1,67 @@
+-- Сессии пользователей для PostgresSessionBackend.
+-- session_key — SHA-256 от идентификатора сессии из cookie.
+
+CREATE TABLE IF NOT EXISTS sessions (
+    session_key CHAR(64) PRIMARY KEY,
+    user_data JSONB NOT NULL,
+    created_at DOUBLE PRECISION NOT NULL,
+    expires_at DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_expires_at_idx
+    ON sessions (expires_at);
+
+CREATE OR REPLACE FUNCTION save_session(
+    p_key CHAR(64), p_user_data JSONB,
+    p_created_at DOUBLE PRECISION, p_expires_at DOUBLE PRECISION
+) RETURNS VOID AS $$
+    INSERT INTO sessions (session_key, user_data, created_at, expires_at)
+    VALUES (p_key, p_user_data, p_created_at, p_expires_at)
+    ON CONFLICT (session_key) DO UPDATE SET
+        user_data = EXCLUDED.user_data,
+        expires_at = EXCLUDED.expires_at;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION get_session_record(p_key CHAR(64))
+RETURNS SETOF sessions AS $$
+    SELECT * FROM sessions
+    WHERE session_key = p_key
+      AND expires_at > extract(epoch FROM now());
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION load_sessions()
+RETURNS SETOF sessions AS $$
+    SELECT * FROM sessions
+    WHERE expires_at > extract(epoch FROM now())
+    ORDER BY expires_at;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION delete_sessions(p_keys TEXT[])
+RETURNS INTEGER AS $$
+    WITH deleted AS (
+        DELETE FROM sessions WHERE session_key = ANY(p_keys)
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER FROM deleted;
+$$ LANGUAGE sql;
+
+-- Все сессии пользователя, в том числе созданные другими
+-- экземплярами сервера (смена пароля, удаление пользователя).
+CREATE OR REPLACE FUNCTION delete_user_sessions(p_user_id INTEGER)
+RETURNS INTEGER AS $$
+    WITH deleted AS (
+        DELETE FROM sessions WHERE (user_data->>'id')::INTEGER = p_user_id
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER FROM deleted;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION delete_expired_sessions()
+RETURNS INTEGER AS $$
+    WITH deleted AS (
+        DELETE FROM sessions
+        WHERE expires_at <= extract(epoch FROM now())
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER FROM deleted;
+$$ LANGUAGE sql;
@@ -0,0 +1,32 @@
+-- Отозванные подписанные токены сессий (TokenSessionManager).
+-- Записи с user_id отзывают все токены пользователя,
+-- выданные до revoked_at.
+
+CREATE TABLE IF NOT EXISTS session_denylist (
+    token_id VARCHAR(64) PRIMARY KEY,
+    user_id INTEGER,
+    revoked_at DOUBLE PRECISION NOT NULL,
+    expires_at DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS session_denylist_expires_at_idx
+    ON session_denylist (expires_at);
+
+CREATE OR REPLACE FUNCTION deny_session_token(
+    p_token_id VARCHAR(64), p_user_id INTEGER,
+    p_revoked_at DOUBLE PRECISION, p_expires_at DOUBLE PRECISION
+) RETURNS VOID AS $$
+    INSERT INTO session_denylist (token_id, user_id, revoked_at, expires_at)
+    VALUES (p_token_id, p_user_id, p_revoked_at, p_expires_at)
+    ON CONFLICT (token_id) DO UPDATE SET
+        revoked_at = EXCLUDED.revoked_at,
+        expires_at = EXCLUDED.expires_at;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION get_session_denylist()
+RETURNS SETOF session_denylist AS $$
+    DELETE FROM session_denylist
+    WHERE expires_at <= extract(epoch FROM now());
+
+    SELECT * FROM session_denylist;
+$$ LANGUAGE sql;
@@ -0,0 +1,28 @@
+-- Хэши PBKDF2/scrypt длиннее 64 символов SHA-256.
+-- Проверка пароля перенесена на сервер приложения: функция
+-- возвращает сохранённый хэш по имени пользователя.
+
+-- ALTER берёт ACCESS EXCLUSIVE на users: только если тип ещё не TEXT
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'users'
+            AND column_name = 'password_hash' AND data_type <> 'text'
+    ) THEN
+        ALTER TABLE users ALTER COLUMN password_hash TYPE TEXT;
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION get_user_credentials(p_username VARCHAR)
+RETURNS TABLE (
+    id INTEGER,
+    username VARCHAR,
+    admin BOOLEAN,
+    password_hash TEXT
+) AS $$
+    SELECT u.id, u.username::VARCHAR, u.admin, u.password_hash::TEXT
+    FROM users u
+    WHERE u.username = p_username;
+$$ LANGUAGE sql STABLE;
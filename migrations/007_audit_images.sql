@@ -0,0 +1,206 @@
+-- Изменение и удаление с образами строк для журнала действий.
+-- Каждая функция *_audited за один запрос снимает строку до
+-- изменения, вызывает исходную функцию update_*/delete_* и снимает
+-- строку после. Результат — jsonb:
+--     {"success": ..., "old": {...}, "new": {...}, ...}
+-- Образы строятся теми же функциями get_*_by_id, что и чтение
+-- из приложения, поэтому ключи совпадают с колонками их строк.
+-- Значения в DECLARE вычисляются по порядку объявления: образ "до"
+-- всегда снимается раньше вызова изменяющей функции.
+
+CREATE OR REPLACE FUNCTION row_image(p_getter TEXT, p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_image JSONB;
+BEGIN
+    IF p_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+    EXECUTE format('SELECT to_jsonb(r) FROM %I($1) r LIMIT 1', p_getter)
+        INTO v_image USING p_id;
+    RETURN v_image;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION row_images(p_getter TEXT, p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_images JSONB;
+BEGIN
+    EXECUTE format(
+        'SELECT coalesce(jsonb_agg(to_jsonb(r)), ''[]''::jsonb) '
+        'FROM %I($1) r', p_getter
+    ) INTO v_images USING p_id;
+    RETURN v_images;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Objects
+CREATE OR REPLACE FUNCTION update_object_audited(
+    p_id INTEGER, p_name VARCHAR
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_object_by_id', p_id);
+    v_success JSONB := to_jsonb(update_object(p_id, p_name));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'new', row_image('get_object_by_id', p_id)
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_object_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_object_by_id', p_id);
+    v_receipts JSONB := row_images('get_receipts_by_object', p_id);
+    v_writeoffs JSONB := row_images('get_writeoffs_by_object', p_id);
+    v_success JSONB := to_jsonb(delete_object(p_id));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'receipts', v_receipts, 'writeoffs', v_writeoffs
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Sellers
+CREATE OR REPLACE FUNCTION update_seller_audited(
+    p_id INTEGER, p_name VARCHAR, p_inn VARCHAR, p_kpp VARCHAR
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_seller_by_id', p_id);
+    v_success JSONB := to_jsonb(update_seller(p_id, p_name, p_inn, p_kpp));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'new', row_image('get_seller_by_id', p_id)
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_seller_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_seller_by_id', p_id);
+    v_success JSONB := to_jsonb(delete_seller(p_id));
+BEGIN
+    RETURN jsonb_build_object('success', v_success, 'old', v_old);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Themes
+CREATE OR REPLACE FUNCTION update_theme_audited(
+    p_id INTEGER, p_name VARCHAR
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_theme_by_id', p_id);
+    v_success JSONB := to_jsonb(update_theme(p_id, p_name));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'new', row_image('get_theme_by_id', p_id)
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_theme_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_theme_by_id', p_id);
+    v_success JSONB := to_jsonb(delete_theme(p_id));
+BEGIN
+    RETURN jsonb_build_object('success', v_success, 'old', v_old);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Receipts and write-offs
+CREATE OR REPLACE FUNCTION delete_receipt_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_receipt_by_id', p_id);
+    v_object JSONB := row_image(
+        'get_object_by_id', (v_old->>'object_id')::INTEGER
+    );
+    v_success JSONB := to_jsonb(delete_receipt(p_id));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old, 'object', v_object
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_writeoff_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_writeoff_by_id', p_id);
+    v_success JSONB := to_jsonb(delete_writeoff(p_id));
+BEGIN
+    RETURN jsonb_build_object('success', v_success, 'old', v_old);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Pricing: объект для журнала берётся по цепочке цена -> поступление
+CREATE OR REPLACE FUNCTION pricing_object_image(p_pricing JSONB)
+RETURNS JSONB AS $$
+    SELECT row_image(
+        'get_object_by_id',
+        (row_image(
+            'get_receipt_by_id', (p_pricing->>'receipt_id')::INTEGER
+        )->>'object_id')::INTEGER
+    );
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION update_pricing_audited(
+    p_id INTEGER, p_price NUMERIC, p_tax NUMERIC
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_pricing_by_id', p_id);
+    v_object JSONB := pricing_object_image(v_old);
+    v_success JSONB := to_jsonb(update_pricing(p_id, p_price, p_tax));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'new', row_image('get_pricing_by_id', p_id), 'object', v_object
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_pricing_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_pricing_by_id', p_id);
+    v_object JSONB := pricing_object_image(v_old);
+    v_success JSONB := to_jsonb(delete_pricing(p_id));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old, 'object', v_object
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Users
+CREATE OR REPLACE FUNCTION update_user_audited(
+    p_id INTEGER, p_username VARCHAR, p_admin BOOLEAN
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_user_by_id', p_id) - 'password_hash';
+    v_success JSONB := to_jsonb(update_user(p_id, p_username, p_admin));
+BEGIN
+    RETURN jsonb_build_object(
+        'success', v_success, 'old', v_old,
+        'new', row_image('get_user_by_id', p_id) - 'password_hash'
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION delete_user_audited(p_id INTEGER)
+RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB := row_image('get_user_by_id', p_id) - 'password_hash';
+    v_success JSONB := to_jsonb(delete_user(p_id));
+BEGIN
+    RETURN jsonb_build_object('success', v_success, 'old', v_old);
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,205 @@
+-- Частичное изменение поступлений и списаний (PATCH).
+-- p_changes содержит только изменённые значения в ключах строки
+-- get_receipt_by_id / get_writeoff_by_id (для поступления — и номера
+-- и даты документов). Значения, совпадающие с текущими, отбрасываются;
+-- остальные записываются UPDATE только своих колонок и только в те
+-- таблицы, которых они касаются: счёт, накладная и вх. контроль
+-- не трогаются, если у них не изменились номер и дата и нет нового
+-- файла. Колонки файла меняются только вместе с новым файлом.
+-- Результат — jsonb как у функций *_audited (007):
+--     {"success", "changed", "old", "new", "object"}
+
+DROP FUNCTION IF EXISTS patch_receipt(INTEGER, JSONB);
+DROP FUNCTION IF EXISTS patch_writeoff(INTEGER, JSONB);
+
+-- Первая из колонок-кандидатов, которая есть в таблице, или NULL.
+-- Ключи образа строки и колонки таблиц документов могут отличаться
+-- префиксом (bill_number / number), поэтому имя ищется по списку.
+CREATE OR REPLACE FUNCTION patch_column(
+    p_table REGCLASS, VARIADIC p_candidates TEXT[]
+) RETURNS TEXT AS $$
+    SELECT a.attname::TEXT
+    FROM pg_attribute a
+    WHERE a.attrelid = p_table AND a.attnum > 0 AND NOT a.attisdropped
+        AND a.attname = ANY(p_candidates)
+    ORDER BY array_position(p_candidates, a.attname::TEXT)
+    LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
+-- Значения p_changes, отличающиеся от образа p_old, с ключами,
+-- начинающимися с p_prefix; в результате ключи — колонки p_table.
+CREATE OR REPLACE FUNCTION patch_values(
+    p_table REGCLASS, p_old JSONB, p_changes JSONB, p_prefix TEXT
+) RETURNS JSONB AS $$
+DECLARE
+    v_values JSONB := '{}'::jsonb;
+    v_column TEXT;
+    v_change RECORD;
+BEGIN
+    FOR v_change IN
+        SELECT key, value FROM jsonb_each(p_changes)
+        WHERE starts_with(key, p_prefix)
+            AND p_old->key IS DISTINCT FROM value
+    LOOP
+        v_column := patch_column(
+            p_table, v_change.key,
+            substr(v_change.key, length(p_prefix) + 1)
+        );
+        IF v_column IS NULL THEN
+            RAISE EXCEPTION 'Unknown field: %', v_change.key;
+        END IF;
+        v_values := v_values ||
+            jsonb_build_object(v_column, v_change.value);
+    END LOOP;
+    RETURN v_values;
+END;
+$$ LANGUAGE plpgsql;
+
+-- UPDATE строки p_id только по колонкам из p_values; значения
+-- приводятся к типам колонок через jsonb_populate_record. Новый файл
+-- (p_file, p_filename) записывается в колонку p_file_column и первую
+-- найденную из p_filename_columns, только если он передан.
+CREATE OR REPLACE FUNCTION patch_row(
+    p_table REGCLASS, p_id INTEGER, p_values JSONB,
+    p_file BYTEA DEFAULT NULL, p_filename TEXT DEFAULT NULL,
+    p_file_column TEXT DEFAULT 'file',
+    p_filename_columns TEXT[] DEFAULT ARRAY['filename']
+) RETURNS VOID AS $$
+DECLARE
+    v_set TEXT;
+    v_filename_column TEXT;
+BEGIN
+    SELECT string_agg(format('%I = v.%I', key, key), ', ')
+    INTO v_set
+    FROM jsonb_object_keys(p_values) key;
+
+    IF p_file IS NOT NULL THEN
+        v_set := concat_ws(', ', v_set, format('%I = $3', p_file_column));
+        v_filename_column := patch_column(
+            p_table, VARIADIC p_filename_columns
+        );
+        IF v_filename_column IS NOT NULL THEN
+            v_set := v_set || format(', %I = $4', v_filename_column);
+        END IF;
+    END IF;
+    IF v_set IS NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format(
+        'UPDATE %s t SET %s FROM jsonb_populate_record(NULL::%s, $1) v '
+        'WHERE t.id = $2',
+        p_table, v_set, p_table
+    ) USING p_values, p_id, p_file, p_filename;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION patch_receipt(
+    p_id INTEGER, p_changes JSONB,
+    p_bill_file BYTEA, p_bill_filename TEXT,
+    p_invoice_file BYTEA, p_invoice_filename TEXT,
+    p_ec_file BYTEA, p_ec_filename TEXT
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB;
+    v_receipt JSONB;
+    v_document RECORD;
+    v_values JSONB;
+    v_changed BOOLEAN := FALSE;
+BEGIN
+    PERFORM 1 FROM receipts WHERE id = p_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('success', FALSE, 'changed', FALSE);
+    END IF;
+    v_old := row_image('get_receipt_by_id', p_id);
+
+    -- Поля самого поступления — ключи без префикса документа
+    v_receipt := patch_values(
+        'receipts', v_old,
+        p_changes - ARRAY(
+            SELECT key FROM jsonb_object_keys(p_changes) key
+            WHERE key ~ '^(bill|invoice|entry_control)_'
+        ),
+        ''
+    );
+    IF v_receipt <> '{}'::jsonb THEN
+        PERFORM patch_row('receipts', p_id, v_receipt);
+        v_changed := TRUE;
+    END IF;
+
+    FOR v_document IN
+        SELECT * FROM (VALUES
+            ('bills'::REGCLASS, 'bill_', p_bill_file, p_bill_filename),
+            ('invoices'::REGCLASS, 'invoice_', p_invoice_file,
+             p_invoice_filename),
+            ('entry_control'::REGCLASS, 'entry_control_', p_ec_file,
+             p_ec_filename)
+        ) AS d(doc_table, prefix, file, filename)
+    LOOP
+        v_values := patch_values(
+            v_document.doc_table, v_old, p_changes, v_document.prefix
+        );
+        IF v_values = '{}'::jsonb AND v_document.file IS NULL THEN
+            CONTINUE;
+        END IF;
+        IF v_old->>(v_document.prefix || 'id') IS NULL THEN
+            RAISE EXCEPTION 'Receipt % has no row in %',
+                p_id, v_document.doc_table;
+        END IF;
+        PERFORM patch_row(
+            v_document.doc_table,
+            (v_old->>(v_document.prefix || 'id'))::INTEGER,
+            v_values, v_document.file, v_document.filename, 'file',
+            ARRAY['filename', v_document.prefix || 'filename']
+        );
+        v_changed := TRUE;
+    END LOOP;
+
+    RETURN jsonb_build_object(
+        'success', TRUE, 'changed', v_changed, 'old', v_old,
+        'new', CASE WHEN v_changed
+                    THEN row_image('get_receipt_by_id', p_id)
+                    ELSE v_old END,
+        'object', row_image(
+            'get_object_by_id',
+            coalesce(v_receipt->>'object_id', v_old->>'object_id')::INTEGER
+        )
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION patch_writeoff(
+    p_id INTEGER, p_changes JSONB, p_file BYTEA, p_filename TEXT
+) RETURNS JSONB AS $$
+DECLARE
+    v_old JSONB;
+    v_values JSONB;
+    v_changed BOOLEAN;
+BEGIN
+    PERFORM 1 FROM writeoffs WHERE id = p_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('success', FALSE, 'changed', FALSE);
+    END IF;
+    v_old := row_image('get_writeoff_by_id', p_id);
+    v_values := patch_values('writeoffs', v_old, p_changes, '');
+    v_changed := v_values <> '{}'::jsonb OR p_file IS NOT NULL;
+
+    IF v_changed THEN
+        PERFORM patch_row(
+            'writeoffs', p_id, v_values, p_file, p_filename, 'document',
+            ARRAY['document_filename', 'filename']
+        );
+    END IF;
+
+    RETURN jsonb_build_object(
+        'success', TRUE, 'changed', v_changed, 'old', v_old,
+        'new', CASE WHEN v_changed
+                    THEN row_image('get_writeoff_by_id', p_id)
+                    ELSE v_old END,
+        'object', row_image(
+            'get_object_by_id',
+            coalesce(v_values->>'object_id', v_old->>'object_id')::INTEGER
+        )
+    );
+END;
+$$ LANGUAGE plpgsql;
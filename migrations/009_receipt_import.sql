@@ -0,0 +1,200 @@
+-- Массовый импорт поступлений из CSV/XLSX.
+-- Проверенные строки файла загружаются COPY в промежуточную таблицу
+-- (UNLOGGED: не пишет WAL, при сбое сервера содержимое теряется —
+-- импорт в этом случае просто повторяют). Затем одной транзакцией
+-- (import_receipts) создаются недостающие объекты, поставщики и темы,
+-- документы и поступления: при ошибке не остаётся ничего, и импорт
+-- того же файла можно повторить без дублей.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS import_rows (
+    import_id VARCHAR(32) NOT NULL,
+    line INTEGER NOT NULL,
+    object_name TEXT NOT NULL,
+    seller_object_name TEXT,
+    seller_name TEXT NOT NULL,
+    seller_inn TEXT,
+    seller_kpp TEXT,
+    theme_name TEXT NOT NULL,
+    location TEXT,
+    quantity INTEGER NOT NULL,
+    bill_number TEXT,
+    bill_date DATE,
+    invoice_number TEXT,
+    invoice_date DATE,
+    entry_control_number TEXT,
+    entry_control_date DATE,
+    price NUMERIC,
+    tax NUMERIC,
+    object_id INTEGER,
+    seller_id INTEGER,
+    theme_id INTEGER,
+    bill_id INTEGER,
+    invoice_id INTEGER,
+    entry_control_id INTEGER,
+    receipt_id INTEGER,
+    PRIMARY KEY (import_id, line)
+);
+
+ALTER TABLE import_rows ADD COLUMN IF NOT EXISTS bill_id INTEGER;
+ALTER TABLE import_rows ADD COLUMN IF NOT EXISTS invoice_id INTEGER;
+ALTER TABLE import_rows ADD COLUMN IF NOT EXISTS entry_control_id INTEGER;
+
+DROP FUNCTION IF EXISTS import_receipts(VARCHAR, INTEGER);
+
+-- Создаёт недостающие объекты, поставщиков и темы (названия
+-- сравниваются без учёта регистра и крайних пробелов) и проставляет
+-- их id в строках импорта. Возвращает число созданных записей.
+CREATE OR REPLACE FUNCTION import_resolve_names(p_import_id VARCHAR)
+RETURNS JSONB AS $$
+DECLARE
+    v_objects INTEGER := 0;
+    v_sellers INTEGER := 0;
+    v_themes INTEGER := 0;
+    v_row RECORD;
+BEGIN
+    FOR v_row IN
+        SELECT min(btrim(r.object_name)) AS name
+        FROM import_rows r
+        WHERE r.import_id = p_import_id
+            AND lower(btrim(r.object_name)) NOT IN (
+                SELECT lower(btrim(o.objectname)) FROM get_all_objects() o
+                WHERE o.objectname IS NOT NULL
+            )
+        GROUP BY lower(btrim(r.object_name))
+    LOOP
+        PERFORM create_object(v_row.name);
+        v_objects := v_objects + 1;
+    END LOOP;
+
+    FOR v_row IN
+        SELECT min(btrim(r.seller_name)) AS name,
+               max(r.seller_inn) AS inn, max(r.seller_kpp) AS kpp
+        FROM import_rows r
+        WHERE r.import_id = p_import_id
+            AND lower(btrim(r.seller_name)) NOT IN (
+                SELECT lower(btrim(s.name)) FROM get_all_sellers() s
+                WHERE s.name IS NOT NULL
+            )
+        GROUP BY lower(btrim(r.seller_name))
+    LOOP
+        PERFORM create_seller(
+            v_row.name, coalesce(v_row.inn, ''), coalesce(v_row.kpp, '')
+        );
+        v_sellers := v_sellers + 1;
+    END LOOP;
+
+    FOR v_row IN
+        SELECT min(btrim(r.theme_name)) AS name
+        FROM import_rows r
+        WHERE r.import_id = p_import_id
+            AND lower(btrim(r.theme_name)) NOT IN (
+                SELECT lower(btrim(t.name)) FROM get_all_themes() t
+                WHERE t.name IS NOT NULL
+            )
+        GROUP BY lower(btrim(r.theme_name))
+    LOOP
+        PERFORM create_theme(v_row.name);
+        v_themes := v_themes + 1;
+    END LOOP;
+
+    UPDATE import_rows r SET
+        object_id = o.id
+    FROM (
+        SELECT DISTINCT ON (lower(btrim(objectname)))
+            lower(btrim(objectname)) AS name, id
+        FROM get_all_objects()
+        ORDER BY lower(btrim(objectname)), id
+    ) o
+    WHERE r.import_id = p_import_id
+        AND o.name = lower(btrim(r.object_name));
+
+    UPDATE import_rows r SET
+        seller_id = s.id
+    FROM (
+        SELECT DISTINCT ON (lower(btrim(name)))
+            lower(btrim(name)) AS name, id
+        FROM get_all_sellers()
+        ORDER BY lower(btrim(name)), id
+    ) s
+    WHERE r.import_id = p_import_id
+        AND s.name = lower(btrim(r.seller_name));
+
+    UPDATE import_rows r SET
+        theme_id = t.id
+    FROM (
+        SELECT DISTINCT ON (lower(btrim(name)))
+            lower(btrim(name)) AS name, id
+        FROM get_all_themes()
+        ORDER BY lower(btrim(name)), id
+    ) t
+    WHERE r.import_id = p_import_id
+        AND t.name = lower(btrim(r.theme_name));
+
+    RETURN jsonb_build_object(
+        'objects', v_objects, 'sellers', v_sellers, 'themes', v_themes
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Создаёт поступления из всех строк импорта так же, как форма
+-- add.html: счёт, накладная и вх. контроль на каждую строку,
+-- поступление и цена, если она указана. Вызывается одним запросом,
+-- поэтому выполняется в одной транзакции вместе с
+-- import_resolve_names. Возвращает
+--     {"created": {"objects", "sellers", "themes"}, "inserted": N}
+CREATE OR REPLACE FUNCTION import_receipts(p_import_id VARCHAR)
+RETURNS JSONB AS $$
+DECLARE
+    v_created JSONB := import_resolve_names(p_import_id);
+    v_inserted INTEGER;
+BEGIN
+    -- Все записи создаются функциями create_*, как из приложения:
+    -- таблиц нет в миграциях, и проверки этих функций не
+    -- дублируются здесь. Каждая вызывается один раз на строку внутри
+    -- одного UPDATE. Счёт нужен накладной, поэтому порядок важен.
+    UPDATE import_rows SET
+        bill_id = create_bill(
+            coalesce(bill_number, ''), bill_date, seller_id, NULL, NULL
+        )
+    WHERE import_id = p_import_id;
+
+    UPDATE import_rows SET
+        invoice_id = create_invoice(
+            coalesce(invoice_number, ''), invoice_date,
+            seller_id, bill_id, NULL, NULL
+        ),
+        entry_control_id = create_entry_control(
+            coalesce(entry_control_number, ''), entry_control_date,
+            NULL, NULL
+        )
+    WHERE import_id = p_import_id;
+
+    -- Поступления — той же create_receipt, что и форма: её id
+    -- записывается прямо в строку импорта
+    UPDATE import_rows SET
+        receipt_id = create_receipt(
+            object_id, coalesce(seller_object_name, ''), seller_id,
+            bill_id, theme_id, invoice_id, entry_control_id,
+            coalesce(location, ''), quantity
+        )
+    WHERE import_id = p_import_id;
+    GET DIAGNOSTICS v_inserted = ROW_COUNT;
+
+    PERFORM create_pricing(receipt_id, price, tax)
+    FROM import_rows
+    WHERE import_id = p_import_id AND price > 0;
+
+    RETURN jsonb_build_object(
+        'created', v_created, 'inserted', v_inserted
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION import_cleanup(p_import_id VARCHAR)
+RETURNS INTEGER AS $$
+    WITH removed AS (
+        DELETE FROM import_rows WHERE import_id = p_import_id
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER FROM removed;
+$$ LANGUAGE sql;
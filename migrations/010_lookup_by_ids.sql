@@ -0,0 +1,87 @@
+-- Выборка для многих id одним запросом: get_receipts_by_objects,
+-- get_writeoffs_by_objects и get_pricing_by_receipts принимают
+-- INTEGER[] и возвращают те же строки, что функции от одного id.
+--
+-- Функции от одного id описаны в init_db.sql, которого нет среди
+-- миграций, поэтому их текст берётся из каталога: сравнение с
+-- параметром (= p_object_id или = $1) заменяется на = ANY(...), а
+-- тип результата, соединения и сортировка остаются прежними. Если
+-- параметр используется не только в таких сравнениях, текст не
+-- переписывается, и функция вызывает исходную для каждого id.
+
+CREATE OR REPLACE FUNCTION create_ids_function(
+    p_source TEXT, p_name TEXT
+) RETURNS BOOLEAN AS $$
+DECLARE
+    v_proc RECORD;
+    v_param TEXT;
+    v_pattern TEXT;
+    v_uses INTEGER;
+    v_comparisons INTEGER;
+    v_body TEXT;
+    v_rewritten BOOLEAN;
+    v_language TEXT;
+BEGIN
+    SELECT p.prosrc, p.proargnames, l.lanname,
+           pg_get_function_result(p.oid) AS result,
+           CASE p.provolatile WHEN 'i' THEN 'IMMUTABLE'
+                              WHEN 's' THEN 'STABLE'
+                              ELSE 'VOLATILE' END AS volatility
+    INTO v_proc
+    FROM pg_proc p
+    JOIN pg_language l ON l.oid = p.prolang
+    WHERE p.proname = p_source AND p.pronargs = 1
+    LIMIT 1;
+    IF NOT FOUND THEN
+        RAISE NOTICE 'Function % not found, % is not created',
+            p_source, p_name;
+        RETURN FALSE;
+    END IF;
+
+    v_param := coalesce(nullif(v_proc.proargnames[1], ''), '$1');
+    v_pattern := regexp_replace(v_param, '\$', '\\$') || '\M';
+    SELECT count(*) INTO v_uses
+    FROM regexp_matches(v_proc.prosrc, '(^|[^\w$])' || v_pattern, 'g');
+    -- Только "=", не "<=", ">=", "!=" и не ":="
+    SELECT count(*) INTO v_comparisons
+    FROM regexp_matches(
+        v_proc.prosrc, '([^<>!=:])=\s*' || v_pattern, 'g'
+    );
+
+    EXECUTE format('DROP FUNCTION IF EXISTS %I(INTEGER[])', p_name);
+    v_rewritten := v_uses > 0 AND v_uses = v_comparisons;
+    v_language := v_proc.lanname;
+    IF v_rewritten THEN
+        v_body := regexp_replace(
+            v_proc.prosrc, '([^<>!=:])=\s*' || v_pattern,
+            '\1= ANY(' || v_param || ')', 'g'
+        );
+    ELSE
+        v_body := format(
+            'SELECT f.* FROM unnest($1) AS ids(id) '
+            'CROSS JOIN LATERAL %I(ids.id) AS f', p_source
+        );
+        v_language := 'sql';
+        RAISE NOTICE '% is not rewritable, % calls it per id',
+            p_source, p_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE FUNCTION %I(%s INTEGER[]) RETURNS %s LANGUAGE %s %s AS %L',
+        p_name,
+        CASE WHEN v_param = '$1' THEN '' ELSE quote_ident(v_param) END,
+        v_proc.result, v_language, v_proc.volatility, v_body
+    );
+    RETURN v_rewritten;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_ids_function(
+    'get_receipts_by_object', 'get_receipts_by_objects'
+);
+SELECT create_ids_function(
+    'get_writeoffs_by_object', 'get_writeoffs_by_objects'
+);
+SELECT create_ids_function(
+    'get_pricing_by_receipt', 'get_pricing_by_receipts'
+);
@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+SALT_SIZE = 16
+LEGACY_HEX_LENGTH = 64
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _derive(algorithm, password, salt, params):
+    """Вычисляет ключ; вызывается в пуле потоков или процессов."""
+    password = password.encode('utf-8')
+    if algorithm == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac(
+            'sha256', password, salt, params['iterations']
+        )
+    if algorithm == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(
+            password, salt=salt, n=n, r=r, p=p,
+            maxmem=128 * r * n * 2, dklen=32
+        )
+    raise ValueError(f'Unknown password algorithm: {algorithm}')
+
+
+def _parse(stored):
+    """Разбирает сохранённый хэш: (алгоритм, параметры, соль, ключ)."""
+    if len(stored) == LEGACY_HEX_LENGTH and '$' not in stored:
+        return 'sha256', {}, b'', stored.lower()
+
+    parts = stored.split('$')
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        return (
+            parts[0], {'iterations': int(parts[1])},
+            _b64decode(parts[2]), _b64decode(parts[3])
+        )
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        return (
+            parts[0],
+            {'n': int(parts[1]), 'r': int(parts[2]), 'p': int(parts[3])},
+            _b64decode(parts[4]), _b64decode(parts[5])
+        )
+    raise ValueError('Unknown password hash format')
+
+
+def _format(algorithm, params, salt, key):
+    if algorithm == 'pbkdf2_sha256':
+        fields = [str(params['iterations'])]
+    else:
+        fields = [str(params['n']), str(params['r']), str(params['p'])]
+    return '$'.join([algorithm] + fields + [_b64encode(salt), _b64encode(key)])
+
+
+class PasswordHasher:
+    """Хэширование паролей PBKDF2/scrypt в отдельном пуле.
+
+    hashlib отпускает GIL на время PBKDF2 и scrypt, поэтому пула потоков
+    достаточно; пул процессов включается параметром executor.
+    Старые хэши SHA-256 (64 hex-символа) проверяются как раньше
+    и помечаются как требующие перехэширования.
+    """
+
+    def __init__(self, algorithm='pbkdf2_sha256', iterations=600000,
+                 scrypt_n=2 ** 15, scrypt_r=8, scrypt_p=1,
+                 workers=2, max_pending=32, executor='thread'):
+        if algorithm == 'pbkdf2_sha256':
+            self._params = {'iterations': iterations}
+        elif algorithm == 'scrypt':
+            self._params = {'n': scrypt_n, 'r': scrypt_r, 'p': scrypt_p}
+        else:
+            raise ValueError(f'Unknown password algorithm: {algorithm}')
+        self._algorithm = algorithm
+
+        if executor == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        elif executor == 'thread':
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='password'
+            )
+        else:
+            raise ValueError(f'Unknown password executor: {executor}')
+        # Ограничение очереди: при всплеске входов лишние запросы
+        # получают ошибку сразу, а не копятся в пуле.
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._dummy = self.hash(secrets.token_hex(8))
+
+    def _run(self, algorithm, password, salt, params):
+        if not self._pending.acquire(blocking=False):
+            raise ValueError(
+                'Слишком много одновременных входов, повторите попытку'
+            )
+        try:
+            return self._executor.submit(
+                _derive, algorithm, password, salt, params
+            ).result()
+        finally:
+            self._pending.release()
+
+    def hash(self, password):
+        salt = secrets.token_bytes(SALT_SIZE)
+        key = self._run(self._algorithm, password, salt, self._params)
+        return _format(self._algorithm, self._params, salt, key)
+
+    def verify(self, password, stored):
+        if not stored:
+            # Выравниваем время ответа для несуществующих пользователей
+            self.verify(password, self._dummy)
+            return False
+        try:
+            algorithm, params, salt, expected = _parse(stored)
+        except ValueError:
+            return False
+        if algorithm == 'sha256':
+            actual = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(actual, expected)
+        return hmac.compare_digest(
+            self._run(algorithm, password, salt, params), expected
+        )
+
+    def needs_rehash(self, stored):
+        try:
+            algorithm, params, _, _ = _parse(stored)
+        except ValueError:
+            return True
+        return algorithm != self._algorithm or params != self._params
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def create_password_hasher(config):
+    password_config = config.get('passwords') or {}
+    return PasswordHasher(
+        algorithm=password_config.get('algorithm', 'pbkdf2_sha256'),
+        iterations=password_config.get('iterations', 600000),
+        scrypt_n=password_config.get('scrypt_n', 2 ** 15),
+        scrypt_r=password_config.get('scrypt_r', 8),
+        scrypt_p=password_config.get('scrypt_p', 1),
+        workers=password_config.get('workers', 2),
+        max_pending=password_config.get('max_pending', 32),
+        executor=password_config.get('executor', 'thread')
+    )
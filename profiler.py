@@ -0,0 +1,211 @@
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from urllib.parse import urlsplit
+
+MAX_RESULTS = 10
+
+
+class Profiler:
+    """Профилирование по запросу администратора.
+
+    Режим route: cProfile для следующих N запросов маршрута.
+    Режим process: выборка стеков всех потоков в течение N секунд,
+    результат — collapsed stacks для flamegraph.pl / speedscope.
+
+    Пока профилирование не запущено, обработчик запросов не меняется:
+    обёртка ставится на класс только на время сеанса.
+    """
+
+    def __init__(self, handler_class, max_results=MAX_RESULTS):
+        self._handler_class = handler_class
+        self._original = None
+        self._lock = threading.Lock()
+        # Python 3.12+ допускает только один активный cProfile,
+        # поэтому профилируемые запросы выполняются по очереди
+        self._run_lock = threading.Lock()
+        self._session = None
+        self._results = OrderedDict()
+        self._max_results = max_results
+
+    # ==================== RESULTS ====================
+    def _store(self, name, content_type, data, info):
+        with self._lock:
+            self._results[name] = (content_type, data, info)
+            while len(self._results) > self._max_results:
+                self._results.popitem(last=False)
+
+    def memory_usage(self):
+        with self._lock:
+            return {
+                'results': len(self._results),
+                'bytes': sum(
+                    len(data) for _, data, _ in self._results.values()
+                )
+            }
+
+    def get_result(self, name):
+        with self._lock:
+            result = self._results.get(name)
+        if result is None:
+            raise ValueError('Profile not found')
+        return result
+
+    def status(self):
+        with self._lock:
+            session = dict(self._session) if self._session else None
+            results = [
+                dict(info, name=name, size=len(data))
+                for name, (_, data, info) in self._results.items()
+            ]
+        if session is not None:
+            session.pop('stats', None)
+            session.pop('thread', None)
+        return {'active': session, 'results': results}
+
+    # ==================== ROUTE MODE ====================
+    def profile_route(self, route, count):
+        if count <= 0:
+            raise ValueError('Invalid request count')
+        with self._lock:
+            if self._session is not None:
+                raise ValueError('Profiling is already running')
+            self._session = {
+                'mode': 'route', 'route': route, 'count': count,
+                'done': 0, 'started_at': time.time(), 'stats': None
+            }
+            self._original = self._handler_class.route_request
+            original = self._original
+            profiler = self
+
+            def route_request(handler, method):
+                # Остальные маршруты выполняются как обычно, без
+                # профилировщика и общей блокировки
+                route, _ = handler.router.match(
+                    method, urlsplit(handler.path).path
+                )
+                if route is None or not profiler._wants(route.name):
+                    return original(handler, method)
+                profile = cProfile.Profile()
+                with profiler._run_lock:
+                    try:
+                        profile.runcall(original, handler, method)
+                    finally:
+                        profiler._collect(handler.context.route, profile)
+
+            self._handler_class.route_request = route_request
+        return self.status()
+
+    def _wants(self, route):
+        with self._lock:
+            session = self._session
+            return session is not None and session['mode'] == 'route' \
+                and route == session['route'] \
+                and session['done'] < session['count']
+
+    def _collect(self, route, profile):
+        with self._lock:
+            session = self._session
+            if session is None or session['mode'] != 'route' or \
+                    route != session['route'] or \
+                    session['done'] >= session['count']:
+                return
+            if session['stats'] is None:
+                session['stats'] = pstats.Stats(profile)
+            else:
+                session['stats'].add(profile)
+            session['done'] += 1
+            finished = session['done'] >= session['count']
+        if finished:
+            self._finish_route()
+
+    def _finish_route(self):
+        with self._lock:
+            session, self._session = self._session, None
+            if self._original is not None:
+                self._handler_class.route_request = self._original
+                self._original = None
+        if session is None or session['stats'] is None:
+            return
+
+        stats = session['stats']
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(60)
+        info = {
+            'mode': 'route', 'route': session['route'],
+            'requests': session['done'], 'created_at': time.time()
+        }
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self._store(
+            f'route-{stamp}.pstats', 'application/octet-stream',
+            marshal.dumps(stats.stats), info
+        )
+        self._store(
+            f'route-{stamp}.txt', 'text/plain; charset=utf-8',
+            text.getvalue().encode('utf-8'), info
+        )
+
+    # ==================== PROCESS MODE ====================
+    def profile_process(self, seconds, interval=0.005):
+        if seconds <= 0 or seconds > 600:
+            raise ValueError('Invalid duration')
+        with self._lock:
+            if self._session is not None:
+                raise ValueError('Profiling is already running')
+            thread = threading.Thread(
+                target=self._sample, args=(seconds, interval),
+                daemon=True, name='profiler'
+            )
+            self._session = {
+                'mode': 'process', 'seconds': seconds,
+                'interval': interval, 'started_at': time.time(),
+                'thread': thread
+            }
+        thread.start()
+        return self.status()
+
+    def _sample(self, seconds, interval):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f'{code.co_name} '
+                        f'({code.co_filename.rsplit("/", 1)[-1]}:'
+                        f'{code.co_firstlineno})'
+                    )
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+
+        folded = ''.join(
+            f'{stack} {count}\n' for stack, count in stacks.most_common()
+        )
+        with self._lock:
+            self._session = None
+        self._store(
+            f'process-{time.strftime("%Y%m%d-%H%M%S")}.folded',
+            'text/plain; charset=utf-8', folded.encode('utf-8'),
+            {'mode': 'process', 'seconds': seconds, 'samples': samples,
+             'created_at': time.time()}
+        )
+
+    def cancel(self):
+        with self._lock:
+            session = self._session
+        if session is not None and session['mode'] == 'route':
+            self._finish_route()
@@ -0,0 +1,178 @@
+import re
+
+REQUIRED = object()
+
+# Типы параметров пути: регулярное выражение и преобразование
+CONVERTERS = {
+    'int': (r'\d+', int),
+    'str': (r'[^/]+', str),
+    'hex32': (r'[0-9a-f]{32}', str),
+    'file_type': (r'bill|invoice|entry_control|writeoff', str),
+}
+
+PATH_PARAM = re.compile(r'\{(\w+)(?::(\w+))?\}')
+
+
+class ParameterError(ValueError):
+    """Неверные или недостающие параметры запроса (ответ 400)."""
+
+
+class Param:
+    """Параметр строки запроса с преобразованием типа."""
+
+    __slots__ = ('name', 'type', 'default', 'error', 'arg')
+
+    def __init__(self, name, type=str, default=REQUIRED, error=None,
+                 arg=None):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.error = error or f'Missing {name}'
+        self.arg = arg or name
+
+    def extract(self, query):
+        values = query.get(self.name)
+        if not values or values[0] == '':
+            if self.default is REQUIRED:
+                raise ParameterError(self.error)
+            return self.default
+        try:
+            return self.type(values[0])
+        except ParameterError:
+            raise
+        except (TypeError, ValueError):
+            raise ParameterError(f'Invalid {self.name}')
+
+
+MAX_IDS = 500
+
+
+def id_list(value):
+    """Список id через запятую: "1,2,3" -> [1, 2, 3], не больше
+    MAX_IDS.
+    """
+    ids = [int(i) for i in value.split(',') if i.strip()]
+    if len(ids) > MAX_IDS:
+        raise ParameterError(f'Too many ids (max {MAX_IDS})')
+    return ids
+
+
+class Route:
+    __slots__ = (
+        'method', 'path', 'handler', 'auth', 'params', 'body',
+        'max_body', 'name', 'columns', 'batch', 'pattern', 'converters'
+    )
+
+    def __init__(self, method, path, handler, auth=None, params=(),
+                 body=None, max_body=None, name=None, columns=None,
+                 batch=False):
+        self.method = method
+        self.path = path
+        self.handler = handler
+        # None — без авторизации, 'user' или 'admin'
+        self.auth = auth
+        self.params = tuple(params)
+        # None — тело не читается, 'discard' — читается и
+        # отбрасывается, 'form' — multipart/JSON, 'raw' — байты
+        self.body = body
+        self.max_body = max_body
+        self.name = name or path
+        # Ответ можно запросить в колоночном виде (?format=columns):
+        # True — ответ целиком список строк, строка — ключ списка
+        self.columns = columns
+        # Маршрут возвращает JSON и доступен в /api/batch
+        self.batch = batch
+        self.pattern = None
+        self.converters = {}
+
+        if PATH_PARAM.search(path):
+            regex = ''
+            position = 0
+            for match in PATH_PARAM.finditer(path):
+                param, kind = match.group(1), match.group(2) or 'str'
+                pattern, converter = CONVERTERS[kind]
+                regex += re.escape(path[position:match.start()])
+                regex += f'(?P<{param}>{pattern})'
+                self.converters[param] = converter
+                position = match.end()
+            regex += re.escape(path[position:])
+            self.pattern = re.compile(f'^{regex}$')
+
+    def match(self, path):
+        match = self.pattern.match(path)
+        if not match:
+            return None
+        return {
+            name: self.converters[name](value)
+            for name, value in match.groupdict().items()
+        }
+
+    def arguments(self, path_params, query):
+        kwargs = dict(path_params)
+        for param in self.params:
+            kwargs[param.arg] = param.extract(query)
+        return kwargs
+
+
+class Router:
+    """Таблица маршрутов: статические пути ищутся в словаре,
+    пути с параметрами — по заранее скомпилированным шаблонам.
+    """
+
+    def __init__(self, max_body=None):
+        self.max_body = max_body
+        self._static = {}
+        self._patterns = {}
+        self._paths = {}
+
+    def add(self, method, path, handler, **options):
+        options.setdefault(
+            'body', 'form' if method in ('POST', 'PUT', 'PATCH') else
+            'discard' if method == 'DELETE' else None
+        )
+        options.setdefault('max_body', self.max_body)
+        route = Route(method, path, handler, **options)
+        if route.pattern is None:
+            self._static[(method, path)] = route
+        else:
+            self._patterns.setdefault(method, []).append(route)
+        self._paths.setdefault(path, set()).add(method)
+        return route
+
+    def get(self, path, handler, **options):
+        return self.add('GET', path, handler, **options)
+
+    def post(self, path, handler, **options):
+        return self.add('POST', path, handler, **options)
+
+    def put(self, path, handler, **options):
+        return self.add('PUT', path, handler, **options)
+
+    def patch(self, path, handler, **options):
+        return self.add('PATCH', path, handler, **options)
+
+    def delete(self, path, handler, **options):
+        return self.add('DELETE', path, handler, **options)
+
+    def match(self, method, path):
+        """Возвращает (route, параметры пути) или (None, None)."""
+        route = self._static.get((method, path))
+        if route is not None:
+            return route, {}
+        for route in self._patterns.get(method, ()):
+            params = route.match(path)
+            if params is not None:
+                return route, params
+        return None, None
+
+    def allowed_methods(self, path):
+        methods = set(self._paths.get(path, ()))
+        for method, routes in self._patterns.items():
+            if any(route.match(path) is not None for route in routes):
+                methods.add(method)
+        return sorted(methods)
+
+    def routes(self):
+        yield from self._static.values()
+        for routes in self._patterns.values():
+            yield from routes
@@ -1,20 +1,73 @@
-import json
-import re
 import os
+import time
 import yaml
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from http.cookies import SimpleCookie
 
 from database import Database
 from manager import StorageManager, UserManager, PricingManager
 from handlers import RequestHandler, MultipartParser, FileHelper
-from auth import SessionManager
+from auth import create_session_manager
+from blobstore import create_blob_store, BlobMigrator
+from archive import stream_zip
+from cache import create_file_cache
+from uploads import create_upload_manager
+from importer import create_receipt_importer
+from context import RequestContext
+from passwords import create_password_hasher
+from accesslog import create_access_log
+from profiler import Profiler
+from router import Router, Param, ParameterError, id_list
+from metrics import (
+    REGISTRY, HTTP_REQUESTS, HTTP_DURATION, HTTP_IN_FLIGHT,
+    HTTP_BYTES_IN, HTTP_BYTES_OUT, HTTP_BODY_BYTES, HTTP_RESPONSE_BYTES,
+    DB_CONNECTIONS, SESSIONS
+)
+from memory import MemoryTracker
+from jsonenc import (
+    JsonEncoder, JsonStream, create_json_encoder, to_columns
+)
+
+
+MAX_BATCH_OPERATIONS = 100
+
+
+class CountingWriter:
+    """Обёртка над wfile: считает отправленные байты и время записи."""
+
+    def __init__(self, raw, context):
+        self._raw = raw
+        self._context = context
+
+    def write(self, data):
+        start = time.perf_counter()
+        try:
+            return self._raw.write(data)
+        finally:
+            self._context.bytes_out += len(data)
+            self._context.add_timing(
+                'write', time.perf_counter() - start
+            )
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
 
 class StorageHTTPHandler(BaseHTTPRequestHandler):
     handler = None
     session_manager = None
     config = None
+    router = None
+    access_log = None
+    profiler = None
+    memory = None
+    json_encoder = JsonEncoder()
+    context = None
+    body = b''
+    fields = {}
+    files = {}
     protocol_version = "HTTP/1.0"
 
     def get_session_id(self):
@@ -25,11 +78,24 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
             return cookie['session_id'].value
         return None
 
-    def get_current_user(self):
-        session_id = self.get_session_id()
+    def create_context(self):
+        """Контекст без пользователя: сессия проверяется в
+        load_user, чтобы ошибка хранилища сессий стала ответом 500.
+        """
+        return RequestContext(
+            self.get_session_id(), None, self.client_address[0],
+            self.command, self.path
+        )
+
+    def load_user(self):
+        session_id = self.context.session_id
         if session_id:
-            return self.session_manager.get_session(session_id)
-        return None
+            self.context.user = self.session_manager.get_session(
+                session_id
+            )
+
+    def get_current_user(self):
+        return self.context.user if self.context else None
 
     def require_auth(self):
         user = self.get_current_user()
@@ -48,10 +114,8 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
         return user
 
     def send_json_response(self, data, status=200, session_id=None):
-        json_data = json.dumps(
-            data, default=str, ensure_ascii=False
-        )
-        encoded = json_data.encode('utf-8')
+        with self.context.timer('serialize'):
+            encoded = self.json_encoder.encode(data)
 
         self.send_response(status)
         self.send_header('Content-Type',
@@ -67,10 +131,43 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
             )
 
         self.end_headers()
-        self.wfile.write(encoded)
+        self.write_buffered(encoded)
         self.wfile.flush()
 
+    def send_json_stream(self, stream):
+        """Массив отправляется порциями без Content-Length: ответ
+        HTTP/1.0 с Connection: close заканчивается закрытием соединения.
+        """
+        chunks = stream.chunks(self.json_encoder, self.context.timer)
+        try:
+            first = next(chunks)
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'application/json; charset=utf-8')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.write_buffered(first)
+            try:
+                for chunk in chunks:
+                    self.write_buffered(chunk)
+                self.wfile.flush()
+            except Exception:
+                # Заголовки уже отправлены: ответ обрывается, и клиент
+                # получает неполный JSON вместо сообщения об ошибке
+                self.close_connection = True
+        finally:
+            chunks.close()
+
+    def write_buffered(self, data):
+        HTTP_RESPONSE_BYTES.inc(amount=len(data))
+        try:
+            self.wfile.write(data)
+        finally:
+            HTTP_RESPONSE_BYTES.dec(amount=len(data))
+
     def send_error_json(self, message, status=500):
+        if self.context is not None:
+            self.context.error = message
         self.send_json_response({'error': message}, status)
 
     def serve_file(self, filepath, content_type):
@@ -97,31 +194,33 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
         except FileNotFoundError:
             self.send_error_json('File not found', 404)
 
-    def serve_document_file(self, path):
-        match = re.match(
-            r'/api/file/(bill|invoice|entry_control|writeoff)/(\d+)',
-            path
-        )
-        if not match:
-            self.send_error_json('Invalid file path', 400)
-            return
-
-        file_type = match.group(1)
-        file_id = int(match.group(2))
-
+    def serve_document_file(self, file_type, file_id):
         try:
-            result = self.handler.get_file(file_type, file_id)
+            result = self.handler.get_file(
+                file_type, file_id,
+                FileHelper.accepted_encodings(
+                    self.headers.get('Accept-Encoding', '')
+                )
+            )
             file_data = bytes(result['file'])
+            content_encoding = result.get('content_encoding')
             filename = result.get('filename') or 'document'
 
-            content_type = FileHelper.detect_content_type(
-                file_data, filename
+            content_type = (
+                result.get('content_type') or
+                FileHelper.detect_content_type(file_data, filename)
             )
             encoded_filename = FileHelper.encode_filename(filename)
 
             self.send_response(200)
             self.send_header('Content-Type', content_type)
             self.send_header('Content-Length', str(len(file_data)))
+            self.send_header('Vary', 'Accept-Encoding')
+            if content_encoding:
+                self.send_header(
+                    'Content-Encoding',
+                    FileHelper.CONTENT_ENCODINGS[content_encoding]
+                )
 
             if FileHelper.is_inline(content_type):
                 self.send_header(
@@ -135,10 +234,33 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
                 )
 
             self.end_headers()
-            self.wfile.write(file_data)
+            self.write_buffered(file_data)
         except ValueError as e:
             self.send_error_json(str(e), 404)
 
+    def serve_documents_archive(self, object_ids):
+        archive_name, entries = self.handler.get_documents_archive(
+            object_ids
+        )
+        encoded_filename = FileHelper.encode_filename(archive_name)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header(
+            'Content-Disposition',
+            f"attachment; filename*=UTF-8''{encoded_filename}"
+        )
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        try:
+            stream_zip(self.wfile, entries)
+        except Exception as e:
+            # Заголовки уже отправлены: обрываем ответ, ошибка попадает
+            # в журнал запросов
+            self.context.error = f'Archive streaming failed: {e}'
+            self.close_connection = True
+
     def get_logo_content_type(self, filepath):
         ext = filepath.lower().split('.')[-1] if '.' in filepath else ''
         content_types = {
@@ -152,428 +274,671 @@ class StorageHTTPHandler(BaseHTTPRequestHandler):
         }
         return content_types.get(ext, 'image/png')
 
-    def do_GET(self):
+    # ==================== DISPATCH ====================
+    def send_response(self, code, message=None):
+        if self.context is not None:
+            self.context.status = code
+        super().send_response(code, message)
+
+    def read_body(self, route):
+        content_length = int(self.headers.get('Content-Length', 0) or 0)
+        if route.max_body is not None and content_length > route.max_body:
+            self.send_error_json('Request body too large', 413)
+            self.close_connection = True
+            return False
+
+        if route.body is None:
+            return True
+        self.body = (
+            self.rfile.read(content_length) if content_length > 0 else b''
+        )
+        self.context.bytes_in = len(self.body)
+        HTTP_BODY_BYTES.inc(amount=self.context.bytes_in)
+        if route.body == 'form':
+            self.fields, self.files = MultipartParser.parse_body(
+                self.headers, self.body
+            )
+        return True
+
+    @staticmethod
+    def error_message(error):
+        message = str(error)
+        if 'CONTEXT' in message:
+            message = message.split('\n')[0]
+        return message
+
+    def dispatch(self, method):
+        self.context = self.create_context()
+        self.wfile = CountingWriter(self.wfile, self.context)
+        self.context.activate()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            try:
+                self.load_user()
+            except Exception as e:
+                self.send_error_json(self.error_message(e), 500)
+                return
+            self.route_request(method)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            HTTP_BODY_BYTES.dec(amount=self.context.bytes_in)
+            self.body = self.fields = self.files = None
+            self.context.deactivate()
+            self.record_request(method)
+
+    def record_request(self, method):
+        context = self.context
+        route = context.route or 'unmatched'
+        HTTP_REQUESTS.inc(method, route, str(context.status or 0))
+        HTTP_DURATION.observe(context.elapsed(), method, route)
+        if context.bytes_in:
+            HTTP_BYTES_IN.inc(route, amount=context.bytes_in)
+        if context.bytes_out:
+            HTTP_BYTES_OUT.inc(route, amount=context.bytes_out)
+
+        if self.access_log is not None:
+            timings = context.timings
+            self.access_log.write({
+                'ts': context.started_at,
+                'method': method,
+                'route': route,
+                'path': context.path,
+                'status': context.status,
+                'bytes_in': context.bytes_in,
+                'bytes_out': context.bytes_out,
+                'user_id': context.user_id,
+                'client': context.client_address,
+                'total_ms': round(context.elapsed() * 1000, 3),
+                'db_ms': round(timings.get('db', 0.0) * 1000, 3),
+                'serialize_ms': round(
+                    timings.get('serialize', 0.0) * 1000, 3
+                ),
+                'write_ms': round(timings.get('write', 0.0) * 1000, 3),
+                'error': context.error
+            })
+
+    def route_request(self, method):
         parsed = urlparse(self.path)
-        path = parsed.path
-        query = parse_qs(parsed.query)
+        route, path_params = self.router.match(method, parsed.path)
+
+        if route is None:
+            allowed = self.router.allowed_methods(parsed.path)
+            if allowed:
+                self.send_response(405)
+                self.send_header('Allow', ', '.join(allowed))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_error_json('Not Found', 404)
+            return
+        self.context.route = route.name
 
-        routes = {
-            '/': ('templates/index.html', 'text/html'),
-            '/index.html': ('templates/index.html', 'text/html'),
-            '/add': ('templates/add.html', 'text/html'),
-            '/add.html': ('templates/add.html', 'text/html'),
-            '/manage': ('templates/manage.html', 'text/html'),
-            '/manage.html': ('templates/manage.html', 'text/html'),
-            '/users': ('templates/users.html', 'text/html'),
-            '/users.html': ('templates/users.html', 'text/html'),
-            '/static/style.css': ('static/style.css', 'text/css'),
-            '/logs': ('templates/logs.html', 'text/html'),
-            '/logs.html': ('templates/logs.html', 'text/html'),
-        }
+        if not self.read_body(route):
+            return
+        if route.auth == 'admin' and not self.require_admin():
+            return
+        if route.auth == 'user' and not self.require_auth():
+            return
 
+        query = parse_qs(parsed.query)
         try:
-            if path in routes:
-                filepath, content_type = routes[path]
-                self.serve_file(filepath, content_type)
-            elif path == '/favicon.ico' or path == '/static/logo':
-                company_config = self.config.get('company', {})
-                logo_path = company_config.get('logo', '')
-                if logo_path and os.path.exists(logo_path):
-                    content_type = self.get_logo_content_type(logo_path)
-                    self.serve_binary_file(logo_path, content_type)
-                else:
-                    self.send_response(404)
-                    self.end_headers()
-            elif path == '/api/config':
-                company_config = self.config.get('company', {})
-                self.send_json_response({
-                    'company_name': company_config.get('name', ''),
-                    'has_logo': bool(company_config.get('logo', '') and os.path.exists(company_config.get('logo', '')))
-                })
-            elif path == '/api/auth/check':
-                session_id = self.get_session_id()
-                self.send_json_response(self.handler.get_current_user(session_id))
-            elif path == '/api/objects':
-                self.send_json_response(self.handler.get_objects())
-            elif path == '/api/search':
-                search_type = query.get('type', ['name'])[0]
-                search_value = query.get('value', [''])[0]
-                self.send_json_response(self.handler.search_objects(search_type, search_value))
-            elif path == '/api/object':
-                object_id = query.get('id', [None])[0]
-                if object_id:
-                    self.send_json_response(self.handler.get_object(int(object_id)))
-                else:
-                    self.send_error_json('Missing object id', 400)
-            elif path == '/api/object_details':
-                object_id = query.get('id', [None])[0]
-                if object_id:
-                    self.send_json_response(self.handler.get_object_details(int(object_id)))
-                else:
-                    self.send_error_json('Missing object id', 400)
-            elif path == '/api/sellers':
-                self.send_json_response(self.handler.get_sellers())
-            elif path == '/api/seller':
-                seller_id = query.get('id', [None])[0]
-                if seller_id:
-                    self.send_json_response(self.handler.get_seller(int(seller_id)))
-                else:
-                    self.send_error_json('Missing seller id', 400)
-            elif path == '/api/themes':
-                self.send_json_response(self.handler.get_themes())
-            elif path == '/api/theme':
-                theme_id = query.get('id', [None])[0]
-                if theme_id:
-                    self.send_json_response(self.handler.get_theme(int(theme_id)))
-                else:
-                    self.send_error_json('Missing theme id', 400)
-            elif path == '/api/receipt':
-                receipt_id = query.get('id', [None])[0]
-                if receipt_id:
-                    self.send_json_response(self.handler.get_receipt(int(receipt_id)))
-                else:
-                    self.send_error_json('Missing receipt id', 400)
-            elif path == '/api/writeoff':
-                writeoff_id = query.get('id', [None])[0]
-                if writeoff_id:
-                    self.send_json_response(self.handler.get_writeoff(int(writeoff_id)))
-                else:
-                    self.send_error_json('Missing writeoff id', 400)
-            elif path == '/api/users':
-                if not self.require_admin():
-                    return
-                self.send_json_response(self.handler.get_users())
-            elif path == '/api/user':
-                if not self.require_admin():
-                    return
-                user_id = query.get('id', [None])[0]
-                if user_id:
-                    self.send_json_response(self.handler.get_user(int(user_id)))
-                else:
-                    self.send_error_json('Missing user id', 400)
-            elif path.startswith('/api/file/'):
-                self.serve_document_file(path)
-            elif path == '/api/pricing':
-                pricing_id = query.get('id', [None])[0]
-                receipt_id = query.get('receipt_id', [None])[0]
-                if pricing_id:
-                    self.send_json_response(self.handler.get_pricing(int(pricing_id)))
-                elif receipt_id:
-                    result = self.handler.get_pricing_by_receipt(int(receipt_id))
-                    self.send_json_response(result if result else {})
-                else:
-                    self.send_json_response(self.handler.get_all_pricing())
-            elif path == '/api/logs':
-                if not self.require_admin():
-                    return
-                search = query.get('search', [''])[0]
-                limit = int(query.get('limit', [500])[0])
-                offset = int(query.get('offset', [0])[0])
-                if search:
-                    logs = self.handler.search_logs(
-                        search, limit, offset
-                    )
-                else:
-                    logs = self.handler.get_logs(limit, offset)
-                count = self.handler.get_logs_count()
-                self.send_json_response({
-                    'logs': logs, 'total': count
-                })
-            
-            elif path == '/api/filtered':
-                filter_type = query.get('filter', ['all'])[0]
-                if filter_type == 'in_stock':
-                    self.send_json_response(
-                        self.handler.get_objects_filtered('in_stock')
-                    )
-                elif filter_type == 'written_off':
-                    self.send_json_response(
-                        self.handler.get_objects_filtered('written_off')
-                    )
-                else:
-                    self.send_json_response(
-                        self.handler.get_objects()
-                    )
-            
-                    
+            kwargs = route.arguments(path_params, query)
         except ValueError as e:
-            self.send_error_json(str(e), 404)
+            self.send_error_json(str(e), 400)
+            return
+
+        try:
+            with self.context.timer('handler'):
+                result = route.handler(self, **kwargs)
+            if route.columns and query.get('format') == ['columns']:
+                result = self.columnar(result, route.columns)
+            if isinstance(result, JsonStream):
+                self.send_json_stream(result)
+            elif result is not None:
+                self.send_json_response(result)
         except Exception as e:
-                self.send_error_json(str(e), 500)
+            self.send_error_json(
+                self.error_message(e), self.error_status(method, e)
+            )
 
-    def do_POST(self):
-        path = urlparse(self.path).path
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length) if content_length > 0 else b''
+    @staticmethod
+    def error_status(method, error):
+        if isinstance(error, ParameterError):
+            return 400
+        if isinstance(error, ValueError):
+            return 404 if method == 'GET' else 400
+        return 400 if method == 'DELETE' else 500
+
+    @staticmethod
+    def columnar(result, key):
+        if isinstance(result, JsonStream):
+            result = result.materialize()
+        if key is True:
+            return to_columns(result) if isinstance(result, list) else result
+        if isinstance(result, dict) and isinstance(result.get(key), list):
+            return dict(result, **{key: to_columns(result[key])})
+        return result
 
-        fields, files = MultipartParser.parse_body(
-            self.headers, body
-        )
+    def do_GET(self):
+        self.dispatch('GET')
 
-        try:
-            if path == '/api/auth/login':
-                username = fields.get('username', '')
-                password = fields.get('password', '')
-                result = self.handler.login(username, password)
-                self.send_json_response(
-                    result, session_id=result['session_id']
-                )
-            elif path == '/api/auth/logout':
-                session_id = self.get_session_id()
-                self.handler.logout(session_id)
-                self.send_json_response({'success': True})
-            elif path == '/api/object':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_object(fields)
-                )
-            elif path == '/api/seller':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_seller(fields)
-                )
-            elif path == '/api/theme':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_theme(fields)
-                )
-            elif path == '/api/receipt':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_receipt(fields, files)
-                )
-            elif path == '/api/writeoff':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_writeoff(fields, files)
-                )
-            elif path == '/api/pricing':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.create_pricing(fields)
-                )
-            elif path == '/api/user':
-                if not self.require_admin():
-                    return
-                self.send_json_response(
-                    self.handler.create_user(fields)
-                )
-            else:
-                self.send_error_json('Not Found', 404)
-        except ValueError as e:
-            self.send_error_json(str(e), 400)
-        except Exception as e:
-            self.send_error_json(str(e), 500)
+    def do_POST(self):
+        self.dispatch('POST')
 
     def do_PUT(self):
-        path = urlparse(self.path).path
+        self.dispatch('PUT')
 
-        content_length = int(
-            self.headers.get('Content-Length', 0)
-        )
-        body = (
-            self.rfile.read(content_length)
-            if content_length > 0 else b''
-        )
-        fields, files = MultipartParser.parse_body(
-            self.headers, body
-        )
+    def do_PATCH(self):
+        self.dispatch('PATCH')
 
-        session_id = self.get_session_id()
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    # ==================== ROUTES ====================
+    def serve_static(self, filepath, content_type):
+        self.serve_file(filepath, content_type)
+
+    def serve_logo(self):
+        company_config = self.config.get('company', {})
+        logo_path = company_config.get('logo', '')
+        if logo_path and os.path.exists(logo_path):
+            content_type = self.get_logo_content_type(logo_path)
+            self.serve_binary_file(logo_path, content_type)
+        else:
+            self.send_response(404)
+            self.end_headers()
 
-        try:
-            if path == '/api/object':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_object(
-                        fields, session_id
-                    )
-                )
-            elif path == '/api/seller':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_seller(
-                        fields, session_id
-                    )
-                )
-            elif path == '/api/theme':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_theme(
-                        fields, session_id
-                    )
-                )
-            elif path == '/api/receipt':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_receipt(
-                        fields, files, session_id
-                    )
-                )
-            elif path == '/api/writeoff':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_writeoff(
-                        fields, files, session_id
-                    )
-                )
-            elif path == '/api/pricing':
-                if not self.require_auth():
-                    return
-                self.send_json_response(
-                    self.handler.update_pricing(
-                        fields, session_id
-                    )
-                )
-            elif path == '/api/user':
-                if not self.require_admin():
-                    return
-                self.send_json_response(
-                    self.handler.update_user(
-                        fields, session_id
-                    )
-                )
-            else:
-                self.send_error_json('Not Found', 404)
-        except ValueError as e:
-            self.send_error_json(str(e), 400)
-        except Exception as e:
-            self.send_error_json(str(e), 500)
+    def serve_metrics(self):
+        metrics_config = self.config.get('metrics') or {}
+        allowed = metrics_config.get('allowed_addresses', ['127.0.0.1', '::1'])
+        if self.context.client_address not in allowed and \
+                not self.context.admin:
+            self.send_error_json('Forbidden', 403)
+            return
 
-    def do_DELETE(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        query = parse_qs(parsed.query)
+        encoded = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
 
-        content_length = int(
-            self.headers.get('Content-Length', 0)
+    def get_profile(self, name=None):
+        if not name:
+            return self.profiler.status()
+        content_type, data, _ = self.profiler.get_result(name)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        encoded_filename = FileHelper.encode_filename(name)
+        self.send_header(
+            'Content-Disposition',
+            f"attachment; filename*=UTF-8''{encoded_filename}"
         )
-        if content_length > 0:
-            self.rfile.read(content_length)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_profile(self):
+        mode = self.fields.get('mode', 'route')
+        if mode == 'route':
+            route = self.fields.get('route')
+            if not route:
+                raise ValueError('Missing route')
+            return self.profiler.profile_route(
+                route, int(self.fields.get('count', 10))
+            )
+        if mode == 'process':
+            return self.profiler.profile_process(
+                float(self.fields.get('seconds', 10)),
+                float(self.fields.get('interval', 0.005))
+            )
+        raise ValueError(f'Unknown profiling mode: {mode}')
+
+    def cancel_profile(self):
+        self.profiler.cancel()
+        return self.profiler.status()
+
+    def tracemalloc_action(self):
+        action = self.fields.get('action')
+        if action == 'start':
+            return self.memory.start(int(self.fields.get('frames', 10)))
+        if action == 'snapshot':
+            return self.memory.snapshot()
+        if action == 'stop':
+            return self.memory.stop()
+        raise ValueError(f'Unknown action: {action}')
+
+    def run_batch(self):
+        """Несколько GET-запросов в одном: {"operations": [{"path":
+        "/api/objects"}, ...]}. Операции выполняются по очереди; у каждой
+        свой статус и те же правила доступа. Общее соединение с БД
+        занимается на время одной операции, а не всего пакета, чтобы
+        запросы других потоков шли между операциями.
+        """
+        operations = self.fields.get('operations') \
+            if isinstance(self.fields, dict) else None
+        if not isinstance(operations, list) or not operations:
+            raise ValueError('Missing operations')
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            raise ValueError('Too many operations')
+
+        return {'results': [
+            self.run_batch_operation(operation) for operation in operations
+        ]}
+
+    def run_batch_operation(self, operation):
+        path = operation.get('path') if isinstance(operation, dict) \
+            else operation
+        if not isinstance(path, str):
+            return {'status': 400, 'body': {'error': 'Missing path'}}
+        parsed = urlparse(path)
+        route, path_params = self.router.match('GET', parsed.path)
+        if route is None or not route.batch:
+            return {'status': 404, 'body': {'error': 'Not Found'}}
+
+        user = self.context.user
+        if route.auth and not user:
+            return {'status': 401,
+                    'body': {'error': 'Требуется авторизация'}}
+        if route.auth == 'admin' and not user.get('admin'):
+            return {'status': 403,
+                    'body': {'error': 'Требуются права администратора'}}
 
-        session_id = self.get_session_id()
+        query = parse_qs(parsed.query)
+        try:
+            kwargs = route.arguments(path_params, query)
+        except ValueError as e:
+            return {'status': 400, 'body': {'error': str(e)}}
 
         try:
-            if path == '/api/object':
-                if not self.require_auth():
-                    return
-                oid = query.get('id', [None])[0]
-                if oid:
-                    self.send_json_response(
-                        self.handler.delete_object(
-                            int(oid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing object id', 400
-                    )
-            elif path == '/api/seller':
-                if not self.require_auth():
-                    return
-                sid = query.get('id', [None])[0]
-                if sid:
-                    self.send_json_response(
-                        self.handler.delete_seller(
-                            int(sid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing seller id', 400
-                    )
-            elif path == '/api/theme':
-                if not self.require_auth():
-                    return
-                tid = query.get('id', [None])[0]
-                if tid:
-                    self.send_json_response(
-                        self.handler.delete_theme(
-                            int(tid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing theme id', 400
-                    )
-            elif path == '/api/receipt':
-                if not self.require_auth():
-                    return
-                rid = query.get('id', [None])[0]
-                if rid:
-                    self.send_json_response(
-                        self.handler.delete_receipt(
-                            int(rid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing receipt id', 400
-                    )
-            elif path == '/api/writeoff':
-                if not self.require_auth():
-                    return
-                wid = query.get('id', [None])[0]
-                if wid:
-                    self.send_json_response(
-                        self.handler.delete_writeoff(
-                            int(wid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing writeoff id', 400
-                    )
-            elif path == '/api/pricing':
-                if not self.require_auth():
-                    return
-                pid = query.get('id', [None])[0]
-                if pid:
-                    self.send_json_response(
-                        self.handler.delete_pricing(
-                            int(pid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing pricing id', 400
-                    )
-            elif path == '/api/user':
-                if not self.require_admin():
-                    return
-                uid = query.get('id', [None])[0]
-                if uid:
-                    self.send_json_response(
-                        self.handler.delete_user(
-                            int(uid), session_id
-                        )
-                    )
-                else:
-                    self.send_error_json(
-                        'Missing user id', 400
-                    )
-            else:
-                self.send_error_json('Not Found', 404)
+            with self.context.timer('handler'), self.handler.db.batch():
+                result = route.handler(self, **kwargs)
+                if route.columns and query.get('format') == ['columns']:
+                    result = self.columnar(result, route.columns)
+                if isinstance(result, JsonStream):
+                    result = result.materialize()
         except Exception as e:
-            error_msg = str(e)
-            if 'CONTEXT' in error_msg:
-                error_msg = error_msg.split('\n')[0]
-            self.send_error_json(error_msg, 400)
+            return {'status': self.error_status('GET', e),
+                    'body': {'error': self.error_message(e)}}
+        return {'status': 200, 'body': result}
+
+    def get_config(self):
+        company_config = self.config.get('company', {})
+        logo_path = company_config.get('logo', '')
+        return {
+            'company_name': company_config.get('name', ''),
+            'has_logo': bool(logo_path and os.path.exists(logo_path))
+        }
+
+    def login(self):
+        result = self.handler.login(
+            self.fields.get('username', ''),
+            self.fields.get('password', '')
+        )
+        self.send_json_response(result, session_id=result['session_id'])
+
+    def logout(self):
+        self.handler.logout(self.context)
+        return {'success': True}
+
+    def get_object_details(self, object_id=None, object_ids=None):
+        if object_ids:
+            return self.handler.get_object_details_bulk(object_ids)
+        if object_id is None:
+            raise ParameterError('Missing object id')
+        return self.handler.get_object_details(object_id)
+
+    def get_pricing(self, pricing_id=None, receipt_id=None,
+                    receipt_ids=None):
+        if receipt_ids:
+            return self.handler.get_pricing_by_receipts(receipt_ids)
+        if pricing_id:
+            return self.handler.get_pricing(pricing_id)
+        if receipt_id:
+            return self.handler.get_pricing_by_receipt(receipt_id) or {}
+        return JsonStream(self.handler.get_all_pricing())
+
+    def get_logs(self, search, limit, offset):
+        total = self.handler.get_logs_count()
+        if search:
+            logs = self.handler.search_logs(search, limit, offset)
+            return {'logs': logs, 'total': total}
+        return JsonStream(
+            self.handler.get_logs(limit, offset), 'logs', {'total': total}
+        )
+
+    def get_filtered(self, filter_type):
+        if filter_type in ('in_stock', 'written_off'):
+            return self.handler.get_objects_filtered(filter_type)
+        return JsonStream(self.handler.get_objects())
+
+    def get_objects_archive(self, object_ids):
+        if not object_ids:
+            raise ValueError('Missing object ids')
+        self.serve_documents_archive(object_ids)
+
+    def put_upload_chunk(self, upload_id, index):
+        return self.handler.upload_chunk(
+            upload_id, index, self.body,
+            self.headers.get('X-Chunk-SHA256'), self.context
+        )
 
     def log_message(self, format, *args):
         pass
 
+
+PAGES = {
+    '/': ('templates/index.html', 'text/html'),
+    '/index.html': ('templates/index.html', 'text/html'),
+    '/add': ('templates/add.html', 'text/html'),
+    '/add.html': ('templates/add.html', 'text/html'),
+    '/manage': ('templates/manage.html', 'text/html'),
+    '/manage.html': ('templates/manage.html', 'text/html'),
+    '/users': ('templates/users.html', 'text/html'),
+    '/users.html': ('templates/users.html', 'text/html'),
+    '/static/style.css': ('static/style.css', 'text/css'),
+    '/static/upload.js': ('static/upload.js', 'application/javascript'),
+    '/logs': ('templates/logs.html', 'text/html'),
+    '/logs.html': ('templates/logs.html', 'text/html'),
+}
+
+
+def build_router(max_body=None, upload_chunk_size=None):
+    """Таблица маршрутов; строится один раз при запуске сервера."""
+    router = Router(max_body)
+
+    def entity_id(name):
+        return Param('id', int, error=f'Missing {name} id', arg='entity_id')
+
+    # Страницы и статика
+    for path, (filepath, content_type) in PAGES.items():
+        router.get(
+            path,
+            lambda r, f=filepath, t=content_type: r.serve_static(f, t)
+        )
+    router.get('/favicon.ico', StorageHTTPHandler.serve_logo)
+    router.get('/static/logo', StorageHTTPHandler.serve_logo)
+    router.get('/api/config', StorageHTTPHandler.get_config, batch=True)
+    router.get('/metrics', StorageHTTPHandler.serve_metrics)
+
+    # Авторизация
+    router.get(
+        '/api/auth/check',
+        lambda r: r.handler.get_current_user(r.context),
+        batch=True
+    )
+    router.post('/api/auth/login', StorageHTTPHandler.login)
+    router.post('/api/auth/logout', StorageHTTPHandler.logout)
+
+    # Несколько чтений одним запросом
+    router.post('/api/batch', StorageHTTPHandler.run_batch)
+
+    # Чтение
+    router.get(
+        '/api/objects', lambda r: JsonStream(r.handler.get_objects()),
+        columns=True, batch=True
+    )
+    router.get(
+        '/api/search',
+        lambda r, search_type, value:
+            r.handler.search_objects(search_type, value),
+        params=[Param('type', default='name', arg='search_type'),
+                Param('value', default='')],
+        columns=True, batch=True
+    )
+    router.get(
+        '/api/filtered', StorageHTTPHandler.get_filtered,
+        params=[Param('filter', default='all', arg='filter_type')],
+        columns=True, batch=True
+    )
+    router.get(
+        '/api/object',
+        lambda r, entity_id: r.handler.get_object(entity_id),
+        params=[entity_id('object')],
+        batch=True
+    )
+    router.get(
+        '/api/object_details', StorageHTTPHandler.get_object_details,
+        params=[Param('id', int, default=None, arg='object_id'),
+                Param('ids', id_list, default=None, arg='object_ids')],
+        batch=True
+    )
+    router.get('/api/sellers', lambda r: r.handler.get_sellers(), batch=True)
+    router.get(
+        '/api/seller',
+        lambda r, entity_id: r.handler.get_seller(entity_id),
+        params=[entity_id('seller')],
+        batch=True
+    )
+    router.get('/api/themes', lambda r: r.handler.get_themes(), batch=True)
+    router.get(
+        '/api/theme',
+        lambda r, entity_id: r.handler.get_theme(entity_id),
+        params=[entity_id('theme')],
+        batch=True
+    )
+    router.get(
+        '/api/receipt',
+        lambda r, entity_id: r.handler.get_receipt(entity_id),
+        params=[entity_id('receipt')],
+        batch=True
+    )
+    router.get(
+        '/api/writeoff',
+        lambda r, entity_id: r.handler.get_writeoff(entity_id),
+        params=[entity_id('writeoff')],
+        batch=True
+    )
+    router.get(
+        '/api/pricing', StorageHTTPHandler.get_pricing,
+        params=[Param('id', int, default=None, arg='pricing_id'),
+                Param('receipt_id', int, default=None),
+                Param('receipt_ids', id_list, default=None)],
+        columns=True, batch=True
+    )
+
+    # Документы
+    router.get(
+        '/api/file/{file_type:file_type}/{file_id:int}',
+        lambda r, file_type, file_id:
+            r.serve_document_file(file_type, file_id),
+        name='/api/file'
+    )
+    router.get(
+        '/api/object/{object_id:int}/documents.zip',
+        lambda r, object_id: r.serve_documents_archive([object_id]),
+        name='/api/object/documents.zip'
+    )
+    router.get(
+        '/api/objects/documents.zip', StorageHTTPHandler.get_objects_archive,
+        params=[Param('ids', id_list, error='Missing object ids',
+                      arg='object_ids')]
+    )
+
+    # Загрузка по частям
+    router.post(
+        '/api/upload',
+        lambda r: r.handler.create_upload(r.fields, r.context),
+        auth='user'
+    )
+    router.get(
+        '/api/upload/{upload_id:hex32}',
+        lambda r, upload_id: r.handler.get_upload(upload_id, r.context),
+        auth='user', name='/api/upload/id'
+    )
+    router.put(
+        '/api/upload/{upload_id:hex32}/{index:int}',
+        StorageHTTPHandler.put_upload_chunk,
+        auth='user', body='raw', max_body=upload_chunk_size or max_body,
+        name='/api/upload/id/chunk'
+    )
+    router.post(
+        '/api/upload/{upload_id:hex32}/finalize',
+        lambda r, upload_id:
+            r.handler.finalize_upload(upload_id, r.context),
+        auth='user', name='/api/upload/id/finalize'
+    )
+    router.delete(
+        '/api/upload/{upload_id:hex32}',
+        lambda r, upload_id: r.handler.abort_upload(upload_id, r.context),
+        auth='user', name='/api/upload/id'
+    )
+
+    # Импорт поступлений из CSV/XLSX
+    router.post(
+        '/api/import/receipts',
+        lambda r: r.handler.start_import(r.fields, r.files, r.context),
+        auth='user'
+    )
+    router.get(
+        '/api/import/{import_id:hex32}',
+        lambda r, import_id: r.handler.get_import(import_id, r.context),
+        auth='user', name='/api/import/id'
+    )
+    router.get(
+        '/api/import/{import_id:hex32}/report',
+        lambda r, import_id:
+            r.handler.get_import_report(import_id, r.context),
+        auth='user', name='/api/import/id/report'
+    )
+
+    # Создание, изменение, удаление
+    for path, name in (('/api/object', 'object'), ('/api/seller', 'seller'),
+                       ('/api/theme', 'theme'), ('/api/pricing', 'pricing')):
+        router.post(
+            path,
+            lambda r, name=name:
+                getattr(r.handler, f'create_{name}')(r.fields),
+            auth='user'
+        )
+        router.put(
+            path,
+            lambda r, name=name:
+                getattr(r.handler, f'update_{name}')(r.fields, r.context),
+            auth='user'
+        )
+    for path, name in (('/api/receipt', 'receipt'),
+                       ('/api/writeoff', 'writeoff')):
+        router.post(
+            path,
+            lambda r, name=name: getattr(r.handler, f'create_{name}')(
+                r.fields, r.files, r.context
+            ),
+            auth='user'
+        )
+        router.put(
+            path,
+            lambda r, name=name: getattr(r.handler, f'update_{name}')(
+                r.fields, r.files, r.context
+            ),
+            auth='user'
+        )
+        # Только изменённые поля; документы — только при новом файле
+        router.patch(
+            path,
+            lambda r, name=name: getattr(r.handler, f'patch_{name}')(
+                r.fields, r.files, r.context
+            ),
+            auth='user'
+        )
+    for path, name in (('/api/object', 'object'), ('/api/seller', 'seller'),
+                       ('/api/theme', 'theme'), ('/api/receipt', 'receipt'),
+                       ('/api/writeoff', 'writeoff'),
+                       ('/api/pricing', 'pricing')):
+        router.delete(
+            path,
+            lambda r, entity_id, name=name:
+                getattr(r.handler, f'delete_{name}')(entity_id, r.context),
+            auth='user', params=[entity_id(name)]
+        )
+
+    # Администрирование
+    router.get(
+        '/api/users', lambda r: r.handler.get_users(), auth='admin',
+        batch=True
+    )
+    router.get(
+        '/api/user',
+        lambda r, entity_id: r.handler.get_user(entity_id),
+        auth='admin', params=[entity_id('user')],
+        batch=True
+    )
+    router.post(
+        '/api/user', lambda r: r.handler.create_user(r.fields),
+        auth='admin'
+    )
+    router.put(
+        '/api/user',
+        lambda r: r.handler.update_user(r.fields, r.context),
+        auth='admin'
+    )
+    router.delete(
+        '/api/user',
+        lambda r, entity_id: r.handler.delete_user(entity_id, r.context),
+        auth='admin', params=[entity_id('user')]
+    )
+    router.get(
+        '/api/logs', StorageHTTPHandler.get_logs, auth='admin',
+        params=[Param('search', default=''),
+                Param('limit', int, default=500),
+                Param('offset', int, default=0)],
+        columns='logs', batch=True
+    )
+    router.get(
+        '/api/admin/cache',
+        lambda r: r.handler.get_file_cache_stats(),
+        auth='admin',
+        batch=True
+    )
+    router.get(
+        '/api/admin/profile', StorageHTTPHandler.get_profile,
+        auth='admin', params=[Param('name', default=None)]
+    )
+    router.post(
+        '/api/admin/profile', StorageHTTPHandler.start_profile,
+        auth='admin'
+    )
+    router.delete(
+        '/api/admin/profile', StorageHTTPHandler.cancel_profile,
+        auth='admin'
+    )
+    router.get(
+        '/api/admin/memory', lambda r: r.memory.report(), auth='admin',
+        batch=True
+    )
+    router.get(
+        '/api/admin/memory/tracemalloc',
+        lambda r, limit, key_type: r.memory.top(limit, key_type),
+        auth='admin',
+        params=[Param('limit', int, default=20),
+                Param('key', default='lineno', arg='key_type')]
+    )
+    router.post(
+        '/api/admin/memory/tracemalloc',
+        StorageHTTPHandler.tracemalloc_action, auth='admin'
+    )
+    return router
+
+def create_memory_tracker(session_manager, file_cache, handler_class):
+    memory = MemoryTracker()
+    memory.register('sessions', session_manager.memory_usage)
+    if file_cache is not None:
+        memory.register('file_cache', file_cache.stats)
+    memory.register('request_bodies', lambda: {
+        'bytes': HTTP_BODY_BYTES.value(),
+        'in_flight': HTTP_IN_FLIGHT.value()
+    })
+    memory.register('buffered_responses', lambda: {
+        'bytes': HTTP_RESPONSE_BYTES.value()
+    })
+    memory.register('profiler', handler_class.profiler.memory_usage)
+    if handler_class.access_log is not None:
+        memory.register(
+            'access_log', handler_class.access_log.memory_usage
+        )
+    return memory
+
+
 def load_config(config_path='config.yaml'):
     with open(config_path, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
@@ -584,18 +949,57 @@ def run_server(config_path='config.yaml'):
 
     db = Database(config_path)
     db.test_connection()
+    db.apply_migrations()
+
+    blob_store = create_blob_store(config)
+    if blob_store is not None and config['storage'].get('migrate'):
+        BlobMigrator(Database(config_path), blob_store).start()
+    uploads = create_upload_manager(config, blob_store)
 
-    manager = StorageManager(db)
+    manager = StorageManager(db, blob_store)
     user_manager = UserManager(db)
-    session_manager = SessionManager()
+    session_manager = create_session_manager(config, db)
     pricing_manager = PricingManager(db)
 
-    StorageHTTPHandler.handler = RequestHandler(db, manager, user_manager, session_manager, pricing_manager)
+    file_cache = create_file_cache(config)
+    StorageHTTPHandler.handler = RequestHandler(
+        db, manager, user_manager, session_manager,
+        pricing_manager, blob_store, file_cache, uploads,
+        create_password_hasher(config),
+        create_receipt_importer(config, Database(config_path))
+    )
+    DB_CONNECTIONS.set_function(db.connection_count)
+    SESSIONS.set_function(session_manager.count)
+    if file_cache is not None:
+        REGISTRY.gauge(
+            'file_cache_bytes', 'Bytes held in the document cache',
+            function=lambda: file_cache.stats()['bytes']
+        )
+        REGISTRY.gauge(
+            'file_cache_hit_ratio', 'Document cache hit ratio',
+            function=lambda: file_cache.stats()['hit_rate']
+        )
+    StorageHTTPHandler.router = build_router(
+        server_config.get('max_body'),
+        uploads.chunk_size if uploads is not None else None
+    )
+    StorageHTTPHandler.access_log = create_access_log(config)
+    StorageHTTPHandler.profiler = Profiler(StorageHTTPHandler)
+    StorageHTTPHandler.memory = create_memory_tracker(
+        session_manager, file_cache, StorageHTTPHandler
+    )
+    StorageHTTPHandler.json_encoder = create_json_encoder(config)
     StorageHTTPHandler.session_manager = session_manager
     StorageHTTPHandler.config = config
 
     server_address = (server_config['host'], server_config['port'])
-    httpd = HTTPServer(server_address, StorageHTTPHandler)
+    # В многопоточном режиме долгие запросы (вход с хэшированием
+    # пароля, выгрузка архивов) не задерживают остальные
+    if server_config.get('threaded', True):
+        httpd = ThreadingHTTPServer(server_address, StorageHTTPHandler)
+        httpd.daemon_threads = True
+    else:
+        httpd = HTTPServer(server_address, StorageHTTPHandler)
 
     company_name = config.get('company', {}).get('name', '')
     if company_name:
@@ -608,7 +1012,11 @@ def run_server(config_path='config.yaml'):
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped")
+    finally:
         httpd.shutdown()
+        # Журнал пишется в фоновом потоке: дописываем очередь до выхода
+        if StorageHTTPHandler.access_log is not None:
+            StorageHTTPHandler.access_log.flush()
         db.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+// ==================== CHUNKED UPLOAD ====================
+// Большие файлы загружаются частями через /api/upload с возобновлением
+// после обрыва связи; в форму передаётся только id документа.
+
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 6;
+
+async function sha256Hex(buffer) {
+    if (!window.crypto || !crypto.subtle) return null;
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest))
+        .map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function uploadRequest(url, options = {}) {
+    const response = await fetch(url, options);
+    const result = await response.json();
+    if (result.error) throw new Error(result.error);
+    return result;
+}
+
+function uploadKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function sendChunks(status, file, onProgress) {
+    const received = new Set(status.received);
+    for (let index = 0; index < status.total_chunks; index++) {
+        if (received.has(index)) continue;
+
+        const start = index * status.chunk_size;
+        const chunk = await file.slice(start, start + status.chunk_size).arrayBuffer();
+        const checksum = await sha256Hex(chunk);
+        const headers = { 'Content-Type': 'application/octet-stream' };
+        if (checksum) headers['X-Chunk-SHA256'] = checksum;
+
+        for (let attempt = 0; ; attempt++) {
+            try {
+                await uploadRequest(`/api/upload/${status.upload_id}/${index}`, {
+                    method: 'PUT', headers, body: chunk
+                });
+                break;
+            } catch (error) {
+                if (attempt >= CHUNK_RETRIES) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+            }
+        }
+
+        received.add(index);
+        if (onProgress) onProgress(received.size / status.total_chunks);
+    }
+
+    const result = await uploadRequest(`/api/upload/${status.upload_id}/finalize`, {
+        method: 'POST'
+    });
+    return result.document_id;
+}
+
+async function uploadChunked(file, onProgress) {
+    const key = uploadKey(file);
+    let status = null;
+
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        try {
+            status = await uploadRequest(`/api/upload/${savedId}`);
+        } catch (error) {
+            localStorage.removeItem(key);
+        }
+    }
+
+    if (!status) {
+        try {
+            status = await uploadRequest('/api/upload', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size })
+            });
+        } catch (error) {
+            // Загрузка по частям недоступна — отправим файл целиком
+            return null;
+        }
+        localStorage.setItem(key, status.upload_id);
+    }
+
+    const documentId = status.document_id || await sendChunks(status, file, onProgress);
+    localStorage.removeItem(key);
+    return documentId;
+}
+
+async function appendFile(formData, fileField, documentField, file, onProgress) {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        const documentId = await uploadChunked(file, onProgress);
+        if (documentId) {
+            formData.append(documentField, documentId);
+            return;
+        }
+    }
+    formData.append(fileField, file);
+}
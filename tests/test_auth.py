@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from auth import TokenSessionManager, create_session_manager
+
+USER = {'id': 7, 'username': 'ivanov', 'admin': False, 'password': 'x'}
+KEYS = {'k1': 'first-secret', 'k2': 'second-secret'}
+
+
+class FakeDb:
+    """Общая таблица deny-list нескольких экземпляров сервера."""
+
+    def __init__(self):
+        self.rows = []
+
+    def deny_session_token(self, token_id, user_id, revoked_at, expires_at):
+        self.rows.append({
+            'token_id': token_id, 'user_id': user_id,
+            'revoked_at': revoked_at, 'expires_at': expires_at
+        })
+
+    def get_session_denylist(self):
+        return list(self.rows)
+
+
+def test_token_carries_only_user_fields():
+    sessions = TokenSessionManager(KEYS)
+    token = sessions.create_session(USER)
+    assert token.startswith('v1.k1.')
+    assert sessions.get_session(token) == {
+        'id': 7, 'username': 'ivanov', 'admin': False
+    }
+
+
+def test_tampered_tokens_are_rejected():
+    sessions = TokenSessionManager(KEYS)
+    version, key_id, payload, signature = \
+        sessions.create_session(USER).split('.')
+    other_signature = signature[:-1] + \
+        ('A' if signature[-1] != 'A' else 'B')
+    forged = TokenSessionManager({'k1': 'other-secret'}).create_session(
+        dict(USER, admin=True)
+    )
+    for token in (
+        f'{version}.{key_id}.{payload}x.{signature}',
+        f'{version}.{key_id}.{payload}.{other_signature}',
+        f'{version}.k2.{payload}.{signature}',
+        f'v0.{key_id}.{payload}.{signature}',
+        forged, 'garbage', '', None,
+    ):
+        assert sessions.get_session(token) is None
+
+
+def test_old_key_still_verifies_after_rotation():
+    old = TokenSessionManager(KEYS, signing_key='k1')
+    token = old.create_session(USER)
+    rotated = TokenSessionManager(KEYS, signing_key='k2')
+    assert rotated.get_session(token)['id'] == 7
+    assert rotated.create_session(USER).startswith('v1.k2.')
+    assert TokenSessionManager({'k2': KEYS['k2']}).get_session(token) is None
+
+
+def test_expired_token_is_rejected():
+    sessions = TokenSessionManager(KEYS, timeout=-1)
+    assert sessions.get_session(sessions.create_session(USER)) is None
+
+
+def test_logout_denies_token_on_every_instance():
+    db = FakeDb()
+    first = TokenSessionManager(KEYS, db=db, refresh_interval=0)
+    second = TokenSessionManager(KEYS, db=db, refresh_interval=0)
+    token = first.create_session(USER)
+    other = first.create_session(USER)
+    assert second.get_session(token) is not None
+
+    first.delete_session(token)
+    assert first.get_session(token) is None
+    assert second.get_session(token) is None
+    assert second.get_session(other) is not None
+
+
+def test_revoke_user_rejects_tokens_issued_before():
+    db = FakeDb()
+    first = TokenSessionManager(KEYS, db=db, refresh_interval=0)
+    second = TokenSessionManager(KEYS, db=db, refresh_interval=0)
+    token = first.create_session(USER)
+    first.revoke_user(USER['id'])
+    assert first.get_session(token) is None
+    assert second.get_session(token) is None
+
+    time.sleep(0.01)
+    assert second.get_session(first.create_session(USER)) is not None
+
+
+def test_cleanup_expired_drops_old_denials():
+    sessions = TokenSessionManager(KEYS, timeout=3600)
+    sessions.delete_session(sessions.create_session(USER))
+    assert sessions.memory_usage()['denied_tokens'] == 1
+    assert sessions.cleanup_expired() == 0
+    sessions._denied = {jti: 0 for jti in sessions._denied}
+    assert sessions.cleanup_expired() == 1
+
+
+def test_configuration_errors():
+    with pytest.raises(ValueError):
+        TokenSessionManager({})
+    with pytest.raises(ValueError):
+        TokenSessionManager(KEYS, signing_key='k3')
+    sessions = create_session_manager({'sessions': {
+        'backend': 'token', 'token_keys': KEYS, 'signing_key': 'k2'
+    }})
+    assert sessions.create_session(USER).startswith('v1.k2.')
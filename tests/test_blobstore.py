@@ -0,0 +1,128 @@
+import os
+import time
+
+import pytest
+
+from blobstore import FilesystemBlobStore, collect_garbage
+
+
+class FakeDb:
+    def __init__(self, digests=()):
+        self.digests = set(digests)
+
+    def get_document_blobs(self):
+        return [{'sha256': digest} for digest in self.digests]
+
+
+class FakeUploads:
+    def __init__(self, digests=()):
+        self.digests = set(digests)
+
+    def pending_digests(self):
+        return set(self.digests)
+
+
+def age(store, digest, seconds):
+    path = store._find(digest)[1]
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FilesystemBlobStore(str(tmp_path / 'blobs'), compression='zlib')
+
+
+def test_put_get_roundtrip(store):
+    data = b'%PDF-1.4 binary \x00\x01\x02' * 10
+    digest = store.put(data)
+    assert digest == store.digest(data)
+    assert store.exists(digest)
+    assert store.get(digest) == data
+
+
+def test_put_is_idempotent(store):
+    data = b'same content'
+    assert store.put(data) == store.put(data)
+    assert [d for d, _ in store.iter_digests()] == [store.digest(data)]
+
+
+def test_compressible_data_is_stored_compressed(store):
+    data = b'text line\n' * 10000
+    digest = store.put(data)
+    encoding, stored = store.read_stored(digest)
+    assert encoding == 'zlib'
+    assert len(stored) < len(data)
+    assert store.get(digest) == data
+
+
+def test_already_compressed_data_is_stored_as_is(store):
+    data = b'PK\x03\x04' + os.urandom(4096)
+    digest = store.put(data)
+    assert store.read_stored(digest) == (None, data)
+
+
+def test_put_file_checks_sha256(store, tmp_path):
+    source = tmp_path / 'scan.pdf'
+    source.write_bytes(b'scan')
+    with pytest.raises(ValueError):
+        store.put_file(str(source), '0' * 64)
+    assert source.exists()
+
+    digest = store.put_file(str(source), store.digest(b'scan'))
+    assert not source.exists()
+    assert store.get(digest) == b'scan'
+
+
+def test_missing_and_invalid_digest(store):
+    with pytest.raises(ValueError):
+        store.get('0' * 64)
+    with pytest.raises(ValueError):
+        store.get('../etc/passwd')
+
+
+def test_delete(store):
+    digest = store.put(b'data')
+    assert store.delete(digest)
+    assert not store.exists(digest)
+    assert not store.delete(digest)
+
+
+def test_gc_removes_only_old_unreferenced_blobs(store):
+    referenced = store.put(b'referenced')
+    orphan = store.put(b'orphan')
+    fresh = store.put(b'fresh')
+    age(store, referenced, 7200)
+    age(store, orphan, 7200)
+
+    removed = collect_garbage(FakeDb([referenced]), store, grace_period=3600)
+    assert removed == [orphan]
+    assert not store.exists(orphan)
+    assert store.exists(referenced)
+    assert store.exists(fresh)
+
+
+def test_gc_dry_run_keeps_blobs(store):
+    orphan = store.put(b'orphan')
+    age(store, orphan, 7200)
+    assert collect_garbage(
+        FakeDb(), store, grace_period=3600, dry_run=True
+    ) == [orphan]
+    assert store.exists(orphan)
+
+
+def test_gc_keeps_pending_uploads(store):
+    pending = store.put(b'uploaded, not attached yet')
+    age(store, pending, 7200)
+    assert collect_garbage(
+        FakeDb(), store, grace_period=3600,
+        uploads=FakeUploads([pending])
+    ) == []
+    assert store.exists(pending)
+
+
+def test_put_again_protects_blob_from_gc(store):
+    digest = store.put(b'reused')
+    age(store, digest, 7200)
+    store.put(b'reused')
+    assert collect_garbage(FakeDb(), store, grace_period=3600) == []
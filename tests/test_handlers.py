@@ -0,0 +1,104 @@
+import pytest
+
+from handlers import FileHelper, RequestHandler, _patch_date, _patch_text
+
+
+def test_accepted_encodings_maps_tokens_to_codecs():
+    assert FileHelper.accepted_encodings('gzip, deflate, br') == ('zlib',)
+    assert FileHelper.accepted_encodings('zstd, deflate') == ('zlib', 'zstd')
+
+
+def test_accepted_encodings_ignores_case_and_spaces():
+    assert FileHelper.accepted_encodings(' Deflate ;q=0.5') == ('zlib',)
+
+
+def test_accepted_encodings_honours_zero_quality():
+    assert FileHelper.accepted_encodings('deflate;q=0, zstd') == ('zstd',)
+    assert FileHelper.accepted_encodings('deflate;q=0.0') == ()
+
+
+def test_accepted_encodings_invalid_quality_rejects_token():
+    assert FileHelper.accepted_encodings('deflate;q=bad') == ()
+
+
+def test_accepted_encodings_empty_header():
+    assert FileHelper.accepted_encodings('') == ()
+    assert FileHelper.accepted_encodings('identity') == ()
+
+
+class FakeManager:
+    def __init__(self, changed=True):
+        self.changed = changed
+        self.calls = []
+
+    def _result(self, row):
+        return {'success': True, 'changed': self.changed, 'old': row,
+                'new': row, 'object': {'objectname': 'Объект'}}
+
+    def patch_receipt(self, receipt_id, changes, files, context=None):
+        self.calls.append((receipt_id, changes, files))
+        return self._result({'id': receipt_id, 'object_id': 1,
+                             'seller_object_name': 'Кабель',
+                             'quantity': 3})
+
+    def patch_writeoff(self, writeoff_id, changes, file_data, filename,
+                       context=None):
+        self.calls.append((writeoff_id, changes, file_data, filename))
+        return self._result({'id': writeoff_id, 'object_id': 1,
+                             'quantity': 3})
+
+
+def make_handler(manager):
+    return RequestHandler(None, manager, None, None)
+
+
+def test_patch_text_and_date():
+    assert _patch_text('') is None
+    assert _patch_text('СЧ-1') == 'СЧ-1'
+    assert _patch_date('') is None
+    assert _patch_date('2024-02-29') == '2024-02-29'
+    with pytest.raises(ValueError, match='Неверная дата'):
+        _patch_date('2023-02-29')
+    with pytest.raises(ValueError, match='Неверная дата'):
+        _patch_date('01.02.2024')
+
+
+def test_patch_changes_keeps_only_sent_fields():
+    changes = RequestHandler._patch_changes(
+        {'id': '5', 'quantity': '10', 'billNumber': '', 'ecDate': '2024-05-01',
+         'unknown': 'x'},
+        RequestHandler.RECEIPT_PATCH_FIELDS
+    )
+    assert changes == {
+        'quantity': 10, 'bill_number': None,
+        'entry_control_date': '2024-05-01'
+    }
+
+
+def test_patch_changes_rejects_bad_values():
+    with pytest.raises(ValueError):
+        RequestHandler._patch_changes(
+            {'quantity': 'много'}, RequestHandler.WRITEOFF_PATCH_FIELDS
+        )
+
+
+def test_patch_receipt_passes_changes_and_files():
+    manager = FakeManager()
+    result = make_handler(manager).patch_receipt(
+        {'id': '5', 'objectId': '2', 'invoiceDate': ''},
+        {'editBillFile': {'data': b'%PDF', 'filename': 'bill.pdf'}}
+    )
+    assert result['changed']
+    assert manager.calls == [(
+        5, {'object_id': 2, 'invoice_date': None},
+        {'bill': (b'%PDF', 'bill.pdf'), 'invoice': (None, None),
+         'entry_control': (None, None)}
+    )]
+
+
+def test_patch_writeoff_without_changes():
+    manager = FakeManager(changed=False)
+    result = make_handler(manager).patch_writeoff({'id': '3'})
+    assert manager.calls == [(3, {}, None, None)]
+    assert not result['changed']
+    assert result['message'] == 'Изменений нет'
@@ -0,0 +1,142 @@
+import datetime
+import json
+import uuid
+from decimal import Decimal
+
+import pytest
+
+from jsonenc import JsonEncoder, JsonStream, orjson, to_columns
+
+ROWS = [
+    {
+        'id': i,
+        'objectname': f'Объект {i}',
+        'amount': Decimal(f'{i}.50'),
+        'created_at': datetime.datetime(2024, 3, 1, 9, 30, i),
+        'contract_date': datetime.date(2024, 1, 1 + i),
+        'guid': uuid.UUID(int=i),
+        'active': i % 2 == 0,
+        'comment': None,
+    }
+    for i in range(5)
+]
+
+BACKENDS = ['json'] + (['orjson'] if orjson is not None else [])
+
+
+def baseline(data):
+    return json.dumps(data, default=str, ensure_ascii=False).encode('utf-8')
+
+
+def test_json_backend_matches_json_dumps():
+    encoder = JsonEncoder('json')
+    assert encoder.encode(ROWS) == baseline(ROWS)
+    assert encoder.encode({'rows': ROWS, 'total': 5}) == \
+        baseline({'rows': ROWS, 'total': 5})
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_values_match_json_dumps(backend):
+    encoded = JsonEncoder(backend).encode(ROWS)
+    assert json.loads(encoded) == json.loads(baseline(ROWS))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_bytes_are_base64(backend):
+    encoded = JsonEncoder(backend).encode({'file': b'\x00\xff'})
+    assert json.loads(encoded) == {'file': 'AP8='}
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        JsonEncoder('simplejson')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('batches', [
+    [ROWS], [ROWS[:2], [], ROWS[2:]], [[row] for row in ROWS], [], [[]],
+])
+def test_stream_matches_single_encode(backend, batches):
+    encoder = JsonEncoder(backend)
+    rows = [row for batch in batches for row in batch]
+
+    stream = JsonStream(batches)
+    assert b''.join(stream.chunks(encoder)) == encoder.encode(rows)
+    assert stream.materialize() == rows
+
+    stream = JsonStream(batches, 'objects', {'total': len(rows)})
+    expected = {'objects': rows, 'total': len(rows)}
+    assert b''.join(stream.chunks(encoder)) == encoder.encode(expected)
+    assert stream.materialize() == expected
+
+
+def test_stream_times_serialization():
+    timings = []
+
+    class Timer:
+        def __init__(self, stage):
+            timings.append(stage)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    chunks = JsonStream([ROWS[:2], ROWS[2:]]).chunks(JsonEncoder('json'), Timer)
+    assert next(chunks).startswith(b'[{')
+    assert timings == ['serialize']
+
+
+def decode_columns(data):
+    """Обратное преобразование, как его делает клиент."""
+    rows = [{} for _ in range(data['count'])]
+    for column, values in zip(data['columns'], data['values']):
+        dictionary = data['dictionaries'].get(column)
+        for row, value in zip(rows, values):
+            if dictionary is not None and value is not None:
+                value = dictionary[value]
+            row[column] = value
+    return rows
+
+
+def test_to_columns_roundtrip():
+    rows = [
+        {'id': i, 'seller_name': ['ООО А', 'ООО Б', None][i % 3],
+         'objectname': f'Объект {i}', 'amount': Decimal(i)}
+        for i in range(10)
+    ]
+    data = to_columns(rows)
+    assert data['columns'] == ['id', 'seller_name', 'objectname', 'amount']
+    assert data['count'] == 10
+    assert data['values'][0] == list(range(10))
+    assert decode_columns(data) == rows
+
+
+def test_to_columns_dictionary_encodes_repeated_strings_only():
+    rows = [
+        {'status': ['new', 'old'][i % 2], 'name': f'n{i}', 'n': i % 2}
+        for i in range(6)
+    ]
+    data = to_columns(rows)
+    assert data['dictionaries'] == {'status': ['new', 'old']}
+    assert data['values'][0] == [0, 1, 0, 1, 0, 1]
+    assert data['values'][1] == [f'n{i}' for i in range(6)]
+    assert data['values'][2] == [0, 1, 0, 1, 0, 1]
+
+    assert to_columns(rows, dictionary_ratio=0)['dictionaries'] == {}
+    assert 'name' in to_columns(rows, dictionary_ratio=1)['dictionaries']
+
+
+def test_to_columns_mixed_types_are_not_dictionary_encoded():
+    rows = [{'value': 'a'}, {'value': 1}, {'value': 'a'}, {'value': 'a'}]
+    data = to_columns(rows)
+    assert data['dictionaries'] == {}
+    assert data['values'] == [['a', 1, 'a', 'a']]
+
+
+def test_to_columns_empty():
+    assert to_columns([]) == {
+        'columns': [], 'values': [], 'count': 0, 'dictionaries': {}
+    }
+    assert to_columns(iter([{'id': 1}]))['values'] == [[1]]
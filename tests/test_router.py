@@ -0,0 +1,88 @@
+import pytest
+
+from router import MAX_IDS, Param, ParameterError, Router, id_list
+
+
+def handler(request):
+    return None
+
+
+@pytest.fixture
+def router():
+    router = Router(max_body=1024)
+    router.get('/api/objects', handler)
+    router.get('/api/objects/{object_id:int}', handler, name='object')
+    router.delete('/api/objects/{object_id:int}', handler)
+    router.get('/api/files/{file_type:file_type}/{entity_id:int}', handler)
+    router.post('/api/uploads', handler, auth='user', max_body=None)
+    return router
+
+
+def test_static_and_parameterised_routes(router):
+    route, params = router.match('GET', '/api/objects')
+    assert route.path == '/api/objects' and params == {}
+
+    route, params = router.match('GET', '/api/objects/42')
+    assert route.name == 'object'
+    assert params == {'object_id': 42}
+
+    route, params = router.match('GET', '/api/files/invoice/7')
+    assert params == {'file_type': 'invoice', 'entity_id': 7}
+
+
+def test_unmatched_paths(router):
+    assert router.match('GET', '/api/objects/abc') == (None, None)
+    assert router.match('GET', '/api/objects/42/extra') == (None, None)
+    assert router.match('GET', '/api/files/photo/7') == (None, None)
+    assert router.match('PUT', '/api/objects') == (None, None)
+
+
+def test_allowed_methods(router):
+    assert router.allowed_methods('/api/objects/1') == ['DELETE', 'GET']
+    assert router.allowed_methods('/api/uploads') == ['POST']
+    assert router.allowed_methods('/missing') == []
+
+
+def test_body_and_limits_defaults(router):
+    assert router.match('GET', '/api/objects')[0].body is None
+    assert router.match('DELETE', '/api/objects/1')[0].body == 'discard'
+    upload = router.match('POST', '/api/uploads')[0]
+    assert upload.body == 'form'
+    assert upload.auth == 'user'
+    assert upload.max_body is None
+    assert router.match('GET', '/api/objects')[0].max_body == 1024
+
+
+def test_routes_lists_everything(router):
+    assert len(list(router.routes())) == 5
+
+
+def test_query_params():
+    route = Router().get('/api/logs', handler, params=[
+        Param('limit', int, default=100),
+        Param('search', default=None),
+        Param('id', int, error='Missing object id', arg='object_id'),
+    ])
+    assert route.arguments({}, {'id': ['5']}) == {
+        'limit': 100, 'search': None, 'object_id': 5
+    }
+    assert route.arguments({'x': 1}, {'id': ['5'], 'limit': ['10']}) == {
+        'x': 1, 'limit': 10, 'search': None, 'object_id': 5
+    }
+    with pytest.raises(ParameterError, match='Missing object id'):
+        route.arguments({}, {'id': ['']})
+    with pytest.raises(ParameterError, match='Invalid limit'):
+        route.arguments({}, {'id': ['5'], 'limit': ['ten']})
+
+
+def test_id_list():
+    assert id_list('1,2, 3,') == [1, 2, 3]
+    with pytest.raises(ValueError):
+        id_list('1,x')
+    with pytest.raises(ParameterError):
+        id_list(','.join(['1'] * (MAX_IDS + 1)))
+    route = Router().get('/api/archive', handler, params=[
+        Param('ids', id_list)
+    ])
+    with pytest.raises(ParameterError, match='Invalid ids'):
+        route.arguments({}, {'ids': ['1,x']})
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+from blobstore import FilesystemBlobStore
+from uploads import StoredDocument, UploadManager
+
+USER = {'id': 1, 'username': 'admin'}
+OTHER = {'id': 2, 'username': 'user'}
+DATA = b'%PDF-1.4 ' + bytes(range(256)) * 4
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FilesystemBlobStore(str(tmp_path / 'blobs'), compression='none')
+
+
+@pytest.fixture
+def uploads(tmp_path, store):
+    return UploadManager(str(tmp_path / 'uploads'), store, chunk_size=100)
+
+
+def upload_all(uploads, status, data=DATA):
+    upload_id = status['upload_id']
+    for index in range(status['total_chunks']):
+        chunk = data[index * 100:(index + 1) * 100]
+        status = uploads.put_chunk(
+            USER, upload_id, index, chunk, hashlib.sha256(chunk).hexdigest()
+        )
+    return status
+
+
+def test_chunked_upload_is_stored_in_blob_store(uploads, store):
+    status = uploads.create(
+        USER, 'scan.pdf', len(DATA), hashlib.sha256(DATA).hexdigest()
+    )
+    assert status['total_chunks'] == 11
+    status = upload_all(uploads, status)
+    assert status['complete']
+
+    status = uploads.finalize(USER, status['upload_id'])
+    document = uploads.resolve(USER, status['document_id'])
+    assert isinstance(document, StoredDocument)
+    assert document.filename == 'scan.pdf'
+    assert document.content_type == 'application/pdf'
+    assert len(document) == len(DATA)
+    assert store.get(document.sha256) == DATA
+    assert uploads.pending_digests() == {document.sha256}
+
+    uploads.release(status['document_id'])
+    assert uploads.pending_digests() == set()
+
+
+def test_status_reports_received_chunks(uploads):
+    status = uploads.create(USER, 'scan.pdf', 250)
+    uploads.put_chunk(USER, status['upload_id'], 2, DATA[:50])
+    status = uploads.status(USER, status['upload_id'])
+    assert status['received'] == [2]
+    assert status['received_offsets'] == [200]
+    assert status['received_bytes'] == 50
+    assert not status['complete']
+
+
+def test_chunk_validation(uploads):
+    upload_id = uploads.create(USER, 'scan.pdf', 250)['upload_id']
+    with pytest.raises(ValueError, match='Checksum'):
+        uploads.put_chunk(USER, upload_id, 0, DATA[:100], '0' * 64)
+    with pytest.raises(ValueError, match='index'):
+        uploads.put_chunk(USER, upload_id, 3, DATA[:100])
+    with pytest.raises(ValueError, match='length'):
+        uploads.put_chunk(USER, upload_id, 0, DATA[:99])
+    with pytest.raises(ValueError, match='incomplete'):
+        uploads.finalize(USER, upload_id)
+
+
+def test_finalize_rejects_wrong_sha256(uploads):
+    status = uploads.create(USER, 'scan.pdf', len(DATA), '0' * 64)
+    status = upload_all(uploads, status)
+    with pytest.raises(ValueError, match='Checksum'):
+        uploads.finalize(USER, status['upload_id'])
+    with pytest.raises(ValueError, match='not found'):
+        uploads.status(USER, status['upload_id'])
+
+
+def test_upload_belongs_to_its_user(uploads):
+    upload_id = uploads.create(USER, 'scan.pdf', 10)['upload_id']
+    with pytest.raises(ValueError, match='not found'):
+        uploads.status(OTHER, upload_id)
+    with pytest.raises(ValueError, match='not found'):
+        uploads.put_chunk(OTHER, upload_id, 0, DATA[:10])
+
+
+def test_invalid_upload_id(uploads):
+    with pytest.raises(ValueError, match='Invalid upload id'):
+        uploads.status(USER, '../../etc')
+
+
+def test_create_limits(uploads):
+    with pytest.raises(ValueError):
+        uploads.create(USER, '', 10)
+    with pytest.raises(ValueError):
+        uploads.create(USER, 'scan.pdf', 0)
+    with pytest.raises(ValueError):
+        uploads.create(USER, 'scan.pdf', 300 * 1024 * 1024)
+
+
+def test_reap_removes_stale_uploads(tmp_path, store):
+    uploads = UploadManager(
+        str(tmp_path / 'uploads'), store, chunk_size=100, max_age=60
+    )
+    stale = uploads.create(USER, 'old.pdf', 10)['upload_id']
+    fresh = uploads.create(USER, 'new.pdf', 10)['upload_id']
+    meta = uploads._load(stale)
+    meta['updated_at'] = time.time() - 120
+    with open(os.path.join(uploads._dir(stale), 'meta.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    assert uploads.reap() == 1
+    with pytest.raises(ValueError):
+        uploads.status(USER, stale)
+    assert uploads.status(USER, fresh)['upload_id'] == fresh
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import math
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+
+from handlers import FileHelper
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class StoredDocument:
+    """Документ, содержимое которого уже лежит в хранилище блобов.
+
+    Передаётся в StorageManager вместо байтов файла.
+    """
+
+    __slots__ = ('sha256', 'size', 'filename', 'content_type')
+
+    def __init__(self, sha256, size, filename, content_type):
+        self.sha256 = sha256
+        self.size = size
+        self.filename = filename
+        self.content_type = content_type
+
+    def __len__(self):
+        return self.size
+
+
+class UploadManager:
+    """Возобновляемая загрузка больших файлов по частям."""
+
+    def __init__(self, root, blob_store, chunk_size=4 * 1024 * 1024,
+                 max_size=200 * 1024 * 1024, max_age=24 * 3600):
+        self._root = os.path.abspath(root)
+        self._blob_store = blob_store
+        self.chunk_size = chunk_size
+        self._max_size = max_size
+        self._max_age = max_age
+        # _lock защищает только словарь блокировок; сами загрузки
+        # блокируются каждая своей, чтобы долгий finalize одной не
+        # задерживал части других
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        os.makedirs(self._root, exist_ok=True)
+
+    # ==================== STORAGE ====================
+    def _dir(self, upload_id):
+        if not upload_id or not UPLOAD_ID_RE.match(upload_id):
+            raise ValueError('Invalid upload id')
+        return os.path.join(self._root, upload_id)
+
+    def _upload_lock(self, upload_id):
+        self._dir(upload_id)
+        with self._lock:
+            return self._upload_locks.setdefault(
+                upload_id, threading.Lock()
+            )
+
+    def _load(self, upload_id, user=None):
+        try:
+            with open(os.path.join(self._dir(upload_id), 'meta.json'),
+                      'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise ValueError('Upload not found')
+        if user is not None and meta['user_id'] != user.get('id'):
+            raise ValueError('Upload not found')
+        return meta
+
+    def _save(self, meta):
+        meta['updated_at'] = time.time()
+        path = os.path.join(self._dir(meta['id']), 'meta.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def _status(self, meta):
+        received = sorted(meta['received'])
+        received_bytes = sum(
+            self._chunk_length(meta, index) for index in received
+        )
+        return {
+            'upload_id': meta['id'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'chunk_size': meta['chunk_size'],
+            'total_chunks': meta['total_chunks'],
+            'received': received,
+            'received_offsets': [i * meta['chunk_size'] for i in received],
+            'received_bytes': received_bytes,
+            'complete': len(received) == meta['total_chunks'],
+            'document_id': meta['id'] if meta.get('document') else None
+        }
+
+    @staticmethod
+    def _chunk_length(meta, index):
+        offset = index * meta['chunk_size']
+        return min(meta['chunk_size'], meta['size'] - offset)
+
+    # ==================== PROTOCOL ====================
+    def create(self, user, filename, size, sha256=None):
+        if not filename:
+            raise ValueError('Missing filename')
+        if size <= 0:
+            raise ValueError('Invalid file size')
+        if size > self._max_size:
+            raise ValueError('Файл слишком большой')
+
+        upload_id = secrets.token_hex(16)
+        upload_dir = self._dir(upload_id)
+        os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, 'data'), 'wb') as f:
+            f.truncate(size)
+
+        meta = {
+            'id': upload_id,
+            'user_id': user.get('id'),
+            'filename': os.path.basename(filename),
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'chunk_size': self.chunk_size,
+            'total_chunks': math.ceil(size / self.chunk_size),
+            'received': [],
+            'created_at': time.time(),
+            'document': None
+        }
+        self._save(meta)
+        return self._status(meta)
+
+    def put_chunk(self, user, upload_id, index, data, checksum=None):
+        if checksum and \
+                hashlib.sha256(data).hexdigest() != checksum.lower():
+            raise ValueError('Checksum mismatch')
+        with self._upload_lock(upload_id):
+            meta = self._load(upload_id, user)
+            if meta.get('document'):
+                raise ValueError('Upload already finalized')
+            if index < 0 or index >= meta['total_chunks']:
+                raise ValueError('Invalid chunk index')
+            if len(data) != self._chunk_length(meta, index):
+                raise ValueError('Invalid chunk length')
+
+            path = os.path.join(self._dir(upload_id), 'data')
+            with open(path, 'r+b') as f:
+                f.seek(index * meta['chunk_size'])
+                f.write(data)
+
+            if index not in meta['received']:
+                meta['received'].append(index)
+            self._save(meta)
+            return self._status(meta)
+
+    def status(self, user, upload_id):
+        return self._status(self._load(upload_id, user))
+
+    def finalize(self, user, upload_id):
+        with self._upload_lock(upload_id):
+            meta = self._load(upload_id, user)
+            if meta.get('document'):
+                return self._status(meta)
+            if len(meta['received']) != meta['total_chunks']:
+                raise ValueError('Upload is incomplete')
+
+            path = os.path.join(self._dir(upload_id), 'data')
+            with open(path, 'rb') as f:
+                head = f.read(16)
+            try:
+                # Сумма проверяется до записи в хранилище
+                digest = self._blob_store.put_file(path, meta['sha256'])
+            except ValueError:
+                self._remove(upload_id)
+                raise
+
+            meta['document'] = {
+                'sha256': digest,
+                'size': meta['size'],
+                'filename': meta['filename'],
+                'content_type': FileHelper.detect_content_type(
+                    head, meta['filename']
+                )
+            }
+            self._save(meta)
+            return self._status(meta)
+
+    def abort(self, user, upload_id):
+        self._load(upload_id, user)
+        self._remove(upload_id)
+
+    # ==================== DOCUMENTS ====================
+    def resolve(self, user, document_id):
+        """Возвращает StoredDocument для завершённой загрузки."""
+        meta = self._load(document_id, user)
+        document = meta.get('document')
+        if not document:
+            raise ValueError('Upload is not finalized')
+        return StoredDocument(
+            document['sha256'], document['size'],
+            document['filename'], document['content_type']
+        )
+
+    def pending_digests(self):
+        """Блобы завершённых загрузок, ещё не привязанных к записи.
+
+        Сборщик мусора считает их используемыми: загрузка может
+        ждать привязки до max_age.
+        """
+        digests = set()
+        for upload_id in os.listdir(self._root):
+            if not UPLOAD_ID_RE.match(upload_id):
+                continue
+            try:
+                document = self._load(upload_id).get('document')
+            except (ValueError, json.JSONDecodeError):
+                continue
+            if document:
+                digests.add(document['sha256'])
+        return digests
+
+    def release(self, document_id):
+        """Удаляет сессию после привязки документа к записи."""
+        self._remove(document_id)
+
+    # ==================== REAPER ====================
+    def _remove(self, upload_id):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+    def reap(self):
+        threshold = time.time() - self._max_age
+        removed = 0
+        for upload_id in os.listdir(self._root):
+            if not UPLOAD_ID_RE.match(upload_id):
+                continue
+            with self._upload_lock(upload_id):
+                try:
+                    meta = self._load(upload_id)
+                    updated_at = meta['updated_at']
+                except (ValueError, KeyError, json.JSONDecodeError):
+                    updated_at = os.path.getmtime(self._dir(upload_id))
+                if updated_at < threshold:
+                    self._remove(upload_id)
+                    removed += 1
+        return removed
+
+    def start_reaper(self, interval=600):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reap()
+                except Exception as e:
+                    print(f'Upload reaper failed: {e}')
+
+        thread = threading.Thread(
+            target=run, daemon=True, name='upload-reaper'
+        )
+        thread.start()
+        return thread
+
+
+def create_upload_manager(config, blob_store):
+    upload_config = config.get('uploads') or {}
+    if blob_store is None or not upload_config.get('path'):
+        return None
+    manager = UploadManager(
+        upload_config['path'], blob_store,
+        upload_config.get('chunk_size', 4 * 1024 * 1024),
+        upload_config.get('max_size', 200 * 1024 * 1024),
+        upload_config.get('max_age', 24 * 3600)
+    )
+    manager.reap()
+    manager.start_reaper(upload_config.get('reap_interval', 600))
+    return manager